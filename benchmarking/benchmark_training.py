@@ -0,0 +1,240 @@
+"""Measure where the time goes in training an MS2DeepScore model, without running a full training.
+
+Runs a fixed number of training steps on synthetic spectra (or a subsample of the training split)
+and appends the per-stage timings, peak RSS and samples/s to a json report and a csv file with the
+same name (one row per run, to compare configurations), e.g.:
+    python benchmark_training.py --steps 50 --batch_size 64 --embedding_dim 200 --report training_benchmarks.json
+"""
+import argparse
+import cProfile
+import json
+import os
+import resource
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from tensorflow.keras.optimizers import Adam  # pylint: disable=import-error
+from matchms import Spectrum
+from ms2deepscore import SpectrumBinner
+from ms2deepscore.data_generators import DataGeneratorAllInchikeys
+from ms2deepscore.models import SiameseModel
+from train_ms2deepscore_model import SPECTRUM_BINNER_SETTINGS
+
+
+def cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the training of an MS2DeepScore model.")
+    parser.add_argument("--steps", type=int, default=50,
+                        help="Number of training steps, at least 2 (the first one builds the graph and is not timed).")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--embedding_dim", type=int, default=200)
+    parser.add_argument("--base_dims", type=int, nargs="+", default=[500, 500])
+    parser.add_argument("--intra_op_threads", type=int, default=0, help="Tensorflow intra op threads (0 = default).")
+    parser.add_argument("--inter_op_threads", type=int, default=0, help="Tensorflow inter op threads (0 = default).")
+    parser.add_argument("--n_spectra", type=int, default=5000, help="Number of synthetic spectra.")
+    parser.add_argument("--n_inchikeys", type=int, default=1000, help="Number of synthetic InChIKeys.")
+    parser.add_argument("--library_store", default=None,
+                        help="Spectrum store with a train split (see split_data.py), subsampled instead of synthetic data.")
+    parser.add_argument("--tanimoto_scores", default=None, help="Tanimoto store, required with --library_store.")
+    parser.add_argument("--profile", choices=["cprofile", "pyinstrument"], default=None,
+                        help="Profile the training steps, the profile is saved next to the report.")
+    parser.add_argument("--report", default="training_benchmarks.json",
+                        help="Json file the results are appended to, the csv is written next to it.")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+def synthetic_training_data(n_spectra: int, n_inchikeys: int, seed: int = 42):
+    """Random spectra with n_inchikeys different InChIKeys and a random symmetric Tanimoto dataframe"""
+    rng = np.random.default_rng(seed)
+    inchikeys14 = np.array(["".join(chars) for chars in rng.choice(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"),
+                                                                   size=(n_inchikeys, 14))])
+    inchikeys14 = np.unique(inchikeys14)
+    spectra = []
+    for i in range(n_spectra):
+        n_peaks = rng.integers(5, 200)
+        spectra.append(Spectrum(mz=np.sort(rng.uniform(10.0, 1000.0, n_peaks)),
+                                intensities=rng.uniform(0.01, 1.0, n_peaks),
+                                metadata={"inchikey": inchikeys14[i % len(inchikeys14)] + "-UHFFFAOYSA-N"}))
+    scores = rng.random((len(inchikeys14), len(inchikeys14)))
+    scores = (scores + scores.T) / 2
+    np.fill_diagonal(scores, 1.0)
+    return spectra, pd.DataFrame(scores, index=inchikeys14, columns=inchikeys14)
+
+
+def subsampled_training_data(library_store: str, tanimoto_scores_file: str, n_spectra: int, seed: int = 42):
+    """A random subsample of the train split of library_store with the Tanimoto scores"""
+    from spectrum_store import SpectrumStore
+    from split_data import load_split_indices
+    from tanimoto_store import load_tanimoto_matrix
+    train_indices = load_split_indices(library_store, "train")
+    selected = np.random.default_rng(seed).choice(train_indices, size=min(n_spectra, len(train_indices)), replace=False)
+    spectra = SpectrumStore(library_store).get_spectra(np.sort(selected))
+    return spectra, load_tanimoto_matrix(tanimoto_scores_file).to_dataframe()
+
+
+class TimedDataGenerator(DataGeneratorAllInchikeys):
+    """DataGeneratorAllInchikeys that adds up the time spent in pair selection and in augmentation
+
+    stage_seconds:
+        Seconds spent selecting the spectrum pairs and augmenting the binned spectra, over all batches.
+        The rest of the batch time goes to building the input vectors.
+    """
+    def __init__(self, *args, **kwargs):
+        self.stage_seconds = {"pair_selection": 0.0, "augmentation": 0.0}
+        super().__init__(*args, **kwargs)
+
+    def _spectrum_pair_generator(self, batch_index: int):
+        # The pairs are selected lazily while the batch is assembled, so each pair is timed separately
+        spectrum_pairs = super()._spectrum_pair_generator(batch_index)
+        while True:
+            start = time.perf_counter()
+            spectrum_pair = next(spectrum_pairs, None)
+            self.stage_seconds["pair_selection"] += time.perf_counter() - start
+            if spectrum_pair is None:
+                return
+            yield spectrum_pair
+
+    def _data_augmentation(self, spectrum_binned):
+        start = time.perf_counter()
+        augmented = super()._data_augmentation(spectrum_binned)
+        self.stage_seconds["augmentation"] += time.perf_counter() - start
+        return augmented
+
+
+@contextmanager
+def timed(timings: Dict[str, float], stage: str):
+    start = time.perf_counter()
+    yield
+    timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB (Linux reports ru_maxrss in kB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark_training(spectra: List[Spectrum], tanimoto_df: pd.DataFrame, steps: int, batch_size: int,
+                       embedding_dim: int, base_dims, profiler=None) -> dict:
+    """Time each stage of the training pipeline for a fixed number of training steps
+
+    The first step builds the tensorflow graph and is reported separately, so at least 2 steps are needed.
+    """
+    if steps < 2:
+        raise ValueError(f"At least 2 steps are needed, the first one is not timed (steps={steps})")
+    timings = {}
+    with timed(timings, "binning"):
+        spectrum_binner = SpectrumBinner(**SPECTRUM_BINNER_SETTINGS)
+        binned_spectrums = spectrum_binner.fit_transform(spectra)
+    inchikeys = np.unique([s.get("inchikey")[:14] for s in spectra])
+    same_prob_bins = list(zip(np.linspace(0, 0.9, 10), np.linspace(0.1, 1, 10)))
+    with timed(timings, "generator_setup"):
+        generator = TimedDataGenerator(
+            binned_spectrums, inchikeys, tanimoto_df, dim=len(spectrum_binner.known_bins), batch_size=batch_size,
+            same_prob_bins=same_prob_bins, num_turns=2, augment_noise_max=10, augment_noise_intensity=0.01)
+    if len(generator) == 0:
+        raise ValueError(f"The data generator has no batches, there are fewer InChIKeys ({len(inchikeys)}) "
+                         f"than batch_size ({batch_size})")
+    with timed(timings, "model_setup"):
+        model = SiameseModel(spectrum_binner, base_dims=tuple(base_dims), embedding_dim=embedding_dim,
+                             dropout_rate=0.2)
+        model.compile(loss='mse', optimizer=Adam(lr=0.01), metrics=["mae", tf.keras.metrics.RootMeanSquaredError()])
+
+    # Batches are created up front, so the data generator is timed apart from the training steps
+    batches = []
+    batch_seconds = []
+    for step in range(steps):
+        start = time.perf_counter()
+        batches.append(generator[step % len(generator)])
+        batch_seconds.append(time.perf_counter() - start)
+    timings["batch_generation"] = sum(batch_seconds)
+    timings.update(generator.stage_seconds)
+    # First step builds the tensorflow graph, it is reported separately
+    with timed(timings, "first_train_step"):
+        model.model.train_on_batch(*batches[0])
+    if profiler is not None:
+        profiler.start()
+    with timed(timings, "train_steps"):
+        for inputs, targets in batches[1:]:
+            model.model.train_on_batch(inputs, targets)
+    if profiler is not None:
+        profiler.stop()
+    # Like the ModelCheckpoint of train_ms2deepscore_model, which saves the keras model
+    with timed(timings, "checkpoint_write"), tempfile.TemporaryDirectory() as directory:
+        model.model.save(os.path.join(directory, "checkpoint.hdf5"))
+
+    return {"timings_seconds": timings,
+            "samples_per_second": (steps - 1) * batch_size / timings["train_steps"],
+            "batches_per_second_generator": steps / timings["batch_generation"],
+            "max_batch_generation_seconds": max(batch_seconds),
+            "peak_rss_mb": peak_rss_mb()}
+
+
+class _CProfiler:
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.profile.dump_stats(self.filename)
+
+
+class _PyinstrumentProfiler:
+    def __init__(self, filename: str):
+        from pyinstrument import Profiler  # optional dependency
+        self.filename = filename
+        self.profiler = Profiler()
+
+    def start(self):
+        self.profiler.start()
+
+    def stop(self):
+        self.profiler.stop()
+        with open(self.filename, "w") as file:
+            file.write(self.profiler.output_html())
+
+
+def main():
+    args = cli()
+    if args.intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(args.intra_op_threads)
+    if args.inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(args.inter_op_threads)
+    if args.library_store is not None:
+        spectra, tanimoto_df = subsampled_training_data(args.library_store, args.tanimoto_scores,
+                                                        args.n_spectra, args.seed)
+    else:
+        spectra, tanimoto_df = synthetic_training_data(args.n_spectra, args.n_inchikeys, args.seed)
+
+    profiler = None
+    report_base = os.path.splitext(args.report)[0]
+    if args.profile == "cprofile":
+        profiler = _CProfiler(f"{report_base}_{time.strftime('%Y%m%d_%H%M%S')}.prof")
+    elif args.profile == "pyinstrument":
+        profiler = _PyinstrumentProfiler(f"{report_base}_{time.strftime('%Y%m%d_%H%M%S')}.html")
+
+    results = benchmark_training(spectra, tanimoto_df, args.steps, args.batch_size, args.embedding_dim,
+                                 args.base_dims, profiler)
+    results["settings"] = {key: value for key, value in vars(args).items() if key not in ("report", "profile")}
+    results["timestamp"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    print(json.dumps(results, indent=2))
+
+    reports = []
+    if os.path.exists(args.report):
+        with open(args.report, "r") as file:
+            reports = json.load(file)
+    reports.append(results)
+    with open(args.report, "w") as file:
+        json.dump(reports, file, indent=2)
+    pd.json_normalize(reports, sep="_").to_csv(report_base + ".csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
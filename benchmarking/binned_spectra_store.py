@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import shutil
+from collections.abc import Sequence
+from typing import List
+import numpy as np
+from ms2deepscore import BinnedSpectrum, SpectrumBinner
+from embedding_cache import spectrum_hash
+
+
+BIN_INDICES_FILE = "bin_indices.npy"
+WEIGHTS_FILE = "weights.npy"
+OFFSETS_FILE = "offsets.npy"
+INCHIKEYS_FILE = "inchikeys.txt"
+SPECTRUM_BINNER_FILE = "spectrum_binner.json"
+INPUTS_HASH_FILE = "inputs_hash.txt"
+
+
+def save_binned_spectra(binned_spectrums: List[BinnedSpectrum], directory: str):
+    """Store binned spectra as a CSR-style sparse matrix (bin indices, weights and offsets per spectrum)
+
+    Only the InChIKey of the metadata is kept, which is all the data generators use.
+    """
+    os.makedirs(directory, exist_ok=True)
+    n_peaks = [len(spectrum.binned_peaks) for spectrum in binned_spectrums]
+    offsets = np.zeros(len(binned_spectrums) + 1, dtype=np.int64)
+    np.cumsum(n_peaks, out=offsets[1:])
+    bin_indices = np.empty(offsets[-1], dtype=np.int32)
+    weights = np.empty(offsets[-1], dtype=np.float32)
+    for i, spectrum in enumerate(binned_spectrums):
+        bin_indices[offsets[i]:offsets[i + 1]] = list(spectrum.binned_peaks.keys())
+        weights[offsets[i]:offsets[i + 1]] = list(spectrum.binned_peaks.values())
+    np.save(os.path.join(directory, OFFSETS_FILE), offsets)
+    np.save(os.path.join(directory, BIN_INDICES_FILE), bin_indices)
+    np.save(os.path.join(directory, WEIGHTS_FILE), weights)
+    with open(os.path.join(directory, INCHIKEYS_FILE), "w") as file:
+        file.writelines(f"{spectrum.get('inchikey') or ''}\n" for spectrum in binned_spectrums)
+
+
+class BinnedSpectraStore(Sequence):
+    """Memory-mapped binned spectra stored with save_binned_spectra
+
+    Behaves like a list of BinnedSpectrum, which are created when they are accessed,
+    so it can be passed to the ms2deepscore data generators instead of the list.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.offsets = np.load(os.path.join(directory, OFFSETS_FILE))
+        self.bin_indices = np.load(os.path.join(directory, BIN_INDICES_FILE), mmap_mode="r")
+        self.weights = np.load(os.path.join(directory, WEIGHTS_FILE), mmap_mode="r")
+        with open(os.path.join(directory, INCHIKEYS_FILE), "r") as file:
+            self.inchikeys = [line.rstrip("\n") for line in file]
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("BinnedSpectraStore index out of range")
+        start, end = self.offsets[i], self.offsets[i + 1]
+        binned_peaks = dict(zip(self.bin_indices[start:end].tolist(), self.weights[start:end].tolist()))
+        metadata = {"inchikey": self.inchikeys[i]} if self.inchikeys[i] else {}
+        return BinnedSpectrum(binned_peaks=binned_peaks, metadata=metadata)
+
+
+def save_spectrum_binner(spectrum_binner: SpectrumBinner, filename: str):
+    """Store a fitted SpectrumBinner with its own json serialization (SpectrumBinner.to_json)"""
+    with open(filename, "w") as file:
+        file.write(spectrum_binner.to_json())
+
+
+def load_spectrum_binner(filename: str, **override_settings) -> SpectrumBinner:
+    """Rebuild a fitted SpectrumBinner stored with save_spectrum_binner, without fitting it again
+
+    override_settings:
+        Settings that should differ from the stored ones, e.g. allowed_missing_percentage=100.0
+    """
+    with open(filename, "r") as file:
+        spectrum_binner = SpectrumBinner.from_json(file.read())
+    for setting, value in override_settings.items():
+        assert hasattr(spectrum_binner, setting), f"SpectrumBinner has no setting {setting}"
+        setattr(spectrum_binner, setting, value)
+    return spectrum_binner
+
+
+def binned_spectra_inputs_hash(spectrums_training, spectrums_val, **binner_settings) -> str:
+    """Hash of the peaks and InChIKeys of the training and validation spectra and of the binner settings"""
+    sha256 = hashlib.sha256(json.dumps(binner_settings, sort_keys=True).encode())
+    for split_name, spectra in (("train", spectrums_training), ("val", spectrums_val)):
+        sha256.update(f"{split_name} {len(spectra)}\n".encode())
+        for spectrum in spectra:
+            sha256.update(f"{spectrum_hash(spectrum)} {spectrum.get('inchikey')}\n".encode())
+    return sha256.hexdigest()
+
+
+def load_or_create_binned_spectra(spectrums_training, spectrums_val, directory: str, **binner_settings):
+    """Return the fitted SpectrumBinner and the binned training and validation spectra
+
+    They are loaded from directory if they were stored before for the same spectra and binner settings
+    (see binned_spectra_inputs_hash), otherwise the SpectrumBinner is fitted on spectrums_training and
+    the results are stored in directory, replacing binned spectra of other inputs.
+    """
+    binner_file = os.path.join(directory, SPECTRUM_BINNER_FILE)
+    inputs_hash_file = os.path.join(directory, INPUTS_HASH_FILE)
+    train_directory = os.path.join(directory, "train")
+    val_directory = os.path.join(directory, "val")
+    inputs_hash = binned_spectra_inputs_hash(spectrums_training, spectrums_val, **binner_settings)
+    stored_hash = None
+    if os.path.exists(binner_file) and os.path.exists(inputs_hash_file):
+        with open(inputs_hash_file, "r") as file:
+            stored_hash = file.read().strip()
+    if stored_hash != inputs_hash:
+        for path in (binner_file, inputs_hash_file):
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(train_directory, ignore_errors=True)
+        shutil.rmtree(val_directory, ignore_errors=True)
+        spectrum_binner = SpectrumBinner(**binner_settings)
+        save_binned_spectra(spectrum_binner.fit_transform(spectrums_training), train_directory)
+        save_binned_spectra(spectrum_binner.transform(spectrums_val), val_directory)
+        save_spectrum_binner(spectrum_binner, binner_file)
+        # Written last, it marks the store as complete
+        with open(inputs_hash_file, "w") as file:
+            file.write(inputs_hash)
+    return (load_spectrum_binner(binner_file),
+            BinnedSpectraStore(train_directory),
+            BinnedSpectraStore(val_directory))
@@ -1,68 +1,321 @@
-from typing import List
-import numpy as np
-import pandas as pd
-from ms2deepscore import MS2DeepScore
-from ms2deepscore.models import load_model
-from matchms import Spectrum
-
-
-def tanimoto_dependent_losses(scores, scores_ref, ref_score_bins):
-    """Compute errors (RMSE and MSE) for different bins of the reference scores (scores_ref).
-
-    Parameters
-    ----------
-
-    scores
-        Scores that should be evaluated
-    scores_ref
-        Reference scores (= ground truth).
-    ref_score_bins
-        Bins for the refernce score to evaluate the performance of scores.
-    """
-    rmses = []
-    ref_scores_bins_inclusive = ref_score_bins.copy()
-    ref_scores_bins_inclusive[0] = -np.inf
-    ref_scores_bins_inclusive[-1] = np.inf
-    for i in range(len(ref_scores_bins_inclusive) - 1):
-        low = ref_scores_bins_inclusive[i]
-        high = ref_scores_bins_inclusive[i + 1]
-        idx = np.where((scores_ref >= low) & (scores_ref < high) & (~np.eye(scores_ref.shape[0], dtype=bool)))
-        rmses.append(np.sqrt(np.square(scores_ref[idx] - scores[idx]).mean()))
-    return rmses
-
-
-def do_ms2ds_predictions(test_spectra, ms2ds_model):
-    model = load_model(ms2ds_model)
-    similarity_measure = MS2DeepScore(model)
-    # Calculate scores and get matchms.Scores object
-    scores = similarity_measure.matrix(test_spectra, test_spectra, is_symmetric=True)
-    return scores
-
-
-def select_predictions_for_test_spectra(tanimoto_df: pd.DataFrame,
-                                        test_spectra: List[Spectrum]) -> np.ndarray:
-    """Select the predictions for test_spectra from df with correct predictions
-
-    tanimoto_df:
-        Dataframe with as index and columns Inchikeys of 14 letters
-    test_spectra:
-        list of test spectra
-    """
-    inchikey_idx_test = np.zeros(len(test_spectra))
-    for i, spec in enumerate(test_spectra):
-        inchikey_idx_test[i] = np.where(tanimoto_df.index.values == spec.get("inchikey")[:14])[0]
-
-    inchikey_idx_test = inchikey_idx_test.astype("int")
-    scores_ref = tanimoto_df.values[np.ix_(inchikey_idx_test[:], inchikey_idx_test[:])].copy()
-    return scores_ref
-
-
-def calculate_binned_average_rmse(testing_spectra, tanimoto_score_df, ms2ds_model_file):
-    # plot_parent_mass_distribution(testing_spectra)
-    correct_scores = select_predictions_for_test_spectra(tanimoto_score_df, testing_spectra)
-
-    predicted_scores = do_ms2ds_predictions(testing_spectra, ms2ds_model_file)
-    rmses = tanimoto_dependent_losses(predicted_scores, correct_scores,
-                                                                 np.linspace(0, 1.0, 11))
-    binned_average_rmse = sum(rmses)/len(rmses)
-    return binned_average_rmse
+from typing import Iterable, List, Tuple, Union
+import numpy as np
+import pandas as pd
+from ms2deepscore import MS2DeepScore
+from ms2deepscore.models import load_model
+from ms2deepscore.vector_operations import cosine_similarity_matrix
+from matchms import Spectrum
+from inchikey_index import InchikeyIndex, spectra_inchikeys14
+from tanimoto_store import TanimotoMatrix, gather_scores
+
+
+def tanimoto_dependent_losses(scores, scores_ref, ref_score_bins, block_size: int = 1024):
+    """Compute errors (RMSE) for different bins of the reference scores (scores_ref).
+
+    Both score matrices are expected to be symmetric, so only the pairs above the diagonal are
+    evaluated. They are processed in blocks of block_size rows, the full n x n masks are never built.
+
+    Parameters
+    ----------
+
+    scores
+        Scores that should be evaluated
+    scores_ref
+        Reference scores (= ground truth).
+    ref_score_bins
+        Bins for the refernce score to evaluate the performance of scores.
+    block_size
+        Number of rows processed at once.
+    """
+    tiles = iter_upper_triangle_tiles(scores, scores_ref, block_size)
+    return tanimoto_dependent_losses_from_tiles(tiles, ref_score_bins)
+
+
+def tanimoto_dependent_losses_from_tiles(tiles: Iterable[Tuple[int, int, np.ndarray, np.ndarray]],
+                                         ref_score_bins) -> List[float]:
+    """Compute the RMSE per bin of the reference scores from tiles of the score matrices.
+
+    Only the tiles (or their parts) above the diagonal of the full matrix are needed. This allows computing
+    the binned RMSE for test sets of which the full score matrices do not fit in memory.
+
+    Parameters
+    ----------
+
+    tiles
+        Iterable of (row_offset, col_offset, scores_tile, scores_ref_tile), with the offsets the
+        position of the tile in the full matrix. Pairs on or below the diagonal are ignored.
+    ref_score_bins
+        Bins for the reference score to evaluate the performance of scores.
+    """
+    n_bins = len(ref_score_bins) - 1
+    squared_error_sums = np.zeros(n_bins)
+    counts = np.zeros(n_bins, dtype=np.int64)
+    for row_offset, col_offset, scores_tile, scores_ref_tile in tiles:
+        tile_sums, tile_counts = binned_squared_errors(scores_tile, scores_ref_tile, ref_score_bins,
+                                                       row_offset, col_offset)
+        squared_error_sums += tile_sums
+        counts += tile_counts
+    return rmses_from_binned_squared_errors(squared_error_sums, counts)
+
+
+def binned_squared_errors(scores, scores_ref, ref_score_bins,
+                          row_offset: int = 0, col_offset: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Sum of squared errors and number of pairs per reference score bin for one tile.
+
+    The first and last bin edges are treated as -inf and inf. Pairs on or below the diagonal
+    of the full matrix and pairs without reference score are ignored.
+    """
+    scores_ref = np.asarray(scores_ref)
+    scores = np.asarray(scores)
+    n_rows, n_cols = scores_ref.shape
+    if col_offset >= row_offset + n_rows:
+        # Tile is fully above the diagonal
+        ref = scores_ref.ravel()
+        predicted = scores.ravel()
+    else:
+        rows = np.arange(row_offset, row_offset + n_rows)[:, np.newaxis]
+        cols = np.arange(col_offset, col_offset + n_cols)[np.newaxis, :]
+        upper = cols > rows
+        ref = scores_ref[upper]
+        predicted = scores[upper]
+    has_ref = ~np.isnan(ref)
+    ref = ref[has_ref]
+    predicted = predicted[has_ref]
+
+    n_bins = len(ref_score_bins) - 1
+    bin_idx = np.digitize(ref, np.asarray(ref_score_bins)[1:-1])
+    squared_error_sums = np.bincount(bin_idx, weights=np.square(ref - predicted), minlength=n_bins)
+    counts = np.bincount(bin_idx, minlength=n_bins)
+    return squared_error_sums, counts
+
+
+def rmses_from_binned_squared_errors(squared_error_sums, counts) -> List[float]:
+    """RMSE per bin, NaN for bins without pairs"""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return list(np.sqrt(np.asarray(squared_error_sums) / np.asarray(counts)))
+
+
+def iter_upper_triangle_tiles(scores, scores_ref, block_size: int = 1024):
+    """Yield blocks of rows of the part of two square matrices on and above the diagonal.
+
+    Yields (row_offset, col_offset, scores_tile, scores_ref_tile), the input of
+    tanimoto_dependent_losses_from_tiles. The tiles are views, nothing is copied.
+    """
+    n_spectra = scores_ref.shape[0]
+    for start in range(0, n_spectra, block_size):
+        end = min(start + block_size, n_spectra)
+        yield start, start, scores[start:end, start:], scores_ref[start:end, start:]
+
+
+def do_ms2ds_predictions(test_spectra, ms2ds_model):
+    model = load_model(ms2ds_model)
+    similarity_measure = MS2DeepScore(model)
+    # Calculate scores and get matchms.Scores object
+    scores = similarity_measure.matrix(test_spectra, test_spectra, is_symmetric=True)
+    return scores
+
+
+def compute_ms2ds_embeddings(spectra, ms2ds_model) -> np.ndarray:
+    """Compute the MS2DeepScore embeddings of spectra.
+
+    Scores for any selection of the spectra can then be computed with
+    predictions_from_embeddings, without calling the model again.
+
+    spectra:
+        list of spectra to embed
+    ms2ds_model:
+        loaded SiameseModel or path to a saved model, or any object with a calculate_vectors
+        method such as MS2DeepScore or the NumpyEmbedder of fast_inference.py
+    """
+    if not hasattr(ms2ds_model, "calculate_vectors"):
+        if not hasattr(ms2ds_model, "spectrum_binner"):
+            ms2ds_model = load_model(ms2ds_model)
+        ms2ds_model = MS2DeepScore(ms2ds_model)
+    return ms2ds_model.calculate_vectors(spectra)
+
+
+def predictions_from_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """Symmetric MS2DeepScore score matrix from (a slice of) precomputed embeddings
+
+    Gives the same scores as do_ms2ds_predictions on the corresponding spectra.
+    """
+    return cosine_similarity_matrix(embeddings, embeddings)
+
+
+def select_predictions_for_test_spectra(tanimoto_df: Union[pd.DataFrame, TanimotoMatrix],
+                                        test_spectra: List[Spectrum],
+                                        inchikey_index: InchikeyIndex = None) -> np.ndarray:
+    """Select the predictions for test_spectra from df with correct predictions
+
+    tanimoto_df:
+        Dataframe with as index and columns Inchikeys of 14 letters, or a memory-mapped TanimotoMatrix
+    test_spectra:
+        list of test spectra
+    inchikey_index:
+        Optional InchikeyIndex of tanimoto_df, to reuse it over multiple calls.
+    """
+    if inchikey_index is None:
+        inchikey_index = InchikeyIndex.from_tanimoto_df(tanimoto_df)
+    inchikey_idx_test = inchikey_index.positions(spectra_inchikeys14(test_spectra))
+    scores_ref = gather_scores(tanimoto_df, inchikey_idx_test)
+    return scores_ref
+
+
+def calculate_binned_average_rmse(testing_spectra, tanimoto_score_df, ms2ds_model_file, inchikey_index=None,
+                                  embedding_cache=None):
+    """Average over the Tanimoto score bins of the RMSE of the MS2DeepScore predictions for testing_spectra
+
+    embedding_cache:
+        Optional EmbeddingCache of the model (see embedding_cache.py). The embeddings are read from it,
+        and only the spectra that are not cached are embedded, instead of predicting all scores.
+    """
+    if embedding_cache is not None:
+        return calculate_binned_average_rmse_from_embeddings(
+            testing_spectra, tanimoto_score_df, embedding_cache.get_embeddings(testing_spectra), inchikey_index)
+    # plot_parent_mass_distribution(testing_spectra)
+    correct_scores = select_predictions_for_test_spectra(tanimoto_score_df, testing_spectra, inchikey_index)
+
+    predicted_scores = do_ms2ds_predictions(testing_spectra, ms2ds_model_file)
+    rmses = tanimoto_dependent_losses(predicted_scores, correct_scores,
+                                                                 np.linspace(0, 1.0, 11))
+    binned_average_rmse = sum(rmses)/len(rmses)
+    return binned_average_rmse
+
+
+def calculate_binned_average_rmse_from_embeddings(testing_spectra, tanimoto_score_df, embeddings,
+                                                  inchikey_index=None):
+    """Same as calculate_binned_average_rmse, but using embeddings precomputed with compute_ms2ds_embeddings
+
+    embeddings:
+        Embeddings of testing_spectra, in the same order.
+    inchikey_index:
+        Optional InchikeyIndex of tanimoto_score_df, to reuse it over multiple calls.
+    """
+    assert len(testing_spectra) == embeddings.shape[0], "Expected one embedding per spectrum"
+    correct_scores = select_predictions_for_test_spectra(tanimoto_score_df, testing_spectra, inchikey_index)
+    predicted_scores = predictions_from_embeddings(embeddings)
+    rmses = tanimoto_dependent_losses(predicted_scores, correct_scores,
+                                      np.linspace(0, 1.0, 11))
+    binned_average_rmse = sum(rmses)/len(rmses)
+    return binned_average_rmse
+
+
+# Upper bound of the pairs read by resample_binned_rmses over all replicates, at roughly 20 ns per pair
+# this is about a minute (e.g. 1000 replicates of 2400 spectra, or 60 replicates of 10000 spectra)
+MAX_RESAMPLED_PAIRS = 3 * 10 ** 9
+
+
+def pairwise_bins_and_squared_errors(scores, scores_ref, ref_score_bins,
+                                     block_size: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+    """Reference score bin and squared error of every pair, the sufficient statistics for resampling
+
+    Returns a uint8 matrix with the bin of each pair (len(ref_score_bins) - 1 for pairs without
+    reference score) and a float32 matrix with the squared error of each pair.
+    """
+    n_bins = len(ref_score_bins) - 1
+    n_spectra = scores_ref.shape[0]
+    bin_idx = np.empty((n_spectra, n_spectra), dtype=np.uint8)
+    squared_errors = np.empty((n_spectra, n_spectra), dtype=np.float32)
+    for start in range(0, n_spectra, block_size):
+        end = min(start + block_size, n_spectra)
+        ref = np.asarray(scores_ref[start:end])
+        bin_idx[start:end] = np.where(np.isnan(ref), n_bins, np.digitize(ref, np.asarray(ref_score_bins)[1:-1]))
+        squared_errors[start:end] = np.square(ref - np.asarray(scores[start:end]))
+    return bin_idx, squared_errors
+
+
+def resample_binned_rmses(bin_idx: np.ndarray, squared_errors: np.ndarray, n_bins: int,
+                          subset_size: int, n_replicates: int = 1000, replace: bool = False,
+                          seed: int = 42, block_size: int = 256,
+                          max_pairs: int = MAX_RESAMPLED_PAIRS) -> np.ndarray:
+    """RMSE per bin for random subsets of the spectra, without recomputing any scores
+
+    Each replicate draws subset_size spectra, without replacement (subsampling) or with replacement
+    (bootstrap), and gathers the statistics of their pairs from bin_idx and squared_errors
+    (see pairwise_bins_and_squared_errors). Pairs of a spectrum with itself are ignored.
+
+    The per-bin sums are accumulated from blocks of block_size rows of the subset, so only
+    block_size * subset_size pairs are in memory. Every replicate still reads all
+    subset_size * (subset_size - 1) / 2 pairs, a ValueError is raised if all replicates together
+    would read more than max_pairs.
+
+    Returns an array of shape (n_replicates, n_bins).
+    """
+    n_pairs = n_replicates * subset_size * (subset_size - 1) // 2
+    if n_pairs > max_pairs:
+        raise ValueError(f"{n_replicates} replicates of {subset_size} spectra read {n_pairs:.2e} pairs, "
+                         f"more than max_pairs ({max_pairs:.2e}), use fewer replicates or smaller subsets")
+    rng = np.random.default_rng(seed)
+    n_spectra = bin_idx.shape[0]
+    flat_bins, flat_squared_errors = bin_idx.reshape(-1), squared_errors.reshape(-1)
+    rmses = np.empty((n_replicates, n_bins))
+    for replicate in range(n_replicates):
+        # Sorted, so the rows and columns of a block are read in order
+        subset = np.sort(rng.choice(n_spectra, size=subset_size, replace=replace))
+        counts = np.zeros(n_bins + 1)
+        squared_error_sums = np.zeros(n_bins + 1)
+        for start in range(0, subset_size - 1, block_size):
+            rows = subset[start:start + block_size]
+            columns = subset[start:]
+            # Pair (row a, column b) of the subset is counted once, for a < b
+            pairs = np.triu(np.ones((len(rows), len(columns)), dtype=bool), k=1)
+            if replace:
+                pairs &= rows[:, np.newaxis] != columns[np.newaxis, :]
+            flat_positions = (rows[:, np.newaxis] * n_spectra + columns)[pairs]
+            block_bins = flat_bins.take(flat_positions)
+            counts += np.bincount(block_bins, minlength=n_bins + 1)
+            squared_error_sums += np.bincount(block_bins, weights=flat_squared_errors.take(flat_positions),
+                                              minlength=n_bins + 1)
+        rmses[replicate] = rmses_from_binned_squared_errors(squared_error_sums[:n_bins], counts[:n_bins])
+    return rmses
+
+
+def resample_binned_average_rmse(testing_spectra, tanimoto_score_df, ms2ds_model_file,
+                                 subset_sizes: Iterable[int], n_replicates: int = 1000,
+                                 replace: bool = False, confidence: float = 0.95, seed: int = 42,
+                                 embeddings: np.ndarray = None) -> dict:
+    """Distribution of the (binned average) RMSE for random subsets of testing_spectra
+
+    The predicted and true scores of all testing_spectra are computed once, the replicates only
+    gather from these. This replaces re-predicting disjoint subsets (create_random_subsets) for test
+    sets of up to tens of thousands of spectra: the bin and squared error of all pairs are kept in
+    memory (5 bytes per pair, 12.5 GB for 50000 spectra), and the replicates of each subset size can
+    read at most MAX_RESAMPLED_PAIRS pairs (see resample_binned_rmses).
+
+    Parameters
+    ----------
+
+    subset_sizes
+        Number of spectra in a subset, a distribution is computed for each size.
+    n_replicates
+        Number of random subsets per size.
+    replace
+        Draw bootstrap samples (with replacement) instead of subsamples.
+    confidence
+        Width of the (percentile) confidence intervals.
+    embeddings
+        Optional precomputed embeddings of testing_spectra (see compute_ms2ds_embeddings).
+
+    Returns a dictionary with for each subset size a dictionary with "rmses" (per replicate and bin),
+    "binned_average_rmse" (per replicate), and the confidence intervals "rmses_ci" (per bin) and
+    "binned_average_rmse_ci".
+    """
+    ref_score_bins = np.linspace(0, 1.0, 11)
+    n_bins = len(ref_score_bins) - 1
+    if embeddings is None:
+        embeddings = compute_ms2ds_embeddings(testing_spectra, ms2ds_model_file)
+    correct_scores = select_predictions_for_test_spectra(tanimoto_score_df, testing_spectra)
+    predicted_scores = predictions_from_embeddings(embeddings)
+    bin_idx, squared_errors = pairwise_bins_and_squared_errors(predicted_scores, correct_scores, ref_score_bins)
+    del correct_scores, predicted_scores
+
+    percentiles = [100 * (1 - confidence) / 2, 100 * (1 + confidence) / 2]
+    results = {}
+    for subset_size in subset_sizes:
+        rmses = resample_binned_rmses(bin_idx, squared_errors, n_bins, subset_size, n_replicates, replace, seed)
+        binned_average_rmse = rmses.mean(axis=1)
+        results[subset_size] = {"rmses": rmses,
+                                "binned_average_rmse": binned_average_rmse,
+                                "rmses_ci": np.nanpercentile(rmses, percentiles, axis=0),
+                                "binned_average_rmse_ci": np.nanpercentile(binned_average_rmse, percentiles)}
+    return results
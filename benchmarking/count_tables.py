@@ -0,0 +1,131 @@
+"""Count tables of a spectrum library for the count-based figures (clamshell plots and treemaps).
+
+Reads the metadata of a spectrum store once, joins the ClassyFire classes on InChIKey14 and writes the
+count tables as .tbd files (tab-separated "class count", as read by clamshell_plot.parse_input):
+    python count_tables.py ALL_GNPS_15_12_2021_positive_annotated ALL_GNPS_210409_positive_processed_annotated_CF_NPC_classes.txt ../figures_data
+
+The tables are cached under the hash of the inputs, so refreshing the figures for the same inputs
+does not read the metadata again.
+"""
+import hashlib
+import os
+import sys
+from typing import Dict, Sequence
+import numpy as np
+import pandas as pd
+from hashing import file_hash
+from spectrum_store import INCHIKEY14_COLUMN, METADATA_FILE, load_metadata
+
+
+# Instrument types in the GNPS metadata are free text, they are grouped with the first matching pattern
+INSTRUMENT_CATEGORIES = (
+    ("Orbitrap", r"orbitrap|exactive"),
+    ("TOF", r"tof"),
+    ("Fourier transform", r"ft|fourier"),
+    ("Ion trap", r"ion ?trap|\bit\b|lcq|ltq|qit"),
+    ("Quadruple", r"quadrupole|qqq|\bqq\b|qtrap|triple quad"),
+    ("EBEB", r"ebeb"),
+    ("CID", r"cid"),
+)
+UNKNOWN = "Unknown"
+DECILE_SPLITS = (0, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+COUNT_TABLE_FILES = {"classes": "gnps_classes.tbd", "superclasses": "gnps_superclasses.tbd",
+                     "instruments": "gnps_instruments.tbd"}
+
+
+def instrument_categories(instrument_types: pd.Series) -> pd.Series:
+    """Group the free text instrument types into the categories of INSTRUMENT_CATEGORIES"""
+    instrument_types = instrument_types.fillna("").astype(str).str.lower()
+    # Each unique instrument type is only matched once
+    unique_types = pd.Series(instrument_types.unique())
+    categories = pd.Series(UNKNOWN, index=unique_types.index, dtype=object)
+    unmatched = pd.Series(True, index=unique_types.index)
+    for category, pattern in INSTRUMENT_CATEGORIES:
+        matches = unmatched & unique_types.str.contains(pattern, regex=True)
+        categories[matches] = category
+        unmatched &= ~matches
+    return instrument_types.map(dict(zip(unique_types, categories)))
+
+
+def count_table(labels: pd.Series) -> pd.DataFrame:
+    """Table with columns class and count, sorted from high to low count"""
+    counts = labels.value_counts(sort=False).rename_axis("class").reset_index(name="count")
+    return counts.sort_values(["count", "class"], ascending=[False, True], kind="stable").reset_index(drop=True)
+
+
+def aggregate_counts(metadata: pd.DataFrame, classifiers: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """All count tables of a spectrum library
+
+    The ClassyFire classes and superclasses are counted per unique InChIKey14 (an InChIKey14 with several
+    classes counts for each of them), InChIKeys without a class are counted as Unknown.
+    The instruments are counted per spectrum.
+
+    metadata:
+        Metadata of a spectrum store, with columns inchikey14 and instrument_type.
+    classifiers:
+        ClassyFire classes, with columns inchikey14, cf_class and cf_superclass.
+    """
+    inchikeys14 = pd.DataFrame({"inchikey14": metadata[INCHIKEY14_COLUMN].dropna().unique()})
+    classes = inchikeys14.merge(classifiers, on="inchikey14", how="left")
+    tables = {}
+    for name, column in (("classes", "cf_class"), ("superclasses", "cf_superclass")):
+        per_inchikey = classes[["inchikey14", column]].fillna({column: UNKNOWN}).drop_duplicates()
+        tables[name] = count_table(per_inchikey[column])
+    tables["instruments"] = count_table(instrument_categories(metadata["instrument_type"]))
+    return tables
+
+
+def load_classifiers(classifiers_file: str) -> pd.DataFrame:
+    """Load the ClassyFire class and superclass of each InChIKey14 from the classifiers file"""
+    classifiers = pd.read_csv(classifiers_file, sep="\t", usecols=["inchi_key", "cf_class", "cf_superclass"])
+    classifiers["inchikey14"] = classifiers["inchi_key"].str[:14]
+    return classifiers[["inchikey14", "cf_class", "cf_superclass"]].drop_duplicates()
+
+
+def decile_summary(counts: pd.Series, splits: Sequence[float] = DECILE_SPLITS) -> pd.DataFrame:
+    """Median, mean, sum and number of the counts within each quantile range of splits, in one groupby
+
+    The quantile range of each count (e.g. the dezil column of the treemap notebook) is assigned with
+    a single pd.qcut, the rows of the summary are the ranges in order.
+    """
+    labels = pd.qcut(counts, q=list(splits), labels=np.arange(len(splits) - 1))
+    summary = counts.groupby(labels, observed=False).agg(["median", "mean", "sum", "count"])
+    summary.index.name = "dezil"
+    return summary
+
+
+def write_count_table(table: pd.DataFrame, filename: str):
+    table.to_csv(filename, sep="\t", index=False)
+
+
+def read_count_table(filename: str) -> pd.DataFrame:
+    return pd.read_csv(filename, sep="\t")
+
+
+def _inputs_hash(*filenames: str) -> str:
+    description = " ".join([repr(INSTRUMENT_CATEGORIES), *(file_hash(filename) for filename in filenames)])
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def cached_count_tables(library_store: str, classifiers_file: str, cache_directory: str) -> Dict[str, pd.DataFrame]:
+    """aggregate_counts of a spectrum store, cached in cache_directory under the hash of the inputs"""
+    directory = os.path.join(cache_directory,
+                             _inputs_hash(os.path.join(library_store, METADATA_FILE), classifiers_file))
+    if all(os.path.exists(os.path.join(directory, filename)) for filename in COUNT_TABLE_FILES.values()):
+        return {name: read_count_table(os.path.join(directory, filename))
+                for name, filename in COUNT_TABLE_FILES.items()}
+    metadata = load_metadata(library_store, columns=[INCHIKEY14_COLUMN, "instrument_type"])
+    tables = aggregate_counts(metadata, load_classifiers(classifiers_file))
+    os.makedirs(directory, exist_ok=True)
+    for name, filename in COUNT_TABLE_FILES.items():
+        write_count_table(tables[name], os.path.join(directory, filename))
+    return tables
+
+
+if __name__ == "__main__":
+    library_store, classifiers_file, output_folder = sys.argv[1], sys.argv[2], sys.argv[3]
+    count_tables = cached_count_tables(library_store, classifiers_file,
+                                       os.path.join(output_folder, "count_tables_cache"))
+    for table_name, table_file in COUNT_TABLE_FILES.items():
+        write_count_table(count_tables[table_name], os.path.join(output_folder, table_file))
+        print(f"Stored {len(count_tables[table_name])} {table_name} in", os.path.join(output_folder, table_file))
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+from typing import List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from matchms import Spectrum
+from ms2deepscore.models import load_model
+from calculate_binned_average_rmse import compute_ms2ds_embeddings
+from hashing import file_hash
+
+
+EMBEDDINGS_FILE = "embeddings.f32"
+HASHES_FILE = "spectrum_hashes.txt"
+SETTINGS_FILE = "settings.json"
+
+
+def spectrum_hash(spectrum: Spectrum) -> str:
+    """Hash of the peaks of a spectrum, the only input of the MS2DeepScore embedding"""
+    sha1 = hashlib.sha1(np.ascontiguousarray(spectrum.peaks.mz, dtype=np.float64).tobytes())
+    sha1.update(np.ascontiguousarray(spectrum.peaks.intensities, dtype=np.float64).tobytes())
+    return sha1.hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent cache of the MS2DeepScore embeddings of spectra for one model
+
+    The embeddings are stored in cache_directory/<hash of the model file>/ as a memory-mapped float32
+    array, with a text file with the hash of the spectrum of each row. Spectra that are not in the cache
+    are embedded in batches of batch_size, which are appended to the cache directly. Embeddings computed
+    elsewhere can be added with lookup and add.
+    Only one process at a time should add embeddings to a cache.
+
+    cache_directory:
+        Folder in which the caches of all models are stored.
+    ms2ds_model_file:
+        File of the MS2DeepScore model, it is only loaded if spectra have to be embedded.
+    """
+    def __init__(self, cache_directory: str, ms2ds_model_file: str, batch_size: int = 1000):
+        self.ms2ds_model_file = ms2ds_model_file
+        self.batch_size = batch_size
+        self.directory = os.path.join(cache_directory, file_hash(ms2ds_model_file))
+        os.makedirs(self.directory, exist_ok=True)
+        self._ms2ds_model = None
+        self.embedding_dim = None
+        settings_file = os.path.join(self.directory, SETTINGS_FILE)
+        if os.path.exists(settings_file):
+            with open(settings_file, "r") as file:
+                self.embedding_dim = json.load(file)["embedding_dim"]
+        self.spectrum_hashes = pd.Index(self._read_hashes())
+
+    def _read_hashes(self) -> List[str]:
+        hashes_file = os.path.join(self.directory, HASHES_FILE)
+        if not os.path.exists(hashes_file):
+            return []
+        with open(hashes_file, "r") as file:
+            return [line.rstrip("\n") for line in file]
+
+    def __len__(self) -> int:
+        return len(self.spectrum_hashes)
+
+    def embeddings(self) -> np.ndarray:
+        """Memory-mapped array with all cached embeddings"""
+        if len(self) == 0:
+            return np.empty((0, self.embedding_dim or 0), dtype=np.float32)
+        return np.memmap(os.path.join(self.directory, EMBEDDINGS_FILE), dtype=np.float32, mode="r",
+                         shape=(len(self), self.embedding_dim))
+
+    def get_embeddings(self, spectra: List[Spectrum]) -> np.ndarray:
+        """Return the embeddings of spectra (in the same order), embedding the spectra that are not cached"""
+        hashes = [spectrum_hash(spectrum) for spectrum in spectra]
+        positions = self.spectrum_hashes.get_indexer(hashes)
+        missing = np.where(positions == -1)[0]
+        if len(missing) > 0:
+            # Spectra with identical peaks are only embedded once
+            missing_hashes, first_occurrence = np.unique(np.array(hashes, dtype=object)[missing], return_index=True)
+            self._add([spectra[i] for i in missing[first_occurrence]], list(missing_hashes))
+            positions = self.spectrum_hashes.get_indexer(hashes)
+        return np.array(self.embeddings()[positions])
+
+    def lookup(self, spectra: List[Spectrum]) -> Tuple[Optional[np.ndarray], np.ndarray]:
+        """Return the cached embeddings of spectra and the indices of the spectra that are not cached
+
+        The rows of the spectra that are not cached are NaN. The embeddings are None if none of the
+        spectra is cached. Nothing is embedded, see add to add embeddings computed elsewhere.
+        """
+        positions = self.spectrum_hashes.get_indexer([spectrum_hash(spectrum) for spectrum in spectra])
+        missing = np.where(positions == -1)[0]
+        if len(missing) == len(spectra):
+            return None, missing
+        embeddings = np.full((len(spectra), self.embedding_dim), np.nan, dtype=np.float32)
+        found = positions >= 0
+        embeddings[found] = self.embeddings()[positions[found]]
+        return embeddings, missing
+
+    def add(self, spectra: List[Spectrum], embeddings: np.ndarray):
+        """Add embeddings of spectra that were computed elsewhere (e.g. in worker processes)
+
+        Spectra that are already cached, or occur more than once, are only stored once.
+        """
+        hashes, first_occurrence = np.unique(np.array([spectrum_hash(spectrum) for spectrum in spectra], dtype=object),
+                                             return_index=True)
+        is_new = self.spectrum_hashes.get_indexer(hashes) == -1
+        if is_new.any():
+            self._append(np.asarray(embeddings, dtype=np.float32)[first_occurrence[is_new]], list(hashes[is_new]))
+
+    def _add(self, spectra: List[Spectrum], hashes: List[str]):
+        if self._ms2ds_model is None:
+            self._ms2ds_model = load_model(self.ms2ds_model_file)
+        for start in range(0, len(spectra), self.batch_size):
+            batch_embeddings = compute_ms2ds_embeddings(spectra[start:start + self.batch_size], self._ms2ds_model)
+            self._append(batch_embeddings.astype(np.float32), hashes[start:start + self.batch_size])
+
+    def _append(self, embeddings: np.ndarray, hashes: List[str]):
+        if self.embedding_dim is None:
+            self.embedding_dim = embeddings.shape[1]
+            with open(os.path.join(self.directory, SETTINGS_FILE), "w") as file:
+                json.dump({"embedding_dim": self.embedding_dim, "model_file": self.ms2ds_model_file}, file)
+        # Embeddings are written before their hashes, so an interrupted batch is never used
+        with open(os.path.join(self.directory, EMBEDDINGS_FILE), "r+b" if len(self) else "wb") as file:
+            file.seek(len(self) * self.embedding_dim * 4)
+            file.write(np.ascontiguousarray(embeddings).tobytes())
+            file.truncate()
+        with open(os.path.join(self.directory, HASHES_FILE), "a") as file:
+            file.writelines(f"{spectrum_hash_}\n" for spectrum_hash_ in hashes)
+        self.spectrum_hashes = self.spectrum_hashes.append(pd.Index(hashes))
@@ -0,0 +1,230 @@
+"""Fast CPU inference of MS2DeepScore embeddings with a NumPy forward pass.
+
+The dense layers of the base network of a trained SiameseModel are exported once (batch normalization
+folded into the next dense layer, dropout removed) and the embeddings are computed with NumPy. The
+binned spectra are batched sparsely: the first layer only gathers the weight rows of the bins with a
+peak, instead of multiplying a mostly empty input vector of all bins. The weights can be stored as
+float16 or int8 (per output unit scales) to reduce memory and bandwidth.
+
+Compare with the keras model before using it for an evaluation, e.g.:
+    python fast_inference.py ms2deepscore_model.hdf5 fast_model int8 test_spectra_store GNPS_15_12_2021_pos_tanimoto_scores
+"""
+import json
+import os
+import sys
+import time
+from typing import List, Tuple
+import numpy as np
+from ms2deepscore import BinnedSpectrum
+from ms2deepscore.models import load_model
+from binned_spectra_store import SPECTRUM_BINNER_FILE, load_spectrum_binner, save_spectrum_binner
+from calculate_binned_average_rmse import compute_ms2ds_embeddings
+from inchikey_index import InchikeyIndex, spectra_inchikeys14
+from tiled_similarity import tiled_tanimoto_dependent_losses
+
+
+PRECISIONS = ("float32", "float16", "int8")
+LAYERS_FILE = "dense_layers.npz"
+ACTIVATIONS = {
+    "relu": lambda x: np.maximum(x, 0, out=x),
+    "linear": lambda x: x,
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    "tanh": np.tanh,
+}
+
+
+def export_dense_layers(siamese_model) -> List[dict]:
+    """Weights, biases and activations of the dense layers of the base network of a SiameseModel
+
+    Batch normalization (in inference mode) is an affine transformation, which is folded into the
+    weights and bias of the next dense layer. Dropout is only used in training and is left out.
+    """
+    layers = []
+    affine = None  # (scale, shift) of batch normalizations since the last dense layer
+    for layer in siamese_model.base.layers:
+        layer_type = layer.__class__.__name__
+        if layer_type in ("InputLayer", "Dropout"):
+            continue
+        if layer_type == "BatchNormalization":
+            gamma = layer.gamma.numpy() if layer.scale else 1.0
+            beta = layer.beta.numpy() if layer.center else 0.0
+            scale = gamma / np.sqrt(layer.moving_variance.numpy() + layer.epsilon)
+            shift = beta - layer.moving_mean.numpy() * scale
+            affine = (scale, shift) if affine is None else (affine[0] * scale, affine[1] * scale + shift)
+        elif layer_type == "Dense":
+            weights, bias = layer.kernel.numpy().astype(np.float64), layer.bias.numpy().astype(np.float64)
+            if affine is not None:
+                bias = bias + affine[1] @ weights
+                weights = affine[0][:, np.newaxis] * weights
+                affine = None
+            layers.append({"weights": weights, "bias": bias, "activation": layer.activation.__name__})
+        else:
+            raise ValueError(f"Layers of type {layer_type} are not supported by the NumPy forward pass")
+    if affine is not None:
+        # A batch normalization after the last dense layer is kept as a linear diagonal layer
+        layers.append({"weights": np.diag(affine[0]), "bias": affine[1], "activation": "linear"})
+    return layers
+
+
+def quantize_weights(weights: np.ndarray, precision: str):
+    """Weights in the given precision, with the scale per output unit for int8 (otherwise None)"""
+    assert precision in PRECISIONS, f"Expected precision to be one of {PRECISIONS}"
+    if precision != "int8":
+        return weights.astype(precision), None
+    scales = np.abs(weights).max(axis=0) / 127
+    scales[scales == 0] = 1
+    return np.rint(weights / scales).astype(np.int8), scales.astype(np.float32)
+
+
+class NumpyEmbedder:
+    """MS2DeepScore embeddings computed with the exported dense layers of a SiameseModel
+
+    Has the calculate_vectors method of MS2DeepScore, so it can be passed to compute_ms2ds_embeddings.
+    Only the weights of the first layer, which has a row per bin, are kept in the reduced precision;
+    the other layers are small and are multiplied in float32.
+    """
+    def __init__(self, layers: List[dict], spectrum_binner, precision: str = "float32"):
+        self.spectrum_binner = spectrum_binner
+        self.precision = precision
+        first_layer = layers[0]
+        self.input_weights, self.input_scales = quantize_weights(first_layer["weights"], precision)
+        self.input_bias = first_layer["bias"].astype(np.float32)
+        self.input_activation = first_layer["activation"]
+        self.layers = [(layer["weights"].astype(np.float32), layer["bias"].astype(np.float32), layer["activation"])
+                       for layer in layers[1:]]
+        self._check_activations()
+
+    def _check_activations(self):
+        for activation in [self.input_activation] + [activation for _, _, activation in self.layers]:
+            assert activation in ACTIVATIONS, f"Activation {activation} is not supported"
+
+    @classmethod
+    def from_model(cls, siamese_model, precision: str = "float32") -> "NumpyEmbedder":
+        return cls(export_dense_layers(siamese_model), siamese_model.spectrum_binner, precision)
+
+    def save(self, directory: str):
+        """Store the (quantized) layers and the spectrum binner, they can be loaded without tensorflow"""
+        os.makedirs(directory, exist_ok=True)
+        arrays = {"input_weights": self.input_weights, "input_bias": self.input_bias}
+        if self.input_scales is not None:
+            arrays["input_scales"] = self.input_scales
+        for i, (weights, bias, _) in enumerate(self.layers):
+            arrays[f"weights_{i}"] = weights
+            arrays[f"bias_{i}"] = bias
+        np.savez(os.path.join(directory, LAYERS_FILE), **arrays)
+        with open(os.path.join(directory, "settings.json"), "w") as file:
+            json.dump({"precision": self.precision,
+                       "activations": [self.input_activation] + [activation for _, _, activation in self.layers]},
+                      file)
+        save_spectrum_binner(self.spectrum_binner, os.path.join(directory, SPECTRUM_BINNER_FILE))
+
+    @classmethod
+    def load(cls, directory: str) -> "NumpyEmbedder":
+        with open(os.path.join(directory, "settings.json"), "r") as file:
+            settings = json.load(file)
+        embedder = cls.__new__(cls)
+        embedder.precision = settings["precision"]
+        embedder.spectrum_binner = load_spectrum_binner(os.path.join(directory, SPECTRUM_BINNER_FILE),
+                                                        allowed_missing_percentage=100.0)
+        with np.load(os.path.join(directory, LAYERS_FILE)) as arrays:
+            embedder.input_weights = arrays["input_weights"]
+            embedder.input_bias = arrays["input_bias"]
+            embedder.input_scales = arrays["input_scales"] if "input_scales" in arrays else None
+            activations = settings["activations"]
+            embedder.input_activation = activations[0]
+            embedder.layers = [(arrays[f"weights_{i}"], arrays[f"bias_{i}"], activation)
+                               for i, activation in enumerate(activations[1:])]
+        embedder._check_activations()
+        return embedder
+
+    def embed_binned(self, binned_spectrums: List[BinnedSpectrum], batch_size: int = 1000) -> np.ndarray:
+        """Embeddings of binned spectra, computed in sparse batches"""
+        embeddings = []
+        for start in range(0, len(binned_spectrums), batch_size):
+            batch = binned_spectrums[start:start + batch_size]
+            n_peaks = np.array([len(spectrum.binned_peaks) for spectrum in batch])
+            bins = np.fromiter((b for spectrum in batch for b in spectrum.binned_peaks.keys()),
+                               dtype=np.int64, count=n_peaks.sum())
+            intensities = np.fromiter((v for spectrum in batch for v in spectrum.binned_peaks.values()),
+                                      dtype=np.float32, count=n_peaks.sum())
+            embeddings.append(self._forward_sparse(bins, intensities, n_peaks))
+        if not embeddings:
+            return np.empty((0, self.layers[-1][0].shape[1] if self.layers else len(self.input_bias)))
+        return np.vstack(embeddings)
+
+    def _forward_sparse(self, bins: np.ndarray, intensities: np.ndarray, n_peaks: np.ndarray) -> np.ndarray:
+        # First layer: the sum of the weight rows of the bins with a peak, scaled by their intensity
+        rows = self.input_weights[bins].astype(np.float32) * intensities[:, np.newaxis]
+        hidden = np.zeros((len(n_peaks), rows.shape[1]), dtype=np.float32)
+        with_peaks = n_peaks > 0
+        offsets = np.concatenate([[0], np.cumsum(n_peaks)[:-1]])
+        if with_peaks.any():
+            hidden[with_peaks] = np.add.reduceat(rows, offsets[with_peaks], axis=0)
+        if self.input_scales is not None:
+            hidden *= self.input_scales
+        hidden = ACTIVATIONS[self.input_activation](hidden + self.input_bias)
+        for weights, bias, activation in self.layers:
+            hidden = ACTIVATIONS[activation](hidden @ weights + bias)
+        return hidden
+
+    def calculate_vectors(self, spectra) -> np.ndarray:
+        """Embeddings of spectra, like MS2DeepScore.calculate_vectors"""
+        return self.embed_binned(self.spectrum_binner.transform(spectra))
+
+
+def compare_inference(spectra, tanimoto_scores, ms2ds_model, precision: str = "int8",
+                      max_rmse_delta: float = 0.005,
+                      ref_score_bins=np.linspace(0, 1.0, 11)) -> Tuple[dict, NumpyEmbedder]:
+    """Speedup and change of the RMSE per Tanimoto bin of the NumPy forward pass against the keras model
+
+    Returns the report and the evaluated NumpyEmbedder. The NumPy forward pass should only be used if
+    accepted is True: the RMSE of none of the bins changes by more than max_rmse_delta.
+
+    ms2ds_model:
+        Loaded SiameseModel or path to a saved model.
+    """
+    siamese_model = ms2ds_model if hasattr(ms2ds_model, "spectrum_binner") else load_model(ms2ds_model)
+    embedder = NumpyEmbedder.from_model(siamese_model, precision)
+    start = time.perf_counter()
+    reference_embeddings = compute_ms2ds_embeddings(spectra, siamese_model)
+    reference_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    fast_embeddings = embedder.calculate_vectors(spectra)
+    fast_seconds = time.perf_counter() - start
+
+    inchikey_index = getattr(tanimoto_scores, "inchikey_index", None) or InchikeyIndex.from_tanimoto_df(tanimoto_scores)
+    inchikey_positions = inchikey_index.positions(spectra_inchikeys14(spectra))
+    reference_rmses = tiled_tanimoto_dependent_losses(reference_embeddings, inchikey_positions, tanimoto_scores,
+                                                      ref_score_bins)
+    fast_rmses = tiled_tanimoto_dependent_losses(fast_embeddings, inchikey_positions, tanimoto_scores,
+                                                 ref_score_bins)
+    rmse_deltas = np.array(fast_rmses) - np.array(reference_rmses)
+    max_abs_delta = float(np.nanmax(np.abs(rmse_deltas)))
+    report = {"precision": precision,
+              "n_spectra": len(spectra),
+              "reference_seconds": reference_seconds,
+              "fast_seconds": fast_seconds,
+              "speedup": reference_seconds / fast_seconds,
+              "reference_rmses": list(reference_rmses),
+              "fast_rmses": list(fast_rmses),
+              "rmse_deltas": rmse_deltas.tolist(),
+              "max_abs_rmse_delta": max_abs_delta,
+              "max_rmse_delta": max_rmse_delta,
+              "accepted": max_abs_delta <= max_rmse_delta}
+    return report, embedder
+
+
+if __name__ == "__main__":
+    from spectrum_store import SpectrumStore
+    from tanimoto_store import load_tanimoto_matrix
+    model_file, output_directory, output_precision = sys.argv[1], sys.argv[2], sys.argv[3]
+    test_spectra = SpectrumStore(sys.argv[4]).get_spectra()
+    report, fast_embedder = compare_inference(test_spectra, load_tanimoto_matrix(sys.argv[5]), model_file,
+                                              output_precision)
+    print(json.dumps(report, indent=2))
+    if report["accepted"]:
+        # The embedder that was evaluated is stored
+        fast_embedder.save(output_directory)
+        print("Stored the NumPy model in", os.path.abspath(output_directory))
+    else:
+        print(f"Not stored, the RMSE changes by more than {report['max_rmse_delta']}")
@@ -1,44 +1,77 @@
-import os
-import random
-import pickle
-import numpy as np
-from calculate_binned_average_rmse import calculate_binned_average_rmse
-
-
-def load_pickled_file(filename: str):
-    with open(filename, 'rb') as file:
-        loaded_object = pickle.load(file)
-    return loaded_object
-
-
-def create_random_subsets(testing_spectra, nr_of_splits, tanimoto_score_df, ms2ds_model_file):
-    random.seed(42)
-    random.shuffle(testing_spectra)
-    set_size = len(testing_spectra) / nr_of_splits
-    rmses = []
-    for i in np.linspace(0, len(testing_spectra) - set_size, nr_of_splits):
-        start = int(i)
-        end = int(i + set_size)
-        binned_average_RMSE = calculate_binned_average_rmse(testing_spectra[start:end], tanimoto_score_df, ms2ds_model_file)
-        print(binned_average_RMSE)
-        print(i)
-        rmses.append(binned_average_RMSE)
-    return rmses
-
-
-if __name__ == "__main__":
-    path_root = os.path.dirname(os.getcwd())
-    path_files_folder = os.path.join(path_root, "../../data/hot_topics_metabolomics/")
-    testing_spectra = load_pickled_file(os.path.join(path_files_folder, "all_testing_spectra.pickle"))
-    tanimoto_score_df = load_pickled_file(os.path.join(path_root,
-                                                       "../../data/libraries_and_models/gnps_15_12_2021/in_between_files/GNPS_15_12_2021_pos_tanimoto_scores.pickle"))
-    ms2ds_model_file = os.path.join(path_files_folder, "ms2deepscore_model_with_spectrumbinner.hdf5")
-    print(create_random_subsets(testing_spectra, 10,
-                                tanimoto_score_df,
-                                ms2ds_model_file))
-    print(create_random_subsets(testing_spectra, 100,
-                                tanimoto_score_df,
-                                ms2ds_model_file))
-    print(create_random_subsets(testing_spectra, 1000,
-                                tanimoto_score_df,
-                                ms2ds_model_file))
+import os
+import random
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from tanimoto_store import load_tanimoto_scores
+from calculate_binned_average_rmse import (
+    calculate_binned_average_rmse_from_embeddings, compute_ms2ds_embeddings)
+from embedding_cache import EmbeddingCache
+from inchikey_index import InchikeyIndex
+from split_data import load_test_spectra_for_model
+from stratum_runner import FIGURES_DATA_FOLDER
+
+
+def create_random_subsets(testing_spectra, nr_of_splits, tanimoto_score_df, ms2ds_model_file,
+                          embeddings=None):
+    """Binned average RMSE for nr_of_splits disjoint random subsets of testing_spectra
+
+    The model is only used to embed all testing_spectra once, the scores of each subset
+    are computed from slices of these embeddings.
+
+    embeddings:
+        Optional precomputed embeddings of testing_spectra, in the same order. Like testing_spectra
+        they are shuffled in place, so they can be passed on to the next call.
+    """
+    if embeddings is None:
+        embeddings = compute_ms2ds_embeddings(testing_spectra, ms2ds_model_file)
+    random.seed(42)
+    order = list(range(len(testing_spectra)))
+    random.shuffle(order)
+    testing_spectra[:] = [testing_spectra[i] for i in order]
+    embeddings[:] = embeddings[order]
+    inchikey_index = InchikeyIndex.from_tanimoto_df(tanimoto_score_df)
+    set_size = len(testing_spectra) / nr_of_splits
+    rmses = []
+    for i in np.linspace(0, len(testing_spectra) - set_size, nr_of_splits):
+        start = int(i)
+        end = int(i + set_size)
+        binned_average_RMSE = calculate_binned_average_rmse_from_embeddings(testing_spectra[start:end],
+                                                                            tanimoto_score_df,
+                                                                            embeddings[start:end],
+                                                                            inchikey_index)
+        print(binned_average_RMSE)
+        print(i)
+        rmses.append(binned_average_RMSE)
+    return rmses
+
+
+def write_test_set_csv(rmses_per_set_size: Dict[int, List[float]], filename: str, decimals: int = 9):
+    """Write the RMSEs per test set size in the format of figures_data/experiment_test_set.csv
+
+    There is a column "<set size> test spectra" per set size, from small to large. The columns of the
+    larger sets, which have fewer subsets, are padded with empty cells.
+    """
+    columns = {f"{set_size} test spectra": pd.Series(np.round(rmses, decimals))
+               for set_size, rmses in sorted(rmses_per_set_size.items())}
+    pd.DataFrame(columns).to_csv(filename, sep=";", index=False, encoding="utf-8-sig")
+
+
+if __name__ == "__main__":
+    path_root = os.path.dirname(os.getcwd())
+    path_files_folder = os.path.join(path_root, "../../data/hot_topics_metabolomics/")
+    library_store = os.path.join(path_root, "../../data/libraries_and_models/gnps_15_12_2021/in_between_files/ALL_GNPS_15_12_2021_positive_annotated")
+    ms2ds_model_file = os.path.join(path_files_folder, "ms2deepscore_model_with_spectrumbinner.hdf5")
+    # Models trained before the splits were stored in the library are evaluated on their original test set
+    testing_spectra = load_test_spectra_for_model(library_store, ms2ds_model_file,
+                                                   os.path.join(path_files_folder, "all_testing_spectra.pickle"))
+    tanimoto_score_df = load_tanimoto_scores(os.path.join(path_root,
+                                                         "../../data/libraries_and_models/gnps_15_12_2021/in_between_files/GNPS_15_12_2021_pos_tanimoto_scores"))
+    # Embed the test pool once (or read it from the cache), every subset is scored from these embeddings
+    embedding_cache = EmbeddingCache(os.path.join(path_files_folder, "embedding_cache"), ms2ds_model_file)
+    embeddings = embedding_cache.get_embeddings(testing_spectra)
+    rmses_per_set_size = {}
+    for nr_of_splits in (10, 100, 1000):
+        rmses_per_set_size[len(testing_spectra) // nr_of_splits] = create_random_subsets(
+            testing_spectra, nr_of_splits, tanimoto_score_df, ms2ds_model_file, embeddings=embeddings)
+    write_test_set_csv(rmses_per_set_size, os.path.join(FIGURES_DATA_FOLDER, "experiment_test_set.csv"))
@@ -0,0 +1,10 @@
+import hashlib
+
+
+def file_hash(filename: str) -> str:
+    """sha256 of the content of a file"""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(2 ** 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
@@ -0,0 +1,75 @@
+from typing import Iterable, List, Optional
+import numpy as np
+import pandas as pd
+from matchms import Spectrum
+
+
+class InchikeyIndex:
+    """Maps InChIKeys of 14 characters to their position in a Tanimoto score table.
+
+    Build it once per Tanimoto table (from_tanimoto_df) or save it next to the table and load it again,
+    the lookup of all spectra is then a single vectorized hash lookup.
+    """
+    def __init__(self, inchikeys: Iterable[str]):
+        self.inchikeys = pd.Index(inchikeys)
+        if not self.inchikeys.is_unique:
+            duplicates = self.inchikeys[self.inchikeys.duplicated()].unique()
+            raise ValueError(f"The InChIKey index contains {len(duplicates)} duplicated InChIKeys, "
+                             f"e.g. {list(duplicates[:5])}")
+
+    @classmethod
+    def from_tanimoto_df(cls, tanimoto_df: pd.DataFrame) -> "InchikeyIndex":
+        """Index of a dataframe with as index and columns InChIKeys of 14 letters"""
+        return cls(tanimoto_df.index)
+
+    @classmethod
+    def load(cls, filename: str) -> "InchikeyIndex":
+        """Load an index stored with save"""
+        with open(filename, "r") as file:
+            return cls([line.rstrip("\n") for line in file])
+
+    def save(self, filename: str):
+        """Store the index as a text file with one InChIKey per line, in order"""
+        with open(filename, "w") as file:
+            file.writelines(f"{inchikey}\n" for inchikey in self.inchikeys)
+
+    def __len__(self) -> int:
+        return len(self.inchikeys)
+
+    def positions(self, inchikeys: Iterable[str]) -> np.ndarray:
+        """Return the position of each of the inchikeys (14 characters) in the index
+
+        Raises a KeyError listing the InChIKeys that are not in the index.
+        """
+        inchikeys = list(inchikeys)
+        positions = self.inchikeys.get_indexer(inchikeys)
+        missing = np.where(positions == -1)[0]
+        if len(missing) > 0:
+            missing_inchikeys = pd.unique(np.array(inchikeys, dtype=object)[missing])
+            raise KeyError(f"{len(missing)} of {len(inchikeys)} InChIKeys are not in the Tanimoto scores "
+                           f"({len(missing_inchikeys)} unique), e.g. {list(missing_inchikeys[:5])}")
+        return positions
+
+
+def spectra_inchikeys14(spectra: List[Spectrum]) -> List[str]:
+    """Return the first 14 characters of the InChIKey of each spectrum
+
+    Raises a ValueError if any of the spectra does not have an InChIKey.
+    """
+    inchikeys = [spectrum.get("inchikey") for spectrum in spectra]
+    without_inchikey = [i for i, inchikey in enumerate(inchikeys) if not inchikey]
+    if len(without_inchikey) > 0:
+        raise ValueError(f"{len(without_inchikey)} spectra do not have an InChIKey, "
+                         f"e.g. the spectra at positions {without_inchikey[:5]}")
+    return [inchikey[:14] for inchikey in inchikeys]
+
+
+def gather_block(values: np.ndarray, row_idx: np.ndarray, col_idx: Optional[np.ndarray] = None) -> np.ndarray:
+    """Gather the (rectangular) block of rows row_idx and columns col_idx from values
+
+    If col_idx is None the square block row_idx x row_idx is returned.
+    """
+    if col_idx is None:
+        col_idx = row_idx
+    return values[np.ix_(row_idx, col_idx)]
+
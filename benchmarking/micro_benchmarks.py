@@ -0,0 +1,266 @@
+"""Micro-benchmarks of the hot paths of the evaluation on synthetic data, to catch speed and memory regressions.
+
+Times tanimoto_dependent_losses, select_predictions_for_test_spectra, create_stratified_test_set,
+create_super_class_dict and clamshell_plot at several sizes, and appends the timings and the peak memory
+to a json report with the git commit of the run, to compare commits. The spectra, InChIKeys, Tanimoto
+scores, ClassyFire classes and counts are random, so no GNPS data or trained model is needed:
+    python micro_benchmarks.py --sizes 1000 10000 100000 --report micro_benchmarks.json
+    python micro_benchmarks.py --baseline micro_benchmarks.json
+
+With --baseline the results are compared with the last run in the baseline report, and the script exits
+with status 1 if a benchmark became slower by more than --tolerance.
+The pairwise benchmarks build score matrices of n x n, they are skipped for sizes above --max_pairwise.
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import lru_cache
+from typing import Callable, List, NamedTuple
+import numpy as np
+import pandas as pd
+import matplotlib
+from matchms import Spectrum
+from calculate_binned_average_rmse import select_predictions_for_test_spectra, tanimoto_dependent_losses
+from split_on_mass_ranges import create_stratified_test_set
+from split_on_superclasses import create_super_class_dict
+
+
+CLAMSHELL_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "clamshell")
+sys.path.insert(0, CLAMSHELL_FOLDER)
+REF_SCORE_BINS = np.linspace(0, 1.0, 11)
+SUPERCLASSES = ("Benzenoids", "Lipids and lipid-like molecules", "Organic acids and derivatives",
+                "Organoheterocyclic compounds", "Organic oxygen compounds", "Phenylpropanoids and polyketides",
+                "Alkaloids and derivatives", "Organic nitrogen compounds", "Lignans, neolignans and related compounds",
+                "Nucleosides, nucleotides, and analogues", "Organosulfur compounds", "Hydrocarbons")
+
+
+class Benchmark(NamedTuple):
+    """A hot path to time
+
+    setup:
+        Function of the size, the seed and a temporary folder, returning the function to time (without
+        arguments). The setup is not timed.
+    pairwise:
+        The benchmark builds n x n matrices, it is skipped for sizes above max_pairwise.
+    """
+    setup: Callable[[int, int, str], Callable[[], object]]
+    pairwise: bool = False
+
+
+def synthetic_inchikeys14(n_inchikeys: int, rng: np.random.Generator) -> np.ndarray:
+    """Unique random InChIKeys of 14 characters"""
+    inchikeys14 = np.unique(["".join(chars) for chars in rng.choice(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"),
+                                                                      size=(n_inchikeys, 14))])
+    return rng.permutation(inchikeys14)
+
+
+def synthetic_scores(n: int, rng: np.random.Generator) -> np.ndarray:
+    """Random symmetric float32 score matrix with ones on the diagonal"""
+    scores = rng.random((n, n), dtype=np.float32)
+    scores = (scores + scores.T) / 2
+    np.fill_diagonal(scores, 1.0)
+    return scores
+
+
+@lru_cache(maxsize=1)
+def synthetic_library(n_spectra: int, seed: int):
+    """Random spectra with parent masses and InChIKeys (one per 5 spectra), and the Tanimoto scores of the InChIKeys
+
+    Cached, so the benchmarks of the same size share the spectra.
+    """
+    rng = np.random.default_rng(seed)
+    inchikeys14 = synthetic_inchikeys14(max(n_spectra // 5, 2), rng)
+    # Uniform, so every mass range has enough spectra for create_stratified_test_set
+    parent_masses = rng.uniform(50.0, 1500.0, n_spectra)
+    spectra = []
+    for i in range(n_spectra):
+        n_peaks = rng.integers(5, 50)
+        spectra.append(Spectrum(mz=np.sort(rng.uniform(10.0, 1000.0, n_peaks)),
+                                intensities=rng.uniform(0.01, 1.0, n_peaks),
+                                metadata={"inchikey": inchikeys14[i % len(inchikeys14)] + "-UHFFFAOYSA-N",
+                                          "parent_mass": parent_masses[i]}))
+    tanimoto_df = pd.DataFrame(synthetic_scores(len(inchikeys14), rng), index=inchikeys14, columns=inchikeys14)
+    return spectra, tanimoto_df
+
+
+def write_synthetic_classifiers(inchikeys14: np.ndarray, filename: str, rng: np.random.Generator):
+    """ClassyFire classifiers file with a random superclass for 90% of the InChIKeys"""
+    with_class = inchikeys14[rng.random(len(inchikeys14)) < 0.9]
+    pd.DataFrame({"inchi_key": [inchikey + "-UHFFFAOYSA-N" for inchikey in with_class],
+                  "cf_superclass": rng.choice(SUPERCLASSES, len(with_class))}).to_csv(filename, sep="\t", index=False)
+
+
+def _setup_tanimoto_dependent_losses(n: int, seed: int, directory: str):
+    rng = np.random.default_rng(seed)
+    scores_ref = synthetic_scores(n, rng)
+    scores = np.clip(scores_ref + 0.1 * rng.standard_normal((n, n), dtype=np.float32), 0, 1)
+    scores = (scores + scores.T) / 2
+    return lambda: tanimoto_dependent_losses(scores, scores_ref, REF_SCORE_BINS)
+
+
+def _setup_select_predictions(n: int, seed: int, directory: str):
+    spectra, tanimoto_df = synthetic_library(n, seed)
+    return lambda: select_predictions_for_test_spectra(tanimoto_df, spectra)
+
+
+def _setup_stratified_test_set(n: int, seed: int, directory: str):
+    spectra, _ = synthetic_library(n, seed)
+    # 1500 spectra per mass range of a test set of 100000 spectra, as in split_on_mass_ranges
+    k = max(n * 15 // 1000, 1)
+    return lambda: create_stratified_test_set(spectra, k=k)
+
+
+def _setup_super_class_dict(n: int, seed: int, directory: str):
+    spectra, tanimoto_df = synthetic_library(n, seed)
+    classifiers_file = os.path.join(directory, "classifiers.txt")
+    write_synthetic_classifiers(np.asarray(tanimoto_df.index), classifiers_file, np.random.default_rng(seed))
+    return lambda: create_super_class_dict(classifiers_file, spectra)
+
+
+def _setup_clamshell_plot(n: int, seed: int, directory: str):
+    from clamshell_plot import clamshell_plot  # pylint: disable=import-error,import-outside-toplevel
+    # Class counts are heavy tailed, like the number of InChIKeys per ClassyFire class
+    counts = np.random.default_rng(seed).zipf(1.5, n).tolist()
+    labels = [f"class {i}" for i in range(n)]
+    return lambda: clamshell_plot(counts, labels, 10, os.path.join(directory, "clamshell.png"), counts_threshold=10,
+                                  log=os.path.join(directory, "clamshell.log"))
+
+
+BENCHMARKS = {
+    "tanimoto_dependent_losses": Benchmark(_setup_tanimoto_dependent_losses, pairwise=True),
+    "select_predictions_for_test_spectra": Benchmark(_setup_select_predictions, pairwise=True),
+    "create_stratified_test_set": Benchmark(_setup_stratified_test_set),
+    "create_super_class_dict": Benchmark(_setup_super_class_dict),
+    "clamshell_plot": Benchmark(_setup_clamshell_plot),
+}
+
+
+def time_function(function: Callable[[], object], repeats: int) -> List[float]:
+    seconds = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def peak_memory_mb(function: Callable[[], object]) -> float:
+    """Peak memory allocated while running function, traced in a separate (slower) run
+
+    numpy arrays are traced, memory allocated by other C libraries (e.g. matplotlib rendering) is not.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(names: List[str], sizes: List[int], repeats: int = 3, max_pairwise: int = 10000,
+                   seed: int = 42) -> List[dict]:
+    """Time each benchmark at each size, with the minimum and median over repeats and the peak memory"""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for n in sizes:
+            for name in names:
+                benchmark = BENCHMARKS[name]
+                if benchmark.pairwise and n > max_pairwise:
+                    print(f"{name} (n={n}): skipped, larger than max_pairwise")
+                    continue
+                function = benchmark.setup(n, seed, directory)
+                seconds = time_function(function, repeats)
+                result = {"benchmark": name, "n": n, "repeats": repeats,
+                          "seconds_min": min(seconds), "seconds_median": float(np.median(seconds)),
+                          "peak_memory_mb": peak_memory_mb(function)}
+                print(f"{name} (n={n}): {result['seconds_median']:.4f} s, {result['peak_memory_mb']:.1f} MB")
+                results.append(result)
+                del function
+    synthetic_library.cache_clear()
+    return results
+
+
+def git_commit() -> str:
+    """Short hash of the checked out commit, with -dirty if there are uncommitted changes, None outside git"""
+    folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=folder, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        changes = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=folder,
+                                 capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + "-dirty" if changes else commit
+
+
+def compare_with_baseline(results: List[dict], baseline_results: List[dict], tolerance: float = 1.25) -> pd.DataFrame:
+    """Ratio of the median seconds to the baseline for the benchmarks and sizes in both, with regressions marked"""
+    columns = ["benchmark", "n", "seconds_median", "peak_memory_mb"]
+    comparison = pd.DataFrame(results)[columns].merge(pd.DataFrame(baseline_results)[columns],
+                                                      on=["benchmark", "n"], suffixes=("", "_baseline"))
+    comparison["time_ratio"] = comparison["seconds_median"] / comparison["seconds_median_baseline"]
+    comparison["memory_ratio"] = comparison["peak_memory_mb"] / comparison["peak_memory_mb_baseline"]
+    comparison["regression"] = comparison["time_ratio"] > tolerance
+    return comparison
+
+
+def cli() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the evaluation hot paths on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--benchmarks", nargs="+", default=list(BENCHMARKS), choices=list(BENCHMARKS))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max_pairwise", type=int, default=10000,
+                        help="Largest size of the benchmarks that build n x n score matrices.")
+    parser.add_argument("--report", default="micro_benchmarks.json", help="Json file the results are appended to.")
+    parser.add_argument("--baseline", default=None, help="Report of which the last run is compared with this run.")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="Largest allowed ratio of the median time to the baseline.")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = cli()
+    matplotlib.use("Agg")
+    results = run_benchmarks(args.benchmarks, args.sizes, args.repeats, args.max_pairwise, args.seed)
+    run = {"timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+           "commit": git_commit(),
+           "settings": {key: value for key, value in vars(args).items() if key not in ("report", "baseline")},
+           "python": sys.version.split()[0],
+           "numpy": np.__version__,
+           "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+           "results": results}
+
+    baseline_results = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline_results = json.load(file)[-1]["results"]
+    reports = []
+    if os.path.exists(args.report):
+        with open(args.report, "r") as file:
+            reports = json.load(file)
+    reports.append(run)
+    with open(args.report, "w") as file:
+        json.dump(reports, file, indent=2)
+    print("Stored the results in", os.path.abspath(args.report))
+
+    if baseline_results is not None:
+        comparison = compare_with_baseline(results, baseline_results, args.tolerance)
+        print(comparison.to_string(index=False))
+        if comparison["regression"].any():
+            print(f"{comparison['regression'].sum()} benchmarks are more than {args.tolerance} times slower")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+import json
+import random
+import time
+import numpy as np
+from tensorflow import keras
+
+
+class SeededBatchSequence(keras.utils.Sequence):
+    """Wraps an ms2deepscore data generator so batches can be created by parallel workers reproducibly
+
+    The random state is reset from (seed, epoch, batch index) before each batch is created, so the pair
+    selection and augmentation of a batch do not depend on which worker process creates it.
+    Use with model.fit(..., workers=n, use_multiprocessing=True, callbacks=[sequence.epoch_callback()]):
+    the workers are forked and share the memory-mapped Tanimoto scores and binned spectra with the main
+    process.
+
+    The epoch is taken from the callback, because keras calls on_epoch_end once or twice per epoch
+    depending on the number of workers (the data adapter and the OrderedEnqueuer both call it).
+    """
+    def __init__(self, data_generator: keras.utils.Sequence, seed: int = 42):
+        self.data_generator = data_generator
+        self.seed = seed
+        self.epoch = None
+        self.set_epoch(0)
+
+    def _reset_random_state(self, *keys: int):
+        np.random.seed([self.seed, self.epoch, *keys])
+        random.seed(hash((self.seed, self.epoch, *keys)))
+
+    def __len__(self) -> int:
+        return len(self.data_generator)
+
+    def __getitem__(self, batch_index: int):
+        self._reset_random_state(batch_index)
+        return self.data_generator[batch_index]
+
+    def set_epoch(self, epoch: int):
+        """Prepare the batches of an epoch, repeated calls for the same epoch are ignored"""
+        if epoch == self.epoch:
+            return
+        self.epoch = epoch
+        self._reset_random_state()
+        self.data_generator.on_epoch_end()
+
+    def on_epoch_end(self):
+        """Ignored, the next epoch is set by the callback of epoch_callback"""
+
+    def epoch_callback(self) -> keras.callbacks.Callback:
+        """Callback that sets the epoch of this sequence at the start of each epoch of model.fit"""
+        return _SetEpochCallback(self)
+
+
+class _SetEpochCallback(keras.callbacks.Callback):
+    def __init__(self, sequence: SeededBatchSequence):
+        super().__init__()
+        self.sequence = sequence
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.sequence.set_epoch(epoch)
+
+
+class BatchThroughputMonitor(keras.callbacks.Callback):
+    """Records the training throughput per epoch
+
+    The stall time is the time the training loop spent between the end of a batch and the start of the
+    next one, which is mostly waiting for the data generator (workers).
+    """
+    def __init__(self, report_file: str = None):
+        super().__init__()
+        self.report_file = report_file
+        self.report = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+        self._last_batch_end = self._epoch_start
+        self._stall_time = 0.0
+        self._n_batches = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._stall_time += time.perf_counter() - self._last_batch_end
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._last_batch_end = time.perf_counter()
+        self._n_batches += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        train_time = self._last_batch_end - self._epoch_start
+        epoch_report = {"epoch": epoch,
+                        "batches": self._n_batches,
+                        "train_seconds": train_time,
+                        "batches_per_second": self._n_batches / train_time if train_time > 0 else float("nan"),
+                        "stall_seconds": self._stall_time,
+                        "stall_fraction": self._stall_time / train_time if train_time > 0 else float("nan")}
+        self.report.append(epoch_report)
+        print(f"Epoch {epoch}: {epoch_report['batches_per_second']:.2f} batches/s, "
+              f"{epoch_report['stall_seconds']:.1f} s waiting for batches")
+        if self.report_file is not None:
+            with open(self.report_file, "w") as file:
+                json.dump(self.report, file, indent=2)
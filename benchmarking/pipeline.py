@@ -0,0 +1,431 @@
+"""Content-addressed runner of the benchmark workflow: split -> train -> embed -> evaluate -> figures_data.
+
+Each stage declares its inputs (content hashes of the spectra, splits, model, embeddings and the slice
+of the Tanimoto scores it uses), its parameters and the scripts with its code. The key of a stage is
+the hash of all of these, and a stage is skipped when its key is the same as in the last successful run
+and its outputs exist. A new model reruns the embeddings and the evaluations, while changing for
+instance the mass bins only reruns the mass range evaluation. The evaluation stages are independent
+and run in parallel; they write figures_data/experiment_*.csv directly:
+    python pipeline.py pipeline_config.json
+    python pipeline.py pipeline_config.json --force evaluate_mass_ranges
+
+The config is a json file with the fields of PipelineConfig (relative paths are relative to the config
+file) and optionally the parameters of stages, which override DEFAULT_PARAMETERS, e.g.:
+    {"library_store": "gnps_15_12_2021/ALL_GNPS_15_12_2021_positive_annotated",
+     "tanimoto_scores": "gnps_15_12_2021/GNPS_15_12_2021_pos_tanimoto_scores",
+     "classifiers_file": "gnps_09_04_2021/ALL_GNPS_210409_positive_processed_annotated_CF_NPC_classes.txt",
+     "work_folder": "hot_topics_metabolomics",
+     "parameters": {"evaluate_mass_ranges": {"mass_bins": [0, 250, 500, 750, 1000, 5000]}}}
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Callable, Dict, List, NamedTuple, Tuple
+import numpy as np
+from embedding_cache import EmbeddingCache
+from generate_data_for_box_plot_for_different_size_test_sets import create_random_subsets, write_test_set_csv
+from hashing import file_hash
+from inchikey_index import gather_block
+from spectrum_store import (INCHIKEY14_COLUMN, INTENSITIES_FILE, METADATA_FILE, MZ_FILE, OFFSETS_FILE,
+                            load_metadata)
+from split_data import (SPLIT_MANIFEST_FILE, SPLIT_NAMES, load_split_indices, load_split_inchikeys14,
+                        load_split_spectra, load_test_spectra_for_model, split_indices, split_indices_by_inchikey,
+                        write_split_manifest)
+from split_on_mass_ranges import create_stratified_test_index, mass_range_label
+from split_on_superclasses import create_super_class_index
+from stratification import MASS_BINS, sample_per_stratum
+from stratum_runner import FIGURES_DATA_FOLDER, run_strata, write_experiment_csv
+from tanimoto_store import load_tanimoto_matrix, load_tanimoto_scores, tanimoto_store_files
+from train_ms2deepscore_model import save_model_with_spectrum_binner, train_ms2deepscore_model
+
+
+CODE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = "pipeline_state.json"
+DEFAULT_PARAMETERS = {
+    "split": {"nr_of_val": 10000, "nr_of_test": 100000, "seed": 42, "split_by_inchikey": False},
+    "train": {"seed": 42},
+    "embed": {},
+    "evaluate_test_set_sizes": {"nr_of_splits": [10, 100, 1000]},
+    "evaluate_mass_ranges": {"k": 1500, "seed": 42, "mass_bins": MASS_BINS},
+    "evaluate_superclasses": {"k": 1500, "seed": 42},
+}
+
+
+class PipelineConfig(NamedTuple):
+    """Paths of the inputs and outputs of the pipeline
+
+    library_store:
+        Spectrum store of the library (see spectrum_store.py), the splits are stored in it.
+    tanimoto_scores:
+        Base file name of the Tanimoto store of the library (see tanimoto_store.py).
+    classifiers_file:
+        ClassyFire classes of the InChIKeys, for the superclass evaluation.
+    work_folder:
+        Folder for the model, the embeddings and the state of the pipeline.
+    n_workers:
+        Number of processes of the training batches and of the stratified evaluations, by default the
+        number of cpus. The processes are divided between the stages that run at the same time.
+    parameters:
+        Parameters per stage name, overriding DEFAULT_PARAMETERS.
+    """
+    library_store: str
+    tanimoto_scores: str
+    classifiers_file: str
+    work_folder: str
+    figures_data_folder: str = FIGURES_DATA_FOLDER
+    n_workers: int = None
+    parameters: dict = None
+
+    @property
+    def model_file(self) -> str:
+        return os.path.join(self.work_folder, "ms2deepscore_model_with_spectrumbinner.hdf5")
+
+    @property
+    def embeddings_file(self) -> str:
+        return os.path.join(self.work_folder, "test_embeddings.npy")
+
+    def stage_parameters(self, stage_name: str) -> dict:
+        return {**DEFAULT_PARAMETERS[stage_name], **(self.parameters or {}).get(stage_name, {})}
+
+
+def load_config(filename: str) -> PipelineConfig:
+    with open(filename, "r") as file:
+        settings = json.load(file)
+    config_folder = os.path.dirname(os.path.abspath(filename))
+    for field in ("library_store", "tanimoto_scores", "classifiers_file", "work_folder", "figures_data_folder"):
+        if field in settings:
+            settings[field] = os.path.join(config_folder, settings[field])
+    return PipelineConfig(**settings)
+
+
+class FileHashes:
+    """sha256 of files and derived artifacts, remembered between runs
+
+    A file is only hashed again when its size or modification time changed, so the large files (spectrum
+    store, Tanimoto scores) are read once.
+    """
+    def __init__(self, memo: dict = None):
+        self.memo = {} if memo is None else memo
+
+    def __call__(self, filename: str) -> str:
+        stat = os.stat(filename)
+        return self.memoized(os.path.abspath(filename), [stat.st_size, stat.st_mtime_ns],
+                             lambda: file_hash(filename))
+
+    def memoized(self, name: str, stamp, compute: Callable[[], str]) -> str:
+        """Hash of name computed with compute, unless it was computed before for the same stamp"""
+        entry = self.memo.get(name)
+        if entry is None or entry["stamp"] != stamp:
+            entry = {"stamp": stamp, "sha256": compute()}
+            self.memo[name] = entry
+        return entry["sha256"]
+
+
+def spectra_hash(config: PipelineConfig, file_hashes: FileHashes) -> str:
+    """Hash of the spectrum store of the library"""
+    return _combined_hash(file_hashes(os.path.join(config.library_store, filename))
+                          for filename in (METADATA_FILE, MZ_FILE, INTENSITIES_FILE, OFFSETS_FILE))
+
+
+def split_hash(config: PipelineConfig, split_name: str) -> str:
+    """Hash of the indices of a split, as stored in the split manifest"""
+    with open(os.path.join(config.library_store, SPLIT_MANIFEST_FILE), "r") as file:
+        return json.load(file)["splits"][split_name]["sha256"]
+
+
+def tanimoto_hash(config: PipelineConfig, file_hashes: FileHashes) -> str:
+    """Hash of the complete Tanimoto store"""
+    return _combined_hash(file_hashes(filename) for filename in tanimoto_store_files(config.tanimoto_scores))
+
+
+def tanimoto_slice_hash(config: PipelineConfig, file_hashes: FileHashes, split_name: str = "test") -> str:
+    """Hash of the Tanimoto scores of all pairs of InChIKeys of a split, which is all an evaluation uses
+
+    Adding InChIKeys to the Tanimoto store (see tanimoto_builder.py) does not change it.
+    """
+    stamp = [tanimoto_hash(config, file_hashes), spectra_hash(config, file_hashes), split_hash(config, split_name)]
+    return file_hashes.memoized(f"tanimoto_slice {os.path.abspath(config.tanimoto_scores)} {split_name}", stamp,
+                                lambda: _tanimoto_slice_hash(config, split_name))
+
+
+def _tanimoto_slice_hash(config: PipelineConfig, split_name: str, rows_per_block: int = 256) -> str:
+    inchikeys14 = load_metadata(config.library_store, [INCHIKEY14_COLUMN])[INCHIKEY14_COLUMN]
+    inchikeys14 = inchikeys14.iloc[load_split_indices(config.library_store, split_name)].dropna()
+    tanimoto_matrix = load_tanimoto_matrix(config.tanimoto_scores)
+    positions = np.unique(tanimoto_matrix.inchikey_index.positions(inchikeys14))
+    sha256 = hashlib.sha256(str(tanimoto_matrix.values.dtype).encode())
+    sha256.update("\n".join(tanimoto_matrix.index[positions]).encode())
+    for start in range(0, len(positions), rows_per_block):
+        block = gather_block(tanimoto_matrix.values, positions[start:start + rows_per_block], positions)
+        sha256.update(np.ascontiguousarray(block).tobytes())
+    return sha256.hexdigest()
+
+
+def _combined_hash(hashes) -> str:
+    return hashlib.sha256(" ".join(hashes).encode()).hexdigest()
+
+
+# Loaded once per run, and shared by the (threads of the) stages that use them
+_load_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _load_test_spectra(library_store: str, model_file: str) -> list:
+    return load_test_spectra_for_model(library_store, model_file)
+
+
+def load_test_spectra(config: PipelineConfig) -> list:
+    """The test spectra of the model, loaded once for all stages. Copy the list before reordering it."""
+    with _load_lock:
+        return _load_test_spectra(config.library_store, config.model_file)
+
+
+def run_split(config: PipelineConfig, parameters: dict):
+    inchikeys14 = load_metadata(config.library_store, [INCHIKEY14_COLUMN])[INCHIKEY14_COLUMN]
+    if parameters["split_by_inchikey"]:
+        splits = split_indices_by_inchikey(inchikeys14, parameters["nr_of_val"], parameters["nr_of_test"],
+                                           parameters["seed"])
+    else:
+        splits = split_indices(len(inchikeys14), parameters["nr_of_val"], parameters["nr_of_test"],
+                               parameters["seed"])
+    write_split_manifest(config.library_store, dict(zip(SPLIT_NAMES, splits)), **parameters)
+
+
+def run_training(config: PipelineConfig, parameters: dict):
+    training_spectra = load_split_spectra(config.library_store, "train")
+    validation_spectra = load_split_spectra(config.library_store, "val")
+    tanimoto_score_df = load_tanimoto_matrix(config.tanimoto_scores).to_dataframe()
+    output_folder = os.path.join(config.work_folder, "ms2deepscore_model")
+    os.makedirs(output_folder, exist_ok=True)
+    # Rebuilt by load_or_create_binned_spectra when the training or validation spectra changed
+    binned_spectra_directory = os.path.join(config.work_folder, "binned_spectra")
+    train_ms2deepscore_model(training_spectra, validation_spectra, tanimoto_score_df, output_folder,
+                             binned_spectra_directory, workers=config.n_workers or min(8, os.cpu_count()),
+                             seed=parameters["seed"],
+                             training_inchikeys=load_split_inchikeys14(config.library_store, "train"),
+                             validation_inchikeys=load_split_inchikeys14(config.library_store, "val"))
+    save_model_with_spectrum_binner(os.path.join(output_folder, "final_ms2deepscore_model.hdf5"),
+                                    binned_spectra_directory, config.model_file,
+                                    split_store_directory=config.library_store)
+
+
+def run_embedding(config: PipelineConfig, parameters: dict):
+    # Spectra embedded by an earlier run of the same model are read from the cache
+    embedding_cache = EmbeddingCache(os.path.join(config.work_folder, "embedding_cache"), config.model_file)
+    np.save(config.embeddings_file, embedding_cache.get_embeddings(load_test_spectra(config)))
+
+
+def run_test_set_sizes(config: PipelineConfig, parameters: dict):
+    testing_spectra = list(load_test_spectra(config))
+    embeddings = np.load(config.embeddings_file)
+    tanimoto_score_df = load_tanimoto_scores(config.tanimoto_scores)
+    rmses_per_set_size = {}
+    for nr_of_splits in parameters["nr_of_splits"]:
+        rmses_per_set_size[len(testing_spectra) // nr_of_splits] = create_random_subsets(
+            testing_spectra, nr_of_splits, tanimoto_score_df, config.model_file, embeddings=embeddings)
+    write_test_set_csv(rmses_per_set_size, os.path.join(config.figures_data_folder, "experiment_test_set.csv"))
+
+
+def _run_strata_from_indices(config: PipelineConfig, indices_per_stratum: Dict[str, np.ndarray]) -> Dict[str, float]:
+    test_spectra = load_test_spectra(config)
+    embeddings = np.load(config.embeddings_file, mmap_mode="r")
+    strata = {stratum: [test_spectra[i] for i in indices] for stratum, indices in indices_per_stratum.items()}
+    return run_strata(strata, config.tanimoto_scores, config.model_file, n_workers=config.n_workers,
+                      embeddings={stratum: np.asarray(embeddings[indices])
+                                  for stratum, indices in indices_per_stratum.items()})
+
+
+def run_mass_ranges(config: PipelineConfig, parameters: dict):
+    indices_per_mass_range = create_stratified_test_index(load_test_spectra(config), parameters["k"],
+                                                          parameters["seed"], parameters["mass_bins"])
+    rmse_per_mass_range = _run_strata_from_indices(config, indices_per_mass_range)
+    write_experiment_csv(rmse_per_mass_range,
+                         os.path.join(config.figures_data_folder, "experiment_weight_ranges.csv"),
+                         "molecular_weight_range", "rmse", format_label=mass_range_label)
+
+
+def run_superclasses(config: PipelineConfig, parameters: dict):
+    spectra_per_class = create_super_class_index(config.classifiers_file, load_test_spectra(config))
+    samples_per_class = sample_per_stratum(spectra_per_class, k=parameters["k"], seed=parameters["seed"],
+                                           skip_smaller=True)
+    rmse_per_class = _run_strata_from_indices(config, samples_per_class)
+    write_experiment_csv(rmse_per_class, os.path.join(config.figures_data_folder, "experiment_chemical_class.csv"),
+                         "chemical_class", "RMSE")
+
+
+def _evaluation_inputs(config: PipelineConfig, file_hashes: FileHashes) -> Dict[str, str]:
+    return {"spectra": spectra_hash(config, file_hashes),
+            "test": split_hash(config, "test"),
+            "embeddings": file_hashes(config.embeddings_file),
+            "tanimoto_slice": tanimoto_slice_hash(config, file_hashes)}
+
+
+class Stage(NamedTuple):
+    """A step of the pipeline
+
+    run:
+        Function of the config and the parameters of the stage.
+    inputs:
+        Function of the config and the FileHashes, returning the hash of each input.
+    outputs:
+        Function of the config returning the output files, the stage is rerun if one is missing.
+    code:
+        Scripts with the code of the stage, changing them reruns the stage.
+    depends_on:
+        Stages that create the inputs of this stage.
+    """
+    name: str
+    run: Callable[[PipelineConfig, dict], None]
+    inputs: Callable[[PipelineConfig, FileHashes], Dict[str, str]]
+    outputs: Callable[[PipelineConfig], List[str]]
+    code: Tuple[str, ...]
+    depends_on: Tuple[str, ...] = ()
+
+
+STAGES = (
+    Stage("split", run_split,
+          lambda config, hashes: {"metadata": hashes(os.path.join(config.library_store, METADATA_FILE))},
+          lambda config: [os.path.join(config.library_store, SPLIT_MANIFEST_FILE)],
+          ("split_data.py",)),
+    Stage("train", run_training,
+          lambda config, hashes: {"spectra": spectra_hash(config, hashes),
+                                  "train": split_hash(config, "train"),
+                                  "val": split_hash(config, "val"),
+                                  "tanimoto": tanimoto_hash(config, hashes)},
+          lambda config: [config.model_file],
+          ("train_ms2deepscore_model.py", "parallel_batches.py", "binned_spectra_store.py"),
+          depends_on=("split",)),
+    Stage("embed", run_embedding,
+          lambda config, hashes: {"spectra": spectra_hash(config, hashes),
+                                  "test": split_hash(config, "test"),
+                                  "model": hashes(config.model_file)},
+          lambda config: [config.embeddings_file],
+          ("embedding_cache.py", "calculate_binned_average_rmse.py"),
+          depends_on=("train",)),
+    Stage("evaluate_test_set_sizes", run_test_set_sizes, _evaluation_inputs,
+          lambda config: [os.path.join(config.figures_data_folder, "experiment_test_set.csv")],
+          ("generate_data_for_box_plot_for_different_size_test_sets.py", "calculate_binned_average_rmse.py"),
+          depends_on=("embed",)),
+    Stage("evaluate_mass_ranges", run_mass_ranges, _evaluation_inputs,
+          lambda config: [os.path.join(config.figures_data_folder, "experiment_weight_ranges.csv")],
+          ("split_on_mass_ranges.py", "stratum_runner.py", "calculate_binned_average_rmse.py"),
+          depends_on=("embed",)),
+    Stage("evaluate_superclasses", run_superclasses,
+          lambda config, hashes: {**_evaluation_inputs(config, hashes),
+                                  "classifiers": hashes(config.classifiers_file)},
+          lambda config: [os.path.join(config.figures_data_folder, "experiment_chemical_class.csv")],
+          ("split_on_superclasses.py", "stratum_runner.py", "calculate_binned_average_rmse.py"),
+          depends_on=("embed",)),
+)
+
+
+def stage_key(stage: Stage, config: PipelineConfig, file_hashes: FileHashes) -> str:
+    """Hash of the inputs, the parameters and the code of a stage"""
+    description = {"inputs": stage.inputs(config, file_hashes),
+                   "parameters": config.stage_parameters(stage.name),
+                   "code": {filename: file_hashes(os.path.join(CODE_FOLDER, filename)) for filename in stage.code}}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def stage_levels(stages: Tuple[Stage, ...]) -> List[List[Stage]]:
+    """Group the stages in levels, each stage only depends on stages of earlier levels"""
+    levels = []
+    done = set()
+    remaining = list(stages)
+    while remaining:
+        level = [stage for stage in remaining if set(stage.depends_on) <= done]
+        assert level, f"Circular or missing dependencies of {[stage.name for stage in remaining]}"
+        levels.append(level)
+        done.update(stage.name for stage in level)
+        remaining = [stage for stage in remaining if stage.name not in done]
+    return levels
+
+
+def load_state(filename: str) -> dict:
+    if not os.path.exists(filename):
+        return {"stages": {}, "file_hashes": {}}
+    with open(filename, "r") as file:
+        return json.load(file)
+
+
+def save_state(state: dict, filename: str):
+    # Written to a temporary file first, so an interrupted run does not leave a broken state
+    with open(filename + ".tmp", "w") as file:
+        json.dump(state, file, indent=2)
+    os.replace(filename + ".tmp", filename)
+
+
+def _run_stage(stage: Stage, config: PipelineConfig) -> float:
+    start = time.perf_counter()
+    stage.run(config, config.stage_parameters(stage.name))
+    return time.perf_counter() - start
+
+
+def run_pipeline(config: PipelineConfig, stages: Tuple[Stage, ...] = STAGES, force: Tuple[str, ...] = ()) -> dict:
+    """Run the stages whose key changed (or whose outputs are missing), level by level
+
+    The stages of one level run in parallel threads; the evaluations spend their time in numpy and in
+    the worker processes of run_strata. The state (the key of each finished stage) is stored in the
+    work folder after each level. If a stage fails, the stages of the same level still finish, and
+    the exception is raised afterwards.
+
+    force:
+        Names of stages to run even if their key did not change.
+    """
+    os.makedirs(config.work_folder, exist_ok=True)
+    os.makedirs(config.figures_data_folder, exist_ok=True)
+    state_file = os.path.join(config.work_folder, STATE_FILE)
+    state = load_state(state_file)
+    file_hashes = FileHashes(state["file_hashes"])
+    _load_test_spectra.cache_clear()
+    for level in stage_levels(stages):
+        to_run = {}
+        for stage in level:
+            key = stage_key(stage, config, file_hashes)
+            outputs_exist = all(os.path.exists(filename) for filename in stage.outputs(config))
+            if stage.name in force or not outputs_exist or state["stages"].get(stage.name, {}).get("key") != key:
+                to_run[stage.name] = (stage, key)
+            else:
+                print(f"Skipping {stage.name}, its inputs did not change")
+        errors = []
+        stage_config = config
+        if len(to_run) > 1:
+            # Each evaluation starts its own pool of worker processes, together they use n_workers
+            stage_config = config._replace(n_workers=max((config.n_workers or os.cpu_count()) // len(to_run), 1))
+        with ThreadPoolExecutor(max_workers=max(len(to_run), 1)) as executor:
+            futures = {executor.submit(_run_stage, stage, stage_config): (stage, key)
+                       for stage, key in to_run.values()}
+            for future in as_completed(futures):
+                stage, key = futures[future]
+                try:
+                    seconds = future.result()
+                except Exception as error:  # pylint: disable=broad-except
+                    print(f"{stage.name} failed: {error!r}")
+                    errors.append(error)
+                    continue
+                print(f"Finished {stage.name} in {seconds:.1f} s")
+                state["stages"][stage.name] = {"key": key, "seconds": seconds,
+                                               "finished": time.strftime("%Y-%m-%d %H:%M:%S")}
+        save_state(state, state_file)
+        if errors:
+            raise errors[0]
+    return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stages of the benchmark whose inputs changed.")
+    parser.add_argument("config", help="json file with the paths and parameters (see PipelineConfig).")
+    parser.add_argument("--force", nargs="+", default=(), choices=[stage.name for stage in STAGES],
+                        help="Stages to run even if their inputs did not change.")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    pipeline_config = load_config(args.config)
+    if args.workers is not None:
+        pipeline_config = pipeline_config._replace(n_workers=args.workers)
+    run_pipeline(pipeline_config, force=tuple(args.force))
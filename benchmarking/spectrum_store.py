@@ -0,0 +1,164 @@
+"""Columnar storage of matchms spectra.
+
+A spectrum store is a folder with the metadata of all spectra in a Parquet file (metadata.parquet)
+and the peaks of all spectra concatenated in memory-mapped .npy files (mz.npy, intensities.npy),
+with peak_offsets.npy giving the start of the peaks of each spectrum.
+Metadata queries only read the Parquet file and Spectrum objects are only created for the rows
+that are selected. Reading Parquet files requires pyarrow. Metadata columns with list or dict values,
+or with values of different types, are stored as JSON strings (listed in json_columns.json) and
+parsed again when they are loaded.
+
+Convert a pickled list of spectra once by running this file:
+    python spectrum_store.py all_testing_spectra.pickle all_testing_spectra
+"""
+import json
+import os
+import pickle
+import sys
+from typing import Iterable, List, Tuple
+import numpy as np
+import pandas as pd
+from matchms import Spectrum
+
+
+METADATA_FILE = "metadata.parquet"
+MZ_FILE = "mz.npy"
+INTENSITIES_FILE = "intensities.npy"
+OFFSETS_FILE = "peak_offsets.npy"
+JSON_COLUMNS_FILE = "json_columns.json"
+# Column added to the metadata, it is not added to the metadata of the created spectra
+INCHIKEY14_COLUMN = "inchikey14"
+
+
+def load_pickled_file(filename: str):
+    with open(filename, 'rb') as file:
+        loaded_object = pickle.load(file)
+    return loaded_object
+
+
+def write_spectrum_store(spectra: List[Spectrum], directory: str):
+    """Write spectra to a spectrum store in directory"""
+    os.makedirs(directory, exist_ok=True)
+    metadata = pd.DataFrame([spectrum.metadata for spectrum in spectra], dtype=object)
+    json_columns = []
+    for column in metadata.columns:
+        metadata[column], is_json = _to_storable_column(metadata[column])
+        if is_json:
+            json_columns.append(column)
+    if "inchikey" in metadata.columns:
+        metadata[INCHIKEY14_COLUMN] = metadata["inchikey"].str[:14]
+    metadata.to_parquet(os.path.join(directory, METADATA_FILE), index=False)
+    with open(os.path.join(directory, JSON_COLUMNS_FILE), "w") as file:
+        json.dump(json_columns, file)
+
+    n_peaks = np.array([len(spectrum.peaks.mz) for spectrum in spectra], dtype=np.int64)
+    offsets = np.zeros(len(spectra) + 1, dtype=np.int64)
+    np.cumsum(n_peaks, out=offsets[1:])
+    np.save(os.path.join(directory, OFFSETS_FILE), offsets)
+    for filename, peaks_attribute in ((MZ_FILE, "mz"), (INTENSITIES_FILE, "intensities")):
+        peaks = np.lib.format.open_memmap(os.path.join(directory, filename), mode="w+",
+                                          dtype=np.float64, shape=(int(offsets[-1]),))
+        for i, spectrum in enumerate(spectra):
+            peaks[offsets[i]:offsets[i + 1]] = getattr(spectrum.peaks, peaks_attribute)
+        peaks.flush()
+        del peaks
+
+
+def _to_storable_column(column: pd.Series) -> Tuple[pd.Series, bool]:
+    """Give a metadata column a single type that can be stored in Parquet
+
+    Returns the column and whether its values are stored as JSON strings.
+    """
+    values = column.dropna()
+    if values.map(lambda v: isinstance(v, (bool, np.bool_))).all():
+        return column.astype("boolean"), False
+    if values.map(lambda v: isinstance(v, (int, np.integer)) and not isinstance(v, bool)).all():
+        return column.astype("Int64"), False
+    if values.map(lambda v: isinstance(v, (int, float, np.integer, np.floating))).all():
+        return column.astype("float64"), False
+    if values.map(lambda v: isinstance(v, str)).all():
+        return column.astype(object), False
+    try:
+        return column.map(_to_json, na_action="ignore").astype(object), True
+    except TypeError as error:
+        raise ValueError(f"Metadata {column.name} cannot be stored in a spectrum store: {error}") from error
+
+
+def _to_json(value) -> str:
+    if isinstance(value, tuple):
+        # json.dumps would silently turn it into a list
+        raise TypeError("Object of type tuple is not stored, it would be loaded as a list")
+    return json.dumps(value, default=_numpy_scalar_to_json)
+
+
+def _numpy_scalar_to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class SpectrumStore:
+    """Read access to a spectrum store written with write_spectrum_store
+
+    metadata:
+        Dataframe with one row per spectrum (in the stored order).
+    """
+    def __init__(self, directory: str, metadata_columns: List[str] = None):
+        self.directory = directory
+        self.metadata = load_metadata(directory, metadata_columns)
+        self.offsets = np.load(os.path.join(directory, OFFSETS_FILE))
+        self._mz = np.load(os.path.join(directory, MZ_FILE), mmap_mode="r")
+        self._intensities = np.load(os.path.join(directory, INTENSITIES_FILE), mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def n_peaks(self, min_intensity: float = None) -> np.ndarray:
+        """Number of peaks of each spectrum, only counting peaks with at least min_intensity if given"""
+        if min_intensity is None:
+            return np.diff(self.offsets)
+        n_peaks_before = np.zeros(len(self._intensities) + 1, dtype=np.int64)
+        np.cumsum(self._intensities >= min_intensity, out=n_peaks_before[1:])
+        return np.diff(n_peaks_before[self.offsets])
+
+    def peaks(self, i: int):
+        """Return the mz and intensities of spectrum i, without creating a Spectrum"""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return np.array(self._mz[start:end]), np.array(self._intensities[start:end])
+
+    def get_spectrum(self, i: int) -> Spectrum:
+        return self.get_spectra([i])[0]
+
+    def get_spectra(self, indices: Iterable[int] = None) -> List[Spectrum]:
+        """Create the Spectrum objects of the selected rows (all if indices is None)"""
+        indices = np.arange(len(self)) if indices is None else np.asarray(list(indices), dtype=np.int64)
+        records = self.metadata.iloc[indices].to_dict("records")
+        spectra = []
+        for i, record in zip(indices, records):
+            mz, intensities = self.peaks(i)
+            metadata = {key: value for key, value in record.items()
+                        if key != INCHIKEY14_COLUMN and not _is_missing(value)}
+            spectra.append(Spectrum(mz=mz, intensities=intensities, metadata=metadata))
+        return spectra
+
+
+def load_metadata(directory: str, columns: List[str] = None) -> pd.DataFrame:
+    """Load (the given columns of) the metadata of a spectrum store, without reading any peaks"""
+    metadata = pd.read_parquet(os.path.join(directory, METADATA_FILE), columns=columns)
+    json_columns_file = os.path.join(directory, JSON_COLUMNS_FILE)
+    if os.path.exists(json_columns_file):
+        with open(json_columns_file, "r") as file:
+            json_columns = json.load(file)
+        for column in json_columns:
+            if column in metadata.columns:
+                metadata[column] = metadata[column].map(json.loads, na_action="ignore")
+    return metadata
+
+
+def _is_missing(value) -> bool:
+    return value is None or value is pd.NA or (isinstance(value, float) and np.isnan(value))
+
+
+if __name__ == "__main__":
+    write_spectrum_store(load_pickled_file(sys.argv[1]), sys.argv[2])
+    print("Stored spectra in", os.path.abspath(sys.argv[2]))
@@ -1,30 +1,149 @@
-import numpy as np
-import pickle
-
-# Import data
-def load_pickled_file(filename: str):
-    with open(filename, 'rb') as file:
-        loaded_object = pickle.load(file)
-    return loaded_object
-
-def split_into_train_and_val(all_spectra, nr_of_val, nr_of_test):
-    n_spectra = len(all_spectra)
-    n_train = n_spectra - nr_of_val - nr_of_test
-
-    spectrum_ids = np.arange(n_spectra)
-    # Select training, validation, and test IDs:
-    train_spectrumIDs = np.random.choice(spectrum_ids, n_train, replace=False)
-    val_spectrumIDs = np.random.choice(list(set(spectrum_ids) - set(train_spectrumIDs)), nr_of_val, replace=False)
-    test_spectrumIDs = list(set(spectrum_ids) - set(train_spectrumIDs) - set(val_spectrumIDs))
-    train_split = [all_spectra[i] for i in train_spectrumIDs]
-    val_split = [all_spectra[i] for i in val_spectrumIDs]
-    test_split = [all_spectra[i] for i in test_spectrumIDs]
-    return train_split, val_split, test_split
-
-library_spectra = load_pickled_file("C:/Users/jonge094/PycharmProjects/PhD_MS2Query/ms2query/data/libraries_and_models/gnps_15_12_2021/in_between_files/ALL_GNPS_15_12_2021_positive_annotated.pickle")
-
-train, val, test = split_into_train_and_val(library_spectra, 10000, 100000)
-
-pickle.dump(train, open("C:/Users/jonge094/PycharmProjects/PhD_MS2Query/ms2query/data/hot_topics_metabolomics/training_spectra.pickle","wb"))
-pickle.dump(val, open("C:/Users/jonge094/PycharmProjects/PhD_MS2Query/ms2query/data/hot_topics_metabolomics/training_spectra.pickle","wb"))
-pickle.dump(test, open("C:/Users/jonge094/PycharmProjects/PhD_MS2Query/ms2query/data/hot_topics_metabolomics/training_spectra.pickle","wb"))
+import hashlib
+import json
+import os
+from typing import Dict, List, Tuple
+import h5py
+import numpy as np
+import pandas as pd
+from spectrum_store import INCHIKEY14_COLUMN, SpectrumStore, load_metadata, load_pickled_file
+
+SPLIT_NAMES = ("train", "val", "test")
+SPLIT_MANIFEST_FILE = "split_manifest.json"
+# Attribute of a saved model with the split_manifest_hash of the splits it was trained on
+MODEL_SPLIT_ATTRIBUTE = "split_manifest_sha256"
+
+
+def split_into_train_and_val(all_spectra, nr_of_val, nr_of_test, seed=42):
+    """Split all_spectra randomly into a train, validation and test set"""
+    train_ids, val_ids, test_ids = split_indices(len(all_spectra), nr_of_val, nr_of_test, seed)
+    train_split = [all_spectra[i] for i in train_ids]
+    val_split = [all_spectra[i] for i in val_ids]
+    test_split = [all_spectra[i] for i in test_ids]
+    return train_split, val_split, test_split
+
+
+def split_indices(n_spectra: int, nr_of_val: int, nr_of_test: int,
+                  seed: int = 42) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Split the spectrum indices 0..n_spectra-1 with a single seeded permutation
+
+    Returns the sorted train, validation and test indices.
+    """
+    assert nr_of_val + nr_of_test <= n_spectra, "Cannot select more validation and test spectra than available"
+    permutation = np.random.default_rng(seed).permutation(n_spectra)
+    test_ids = permutation[:nr_of_test]
+    val_ids = permutation[nr_of_test:nr_of_test + nr_of_val]
+    train_ids = permutation[nr_of_test + nr_of_val:]
+    return np.sort(train_ids), np.sort(val_ids), np.sort(test_ids)
+
+
+def split_indices_by_inchikey(inchikeys14, nr_of_val: int, nr_of_test: int,
+                              seed: int = 42) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Split the spectrum indices so that all spectra of an InChIKey14 end up in the same set
+
+    The InChIKeys are added in random order to the test set until it contains at least nr_of_test
+    spectra, then to the validation set until it contains at least nr_of_val spectra.
+    Returns the sorted train, validation and test indices.
+    """
+    group_of_spectrum, unique_inchikeys = pd.factorize(pd.Series(inchikeys14), use_na_sentinel=True)
+    if (group_of_spectrum == -1).any():
+        raise ValueError(f"{(group_of_spectrum == -1).sum()} spectra do not have an InChIKey, "
+                         "these cannot be split by InChIKey")
+    group_sizes = np.bincount(group_of_spectrum, minlength=len(unique_inchikeys))
+    permutation = np.random.default_rng(seed).permutation(len(unique_inchikeys))
+    n_spectra_before = np.cumsum(group_sizes[permutation]) - group_sizes[permutation]
+
+    # 0 = train, 1 = validation, 2 = test
+    group_split = np.zeros(len(unique_inchikeys), dtype=np.int8)
+    is_test = n_spectra_before < nr_of_test
+    group_split[permutation[is_test]] = 2
+    n_test = group_sizes[permutation[is_test]].sum()
+    group_split[permutation[~is_test & (n_spectra_before - n_test < nr_of_val)]] = 1
+
+    split_of_spectrum = group_split[group_of_spectrum]
+    return (np.where(split_of_spectrum == 0)[0],
+            np.where(split_of_spectrum == 1)[0],
+            np.where(split_of_spectrum == 2)[0])
+
+
+def write_split_manifest(store_directory: str, splits: Dict[str, np.ndarray], **settings):
+    """Store the split indices as .npy files in the spectrum store, with a json manifest
+
+    settings:
+        Settings used to create the splits (e.g. seed), these are stored in the manifest.
+    """
+    manifest = {"settings": settings,
+                "n_spectra": int(sum(len(indices) for indices in splits.values())),
+                "splits": {}}
+    for split_name, indices in splits.items():
+        filename = f"split_{split_name}.npy"
+        indices = np.asarray(indices, dtype=np.int64)
+        np.save(os.path.join(store_directory, filename), indices)
+        manifest["splits"][split_name] = {"file": filename,
+                                          "n_spectra": len(indices),
+                                          "sha256": hashlib.sha256(indices.tobytes()).hexdigest()}
+    with open(os.path.join(store_directory, SPLIT_MANIFEST_FILE), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+
+def _load_split_manifest(store_directory: str) -> dict:
+    with open(os.path.join(store_directory, SPLIT_MANIFEST_FILE), "r") as file:
+        return json.load(file)
+
+
+def load_split_indices(store_directory: str, split_name: str) -> np.ndarray:
+    """Load the indices of a split stored with write_split_manifest"""
+    manifest = _load_split_manifest(store_directory)
+    return np.load(os.path.join(store_directory, manifest["splits"][split_name]["file"]))
+
+
+def split_manifest_hash(store_directory: str) -> str:
+    """Hash of the indices of all splits of a spectrum store, it changes when any split changes"""
+    split_hashes = {split_name: split["sha256"]
+                    for split_name, split in _load_split_manifest(store_directory)["splits"].items()}
+    return hashlib.sha256(json.dumps(split_hashes, sort_keys=True).encode()).hexdigest()
+
+
+def load_split_inchikeys14(store_directory: str, split_name: str) -> np.ndarray:
+    """The unique InChIKeys (14 characters) of the spectra of a split, read from the metadata only"""
+    inchikeys14 = load_metadata(store_directory, [INCHIKEY14_COLUMN])[INCHIKEY14_COLUMN]
+    return np.unique(inchikeys14.iloc[load_split_indices(store_directory, split_name)].dropna().to_numpy(dtype=str))
+
+
+def load_split_spectra(store_directory: str, split_name: str) -> List:
+    """Create the spectra of one split (e.g. "test") of a spectrum store"""
+    return SpectrumStore(store_directory).get_spectra(load_split_indices(store_directory, split_name))
+
+
+def load_test_spectra_for_model(store_directory: str, ms2ds_model_file: str,
+                                legacy_test_spectra_file: str = None) -> List:
+    """Load the test spectra of the split the model was trained on
+
+    Models trained on the splits of the store have the split_manifest_hash stored in the model file (see
+    train_ms2deepscore_model.save_model_with_spectrum_binner), for those the test split of the store is
+    returned. A ValueError is raised if the splits changed after training. Models trained before the
+    splits were stored have no hash, their test spectra are loaded from legacy_test_spectra_file.
+    """
+    with h5py.File(ms2ds_model_file, mode="r") as file:
+        model_split_hash = file.attrs.get(MODEL_SPLIT_ATTRIBUTE)
+    if model_split_hash is None:
+        if legacy_test_spectra_file is None:
+            raise ValueError(f"{ms2ds_model_file} was not trained on the splits of {store_directory}")
+        return load_pickled_file(legacy_test_spectra_file)
+    if model_split_hash != split_manifest_hash(store_directory):
+        raise ValueError(f"The splits of {store_directory} changed after {ms2ds_model_file} was trained")
+    return load_split_spectra(store_directory, "test")
+
+
+if __name__ == "__main__":
+    # Spectrum store created with spectrum_store.py from ALL_GNPS_15_12_2021_positive_annotated.pickle
+    library_store = "C:/Users/jonge094/PycharmProjects/PhD_MS2Query/ms2query/data/libraries_and_models/gnps_15_12_2021/in_between_files/ALL_GNPS_15_12_2021_positive_annotated"
+    split_by_inchikey = False
+    seed = 42
+
+    inchikeys14 = load_metadata(library_store, [INCHIKEY14_COLUMN])[INCHIKEY14_COLUMN]
+    if split_by_inchikey:
+        train, val, test = split_indices_by_inchikey(inchikeys14, 10000, 100000, seed)
+    else:
+        train, val, test = split_indices(len(inchikeys14), 10000, 100000, seed)
+    write_split_manifest(library_store, dict(zip(SPLIT_NAMES, (train, val, test))),
+                         seed=seed, split_by_inchikey=split_by_inchikey)
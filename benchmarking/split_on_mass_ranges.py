@@ -1,36 +1,48 @@
-import random
-import os
-import pickle
-from calculate_binned_average_rmse import calculate_binned_average_rmse
-
-
-def load_pickled_file(filename: str):
-    with open(filename, 'rb') as file:
-        loaded_object = pickle.load(file)
-    return loaded_object
-
-
-def create_stratified_test_set(all_test_spectra):
-    bins = [0, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 5000]
-    spectra_split_on_mass = {}
-    for i in range(len(bins)-1):
-        min = bins[i]
-        max = bins[i+1]
-        selected_spectra = [spectrum for spectrum in all_test_spectra if spectrum.get("parent_mass") > min and spectrum.get("parent_mass") <= max]
-        spectra_split_on_mass[f"mass_{min}_{max}"] = random.sample(selected_spectra, k=1500)
-    return spectra_split_on_mass
-
-
-if __name__ == "__main__":
-    path_root = os.path.dirname(os.getcwd())
-    path_files_folder = os.path.join(path_root, "../../../data/hot_topics_metabolomics/")
-    testing_spectra = load_pickled_file(os.path.join(path_files_folder, "all_testing_spectra.pickle"))
-    spectra_split_on_mass = create_stratified_test_set(testing_spectra)
-
-    tanimoto_score_df = load_pickled_file(os.path.join(path_root,
-                                                       "../../../data/libraries_and_models/gnps_15_12_2021/in_between_files/GNPS_15_12_2021_pos_tanimoto_scores.pickle"))
-    ms2ds_model_file = os.path.join(path_files_folder, "ms2deepscore_model_with_spectrumbinner.hdf5")
-    for mass_range in spectra_split_on_mass:
-        testing_spectra = spectra_split_on_mass[mass_range]
-        binned_average_rmse = calculate_binned_average_rmse(testing_spectra, tanimoto_score_df, ms2ds_model_file)
-        print(mass_range, ": ", binned_average_rmse)
+import os
+import numpy as np
+from split_data import load_test_spectra_for_model
+from stratum_runner import FIGURES_DATA_FOLDER, run_strata, write_experiment_csv
+from stratification import (MASS_BINS, group_indices, mass_bin_labels, mass_bin_names, sample_per_stratum,
+                            spectra_table)
+
+
+def mass_range_label(mass_range: str) -> str:
+    """Label of a mass range as used in the figures, e.g. mass_0_200 -> 0-200 Da"""
+    _, min_mass, max_mass = mass_range.split("_")
+    return f"{min_mass}-{max_mass} Da"
+
+
+def create_stratified_test_index(all_test_spectra, k=1500, seed=42, mass_bins=MASS_BINS):
+    """Select the indices of k random spectra for each mass range (see stratification.MASS_BINS)"""
+    parent_masses = spectra_table(all_test_spectra, ["parent_mass"])["parent_mass"]
+    mass_groups = group_indices(np.arange(len(all_test_spectra)), mass_bin_labels(parent_masses, mass_bins))
+    # Use the order of the mass bins, not the order in which they occur in the spectra
+    mass_groups = {label: mass_groups.get(label, np.array([], dtype=int))
+                   for label in mass_bin_names(mass_bins)}
+    return sample_per_stratum(mass_groups, k, seed)
+
+
+def create_stratified_test_set(all_test_spectra, k=1500, seed=42, mass_bins=MASS_BINS):
+    """Select k random spectra for each mass range (see stratification.MASS_BINS)"""
+    spectra_split_on_mass = {}
+    for mass_range, selected in create_stratified_test_index(all_test_spectra, k, seed, mass_bins).items():
+        spectra_split_on_mass[mass_range] = [all_test_spectra[i] for i in selected]
+    return spectra_split_on_mass
+
+
+if __name__ == "__main__":
+    path_root = os.path.dirname(os.getcwd())
+    path_files_folder = os.path.join(path_root, "../../../data/hot_topics_metabolomics/")
+    library_store = os.path.join(path_root, "../../../data/libraries_and_models/gnps_15_12_2021/in_between_files/ALL_GNPS_15_12_2021_positive_annotated")
+    ms2ds_model_file = os.path.join(path_files_folder, "ms2deepscore_model_with_spectrumbinner.hdf5")
+    # Models trained before the splits were stored in the library are evaluated on their original test set
+    testing_spectra = load_test_spectra_for_model(library_store, ms2ds_model_file,
+                                                   os.path.join(path_files_folder, "all_testing_spectra.pickle"))
+    spectra_split_on_mass = create_stratified_test_set(testing_spectra)
+
+    tanimoto_scores_file = os.path.join(path_root,
+                                        "../../../data/libraries_and_models/gnps_15_12_2021/in_between_files/GNPS_15_12_2021_pos_tanimoto_scores")
+    rmse_per_mass_range = run_strata(spectra_split_on_mass, tanimoto_scores_file, ms2ds_model_file,
+                                     embedding_cache_directory=os.path.join(path_files_folder, "embedding_cache"))
+    write_experiment_csv(rmse_per_mass_range, os.path.join(FIGURES_DATA_FOLDER, "experiment_weight_ranges.csv"),
+                         "molecular_weight_range", "rmse", format_label=mass_range_label)
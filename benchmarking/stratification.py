@@ -0,0 +1,88 @@
+from typing import Dict, Iterable, List, Sequence
+import numpy as np
+import pandas as pd
+from matchms import Spectrum
+
+
+MASS_BINS = [0, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 5000]
+STRATIFICATION_COLUMNS = ("parent_mass", "inchikey", "instrument_type", "ionmode")
+
+
+def spectra_table(spectra: List[Spectrum], columns: Sequence[str] = STRATIFICATION_COLUMNS) -> pd.DataFrame:
+    """Collect the metadata needed for stratification of spectra in a single pass
+
+    The row of each spectrum is its position in spectra. An inchikey14 column is added if inchikey is
+    one of the columns. The metadata of a SpectrumStore can be used instead of this table.
+    """
+    table = pd.DataFrame([[spectrum.get(column) for column in columns] for spectrum in spectra],
+                         columns=list(columns))
+    if "inchikey" in table.columns:
+        table["inchikey14"] = table["inchikey"].str[:14]
+    return table
+
+
+def mass_bin_names(bins: Sequence[float] = MASS_BINS) -> List[str]:
+    """Names of the mass bins, in order"""
+    return [f"mass_{bins[i]}_{bins[i + 1]}" for i in range(len(bins) - 1)]
+
+
+def mass_bin_labels(parent_masses: Iterable[float], bins: Sequence[float] = MASS_BINS) -> pd.Series:
+    """Label each parent mass with its bin "mass_{min}_{max}", with min < parent mass <= max
+
+    Parent masses outside of the bins (or missing) get no label (None).
+    """
+    parent_masses = np.asarray(parent_masses, dtype=float)
+    labels = np.array(mass_bin_names(bins) + [None], dtype=object)
+    bin_idx = np.searchsorted(bins, parent_masses, side="left") - 1
+    outside = (bin_idx < 0) | (bin_idx >= len(bins) - 1) | np.isnan(parent_masses)
+    bin_idx[outside] = len(bins) - 1
+    return pd.Series(labels[bin_idx])
+
+
+def load_superclasses(classifiers_file: str) -> pd.DataFrame:
+    """Load the ClassyFire superclass of each InChIKey14 from the classifiers file
+
+    Returns a dataframe with columns inchikey14 and cf_superclass. An InChIKey14 can have multiple
+    superclasses (for different stereoisomers).
+    """
+    classifiers_df = pd.read_csv(classifiers_file, sep="\t")[["cf_superclass", "inchi_key"]]
+    classifiers_df["inchikey14"] = classifiers_df["inchi_key"].str[:14]
+    return classifiers_df[["inchikey14", "cf_superclass"]].drop_duplicates()
+
+
+def superclass_labels(inchikeys14: Iterable[str], superclasses_df: pd.DataFrame) -> pd.DataFrame:
+    """Join the superclasses onto the spectra with a single merge on InChIKey14
+
+    Returns a dataframe with columns spectrum_index and cf_superclass, with one row for each
+    superclass of each spectrum, ordered by spectrum_index. Spectra without superclass are left out.
+    """
+    spectra_df = pd.DataFrame({"spectrum_index": np.arange(len(inchikeys14)),
+                               "inchikey14": list(inchikeys14)})
+    labels = spectra_df.merge(superclasses_df.dropna(subset=["cf_superclass"]), on="inchikey14", how="inner")
+    return labels.sort_values("spectrum_index", kind="stable")[["spectrum_index", "cf_superclass"]]
+
+
+def group_indices(spectrum_indices: Iterable[int], labels: Iterable) -> Dict[str, np.ndarray]:
+    """Group the spectrum indices per stratum label (e.g. mass bin, superclass, instrument or ionmode)
+
+    Spectra without label (None or NaN) are left out. Within a stratum the original order is kept.
+    """
+    grouped = pd.Series(np.asarray(spectrum_indices)).groupby(pd.Series(list(labels)), sort=False, dropna=True)
+    return {label: indices.to_numpy() for label, indices in grouped}
+
+
+def sample_per_stratum(groups: Dict[str, np.ndarray], k: int, seed: int = 42,
+                       skip_smaller: bool = False) -> Dict[str, np.ndarray]:
+    """Select k random spectrum indices (without replacement) of each stratum
+
+    Strata with fewer than k spectra raise a ValueError, unless skip_smaller is True.
+    """
+    rng = np.random.default_rng(seed)
+    samples = {}
+    for label, indices in groups.items():
+        if len(indices) < k:
+            if skip_smaller:
+                continue
+            raise ValueError(f"Stratum {label} contains {len(indices)} spectra, cannot select {k}")
+        samples[label] = rng.choice(indices, size=k, replace=False)
+    return samples
@@ -0,0 +1,115 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from matchms import Spectrum
+from ms2deepscore.models import load_model
+from calculate_binned_average_rmse import (
+    calculate_binned_average_rmse_from_embeddings, compute_ms2ds_embeddings)
+from embedding_cache import EmbeddingCache
+from inchikey_index import InchikeyIndex
+from tanimoto_store import load_tanimoto_scores
+
+
+FIGURES_DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "figures_data")
+
+# Loaded once in each worker process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(tanimoto_scores_file: str, ms2ds_model_file: str = None, n_threads: int = None):
+    if n_threads is not None:
+        # Otherwise the model of every worker uses all cores
+        tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tanimoto_scores = load_tanimoto_scores(tanimoto_scores_file)
+    _worker_state["tanimoto_scores"] = tanimoto_scores
+    _worker_state["inchikey_index"] = InchikeyIndex.from_tanimoto_df(tanimoto_scores)
+    if ms2ds_model_file is not None:
+        _worker_state["ms2ds_model"] = load_model(ms2ds_model_file)
+
+
+def _evaluate_stratum(stratum: str, spectra: List[Spectrum], embeddings: np.ndarray = None,
+                      missing: np.ndarray = None):
+    """Returns the binned average RMSE, and the embeddings of the missing spectra if they were embedded here"""
+    if embeddings is None:
+        embeddings = compute_ms2ds_embeddings(spectra, _worker_state["ms2ds_model"])
+        new_embeddings = embeddings
+    elif missing is not None and len(missing) > 0:
+        new_embeddings = compute_ms2ds_embeddings([spectra[i] for i in missing], _worker_state["ms2ds_model"])
+        embeddings = embeddings.copy()
+        embeddings[missing] = new_embeddings
+    else:
+        new_embeddings = None
+    binned_average_rmse = calculate_binned_average_rmse_from_embeddings(
+        spectra, _worker_state["tanimoto_scores"], embeddings, _worker_state["inchikey_index"])
+    return stratum, binned_average_rmse, new_embeddings
+
+
+def run_strata(strata: Dict[str, List[Spectrum]], tanimoto_scores_file: str, ms2ds_model_file: str,
+               n_workers: int = None, embedding_cache_directory: str = None,
+               embeddings: Dict[str, np.ndarray] = None) -> Dict[str, float]:
+    """Calculate the binned average RMSE of each stratum in parallel
+
+    Each worker process loads the model and the Tanimoto scores once, and uses its share of the cpus for
+    tensorflow. Use a memory-mapped Tanimoto store
+    (see tanimoto_store.py) for tanimoto_scores_file, so all workers share one copy in the page cache.
+
+    strata:
+        Dictionary with the test spectra of each stratum.
+    n_workers:
+        Number of worker processes, by default one per stratum up to the number of cpus.
+    embedding_cache_directory:
+        If given, the cached embeddings are read from an EmbeddingCache in this folder. The workers only
+        embed the spectra that are not cached (the model is only loaded if there are any), and the main
+        process adds their embeddings to the cache.
+    embeddings:
+        Optional precomputed embeddings of the spectra of each stratum, in the same order. The model and
+        the embedding cache are not used.
+    """
+    if not strata:
+        return {}
+    if n_workers is None:
+        n_workers = min(len(strata), os.cpu_count())
+    embedding_cache = None
+    missing = {stratum: None for stratum in strata}
+    if embeddings is not None:
+        ms2ds_model_file = None
+    elif embedding_cache_directory is not None:
+        embedding_cache = EmbeddingCache(embedding_cache_directory, ms2ds_model_file)
+        embeddings = {}
+        for stratum, spectra in strata.items():
+            embeddings[stratum], missing[stratum] = embedding_cache.lookup(spectra)
+        if not any(len(missing_indices) > 0 for missing_indices in missing.values()):
+            ms2ds_model_file = None
+    else:
+        embeddings = {stratum: None for stratum in strata}
+    results = {}
+    # Spawn instead of fork, forking a process that already imported tensorflow is not safe
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker,
+                             initargs=(tanimoto_scores_file, ms2ds_model_file,
+                                       max(1, os.cpu_count() // n_workers))) as executor:
+        futures = [executor.submit(_evaluate_stratum, stratum, spectra, embeddings[stratum], missing[stratum])
+                   for stratum, spectra in strata.items()]
+        for future in as_completed(futures):
+            stratum, binned_average_rmse, new_embeddings = future.result()
+            if embedding_cache is not None and new_embeddings is not None:
+                # Only the main process writes to the cache
+                embedding_cache.add([strata[stratum][i] for i in missing[stratum]], new_embeddings)
+            print(stratum, ": ", binned_average_rmse)
+            results[stratum] = binned_average_rmse
+    return {stratum: results[stratum] for stratum in strata}
+
+
+def write_experiment_csv(results: Dict[str, float], filename: str, label_column: str, value_column: str,
+                         format_label: Callable[[str], str] = None, decimals: int = 3):
+    """Write results in the format of figures_data/experiment_*.csv (";" separated, utf-8 with BOM)"""
+    labels = list(results.keys())
+    if format_label is not None:
+        labels = [format_label(label) for label in labels]
+    experiment_df = pd.DataFrame({label_column: labels,
+                                  value_column: [round(value, decimals) for value in results.values()]})
+    experiment_df.to_csv(filename, sep=";", index=False, encoding="utf-8-sig")
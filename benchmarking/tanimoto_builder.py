@@ -0,0 +1,197 @@
+"""Build the Tanimoto score matrix of a spectrum library from RDKit fingerprints.
+
+Each unique InChIKey14 is fingerprinted once (from the most common InChI, or SMILES, of its spectra)
+and the fingerprints are stored bit-packed as uint64 words. The Tanimoto scores are computed with a
+vectorized popcount in blocks of rows, spread over a pool of processes, and written as a Tanimoto
+store (see tanimoto_store.py). The fingerprints are stored next to it (<output>_fingerprints.npy),
+so for a new library release only the scores of the new InChIKeys against all InChIKeys are computed:
+    python tanimoto_builder.py ALL_GNPS_15_12_2021_positive_annotated GNPS_15_12_2021_pos_tanimoto_scores
+    python tanimoto_builder.py ALL_GNPS_new_release new_release_tanimoto_scores --previous GNPS_15_12_2021_pos_tanimoto_scores
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+import numpy as np
+import pandas as pd
+from rdkit import Chem, DataStructs
+from inchikey_index import InchikeyIndex
+from spectrum_store import INCHIKEY14_COLUMN, load_metadata
+from tanimoto_store import (SUPPORTED_DTYPES, load_tanimoto_matrix, quantize_scores,
+                            tanimoto_store_files)
+
+
+FINGERPRINT_BITS = 2048
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+# Fingerprints of all InChIKeys, set in each worker process by _init_worker
+_worker_fingerprints = None
+
+
+def fingerprints_file(base_filename: str) -> str:
+    """File name of the packed fingerprints stored next to a Tanimoto store"""
+    return tanimoto_store_files(base_filename)[0][:-len(".npy")] + "_fingerprints.npy"
+
+
+def structures_per_inchikey14(metadata: pd.DataFrame) -> pd.Series:
+    """The most common InChI of the spectra of each InChIKey14, or the most common SMILES if none has an InChI
+
+    metadata:
+        Metadata of a spectrum store (see load_metadata), with the inchikey14 column and inchi and/or smiles.
+    """
+    structures = pd.Series(np.nan, index=metadata.index, dtype=object)
+    for column in ("smiles", "inchi"):
+        if column in metadata.columns:
+            values = metadata[column].astype(object)
+            has_value = values.notna() & (values.astype(str).str.len() > 0)
+            structures[has_value] = values[has_value]
+    structures = pd.DataFrame({"inchikey14": metadata[INCHIKEY14_COLUMN], "structure": structures}).dropna()
+    structures["is_inchi"] = structures["structure"].str.startswith("InChI=")
+    counts = structures.groupby(["inchikey14", "is_inchi", "structure"]).size().rename("count").reset_index()
+    counts = counts.sort_values(["inchikey14", "is_inchi", "count"], ascending=[True, False, False], kind="stable")
+    return counts.drop_duplicates("inchikey14").set_index("inchikey14")["structure"]
+
+
+def packed_fingerprint(structure: str, n_bits: int = FINGERPRINT_BITS) -> np.ndarray:
+    """RDKit (daylight-like) fingerprint of an InChI or SMILES packed in uint64 words, all zero if RDKit fails"""
+    if structure.startswith("InChI="):
+        mol = Chem.MolFromInchi(structure)
+    else:
+        mol = Chem.MolFromSmiles(structure)
+    bits = np.zeros(n_bits, dtype=np.uint8)
+    if mol is not None:
+        DataStructs.ConvertToNumpyArray(Chem.RDKFingerprint(mol, fpSize=n_bits), bits)
+    return np.packbits(bits).view(np.uint64)
+
+
+def _fingerprint_chunk(structures: List[str], n_bits: int) -> np.ndarray:
+    return np.array([packed_fingerprint(structure, n_bits) for structure in structures]).reshape(-1, n_bits // 64)
+
+
+def compute_fingerprints(structures: List[str], n_bits: int = FINGERPRINT_BITS, n_workers: int = None,
+                         chunk_size: int = 1000) -> np.ndarray:
+    """Packed fingerprints of all structures, array of shape (n_structures, n_bits / 64)"""
+    assert n_bits % 64 == 0, "Expected the number of bits to be a multiple of 64"
+    chunks = [structures[start:start + chunk_size] for start in range(0, len(structures), chunk_size)]
+    if not chunks:
+        return np.empty((0, n_bits // 64), dtype=np.uint64)
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        return np.vstack(list(executor.map(_fingerprint_chunk, chunks, [n_bits] * len(chunks))))
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """Number of set bits of each uint64 word"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    return _POPCOUNT_TABLE[words.view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+def tanimoto_block(fingerprints_rows: np.ndarray, fingerprints_cols: np.ndarray) -> np.ndarray:
+    """Tanimoto scores of all pairs of two sets of packed fingerprints, 0 for pairs of empty fingerprints"""
+    n_bits_rows = popcount(fingerprints_rows).sum(axis=1, dtype=np.int32)
+    n_bits_cols = popcount(fingerprints_cols).sum(axis=1, dtype=np.int32)
+    intersection = np.zeros((len(fingerprints_rows), len(fingerprints_cols)), dtype=np.int32)
+    # One word at a time, so the temporary arrays are only n_rows x n_cols
+    for word in range(fingerprints_rows.shape[1]):
+        intersection += popcount(fingerprints_rows[:, word, np.newaxis] & fingerprints_cols[np.newaxis, :, word])
+    union = n_bits_rows[:, np.newaxis] + n_bits_cols[np.newaxis, :] - intersection
+    return np.divide(intersection, union, out=np.zeros(union.shape, dtype=np.float32), where=union > 0)
+
+
+def _init_worker(fingerprints: np.ndarray):
+    global _worker_fingerprints
+    _worker_fingerprints = fingerprints
+
+
+def _score_rows(start: int, stop: int) -> np.ndarray:
+    return tanimoto_block(_worker_fingerprints[start:stop], _worker_fingerprints)
+
+
+def write_tanimoto_store(fingerprints: np.ndarray, inchikeys: List[str], base_filename: str,
+                         dtype: str = "float32", previous_base: str = None, rows_per_block: int = 256,
+                         n_workers: int = None):
+    """Compute the Tanimoto scores of all pairs of fingerprints and store them as a Tanimoto store
+
+    previous_base:
+        Tanimoto store of which the InChIKeys are the first InChIKeys of inchikeys, in the same order.
+        Its scores are copied, only the scores of the other InChIKeys against all InChIKeys are computed.
+    """
+    assert dtype in SUPPORTED_DTYPES, f"Expected dtype to be one of {SUPPORTED_DTYPES}"
+    assert len(fingerprints) == len(inchikeys), "Expected one fingerprint per InChIKey"
+    inchikey_index = InchikeyIndex(inchikeys)
+    matrix_file, index_file = tanimoto_store_files(base_filename)
+    n_inchikeys = len(inchikeys)
+    stored = np.lib.format.open_memmap(matrix_file, mode="w+", dtype=dtype, shape=(n_inchikeys, n_inchikeys))
+
+    first_new_row = 0
+    if previous_base is not None:
+        previous = load_tanimoto_matrix(previous_base)
+        first_new_row = len(previous.index)
+        assert previous.index.equals(inchikey_index.inchikeys[:first_new_row]), \
+            "Expected the InChIKeys of the previous store first, in the same order"
+        assert previous.values.dtype == np.dtype(dtype), "Expected the same dtype as the previous store"
+        for start in range(0, first_new_row, rows_per_block):
+            stop = min(start + rows_per_block, first_new_row)
+            stored[start:stop, :first_new_row] = previous.values[start:stop]
+
+    starts = list(range(first_new_row, n_inchikeys, rows_per_block))
+    stops = [min(start + rows_per_block, n_inchikeys) for start in starts]
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(fingerprints,)) as executor:
+        for start, stop, block in zip(starts, stops, executor.map(_score_rows, starts, stops)):
+            block = quantize_scores(block, dtype)
+            stored[start:stop] = block
+            # The scores of the previous InChIKeys against the new ones, the matrix is symmetric
+            stored[:first_new_row, start:stop] = block[:, :first_new_row].T
+    stored.flush()
+    del stored
+    np.save(fingerprints_file(base_filename), fingerprints)
+    inchikey_index.save(index_file)
+
+
+def build_tanimoto_store(structures: pd.Series, base_filename: str, dtype: str = "float32",
+                         previous_base: str = None, n_bits: int = FINGERPRINT_BITS, **kwargs):
+    """Fingerprint the structures and store the Tanimoto scores of all pairs as a Tanimoto store
+
+    structures:
+        The InChI or SMILES per InChIKey14 (see structures_per_inchikey14).
+    previous_base:
+        Tanimoto store built before by this function. Its InChIKeys and fingerprints are reused and the
+        scores of the InChIKeys in structures that are not in it are added. InChIKeys of the previous store
+        that are not in structures are kept.
+    kwargs:
+        Passed to write_tanimoto_store (rows_per_block, n_workers).
+    """
+    if previous_base is None:
+        inchikeys = list(structures.index)
+        fingerprints = compute_fingerprints(list(structures), n_bits, kwargs.get("n_workers"))
+    else:
+        previous_inchikeys = InchikeyIndex.load(tanimoto_store_files(previous_base)[1]).inchikeys
+        previous_fingerprints = np.load(fingerprints_file(previous_base))
+        assert previous_fingerprints.shape[1] * 64 == n_bits, "Expected the fingerprints of the previous store"
+        new_structures = structures[~structures.index.isin(previous_inchikeys)]
+        print(f"Computing the scores of {len(new_structures)} new InChIKeys against all "
+              f"{len(previous_inchikeys) + len(new_structures)} InChIKeys")
+        inchikeys = list(previous_inchikeys) + list(new_structures.index)
+        fingerprints = np.vstack([previous_fingerprints,
+                                  compute_fingerprints(list(new_structures), n_bits, kwargs.get("n_workers"))])
+    n_empty = int(np.sum(~fingerprints.any(axis=1)))
+    if n_empty:
+        print(f"{n_empty} structures could not be fingerprinted (or have an empty fingerprint), "
+              "their scores are 0")
+    write_tanimoto_store(fingerprints, inchikeys, base_filename, dtype, previous_base, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the Tanimoto scores of the InChIKeys of a spectrum store.")
+    parser.add_argument("library_store", help="Spectrum store with the inchi and/or smiles of the spectra.")
+    parser.add_argument("output_base", help="Base file name of the Tanimoto store that is written.")
+    parser.add_argument("--dtype", default="float32", choices=SUPPORTED_DTYPES)
+    parser.add_argument("--previous", default=None, help="Tanimoto store of a previous release to update.")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--rows_per_block", type=int, default=256)
+    args = parser.parse_args()
+
+    metadata = load_metadata(args.library_store)
+    build_tanimoto_store(structures_per_inchikey14(metadata), args.output_base, args.dtype, args.previous,
+                         n_workers=args.workers, rows_per_block=args.rows_per_block)
+    print("Stored Tanimoto scores in", os.path.abspath(tanimoto_store_files(args.output_base)[0]))
@@ -0,0 +1,176 @@
+"""Compact, memory-mapped storage of the Tanimoto score matrix.
+
+The Tanimoto scores are stored as a .npy file, which is memory-mapped when loaded, together
+with a sidecar text file containing the InChIKeys of 14 characters. Only the pages of the matrix
+that are actually used are read from disk, and processes reading the same file share the OS page cache.
+
+Convert the pickled dataframe once by running this file:
+    python tanimoto_store.py GNPS_15_12_2021_pos_tanimoto_scores.pickle GNPS_15_12_2021_pos_tanimoto_scores float32
+
+float16 and uint8 halve or quarter the size, but move scores by up to 5e-4 or 2e-3. Exact bin edges such as
+0.2 or 0.5 are common Tanimoto scores and would then end up in the bin below, so quantize_scores keeps each
+score in its bin of SCORE_BIN_EDGES (the reference score bins of the evaluation), and the binned RMSE counts
+the same pairs per bin as with the pickled scores.
+"""
+import os
+import pickle
+import sys
+from typing import Union
+import numpy as np
+import pandas as pd
+from inchikey_index import InchikeyIndex, gather_block
+
+
+SUPPORTED_DTYPES = ("float32", "float16", "uint8")
+# uint8 stores the scores quantized in steps of 1/255
+UINT8_SCALE = 255
+# Bins of the reference scores in tanimoto_dependent_losses, quantized scores stay in the same bin
+SCORE_BIN_EDGES = np.linspace(0, 1.0, 11)
+
+
+def tanimoto_store_files(base_filename: str):
+    """Return the file names of the score matrix and the InChIKey index of a Tanimoto store"""
+    if base_filename.endswith(".npy"):
+        base_filename = base_filename[:-len(".npy")]
+    return base_filename + ".npy", base_filename + "_inchikeys.txt"
+
+
+class TanimotoMatrix:
+    """Memory-mapped Tanimoto scores with the InChIKeys (14 characters) of the rows and columns
+
+    values:
+        Square (memory-mapped) array with the stored, possibly quantized, scores.
+    inchikey_index:
+        InchikeyIndex of the rows and columns of values.
+    """
+    def __init__(self, values: np.ndarray, inchikey_index: InchikeyIndex):
+        assert values.shape == (len(inchikey_index), len(inchikey_index)), \
+            "Expected a square matrix with one row per InChIKey"
+        self.values = values
+        self.inchikey_index = inchikey_index
+
+    @property
+    def index(self) -> pd.Index:
+        return self.inchikey_index.inchikeys
+
+    @property
+    def columns(self) -> pd.Index:
+        return self.inchikey_index.inchikeys
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def gather(self, row_idx: np.ndarray, col_idx: np.ndarray = None) -> np.ndarray:
+        """Return the scores of rows row_idx and columns col_idx (default row_idx) as floats"""
+        return self._dequantize(gather_block(self.values, row_idx, col_idx))
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """Return the scores as dataframe, with as index and columns the InChIKeys
+
+        For float32 and float16 stores the dataframe is a view on the memory-mapped values.
+        uint8 stores are dequantized, which loads the full matrix into memory.
+        """
+        values = self.values
+        if values.dtype == np.uint8:
+            values = self._dequantize(values)
+        return pd.DataFrame(values, index=self.index, columns=self.columns, copy=False)
+
+    def _dequantize(self, values: np.ndarray) -> np.ndarray:
+        return dequantize_scores(values)
+
+
+def gather_scores(tanimoto_scores: Union[pd.DataFrame, TanimotoMatrix],
+                  row_idx: np.ndarray, col_idx: np.ndarray = None) -> np.ndarray:
+    """Gather a block of scores from a Tanimoto dataframe or a (memory-mapped) TanimotoMatrix"""
+    if isinstance(tanimoto_scores, TanimotoMatrix):
+        # Only reads the needed rows from disk
+        return tanimoto_scores.gather(row_idx, col_idx)
+    return gather_block(tanimoto_scores.to_numpy(), row_idx, col_idx)
+
+
+def save_tanimoto_matrix(tanimoto_df: pd.DataFrame, base_filename: str,
+                         dtype: str = "float32", rows_per_block: int = 1000):
+    """Store a dataframe with Tanimoto scores as .npy file with a sidecar InChIKey index
+
+    tanimoto_df:
+        Dataframe with as index and columns Inchikeys of 14 letters, in the same order.
+    base_filename:
+        File name without extension, base_filename.npy and base_filename_inchikeys.txt are created.
+    dtype:
+        One of "float32", "float16" (error < 5e-4) or "uint8" (error < 2e-3). Scores close to an edge
+        of SCORE_BIN_EDGES can move by one more step, so they stay in their bin (see quantize_scores).
+    """
+    assert dtype in SUPPORTED_DTYPES, f"Expected dtype to be one of {SUPPORTED_DTYPES}"
+    assert tanimoto_df.index.equals(tanimoto_df.columns), \
+        "Expected the same InChIKeys in the same order in index and columns"
+    matrix_file, index_file = tanimoto_store_files(base_filename)
+    inchikey_index = InchikeyIndex.from_tanimoto_df(tanimoto_df)
+
+    scores = tanimoto_df.to_numpy()
+    n_inchikeys = scores.shape[0]
+    stored = np.lib.format.open_memmap(matrix_file, mode="w+", dtype=dtype, shape=(n_inchikeys, n_inchikeys))
+    for start in range(0, n_inchikeys, rows_per_block):
+        stored[start:start + rows_per_block] = quantize_scores(scores[start:start + rows_per_block], dtype)
+    stored.flush()
+    del stored
+    inchikey_index.save(index_file)
+
+
+def quantize_scores(scores: np.ndarray, dtype: str, bin_edges=SCORE_BIN_EDGES) -> np.ndarray:
+    """Convert Tanimoto scores to the dtype they are stored as
+
+    Rounding can move a score across an edge of bin_edges, e.g. 0.2 is 0.19995 as float16. Such scores
+    are moved by one step of the dtype back to the side of the edge of the original score, so
+    np.digitize(scores, bin_edges) is the same for the original and the (dequantized) stored scores.
+    Use bin_edges=None to only round.
+    """
+    if dtype == "uint8":
+        quantized = np.rint(np.clip(scores, 0, 1) * UINT8_SCALE).astype(np.uint8)
+    else:
+        quantized = np.asarray(scores).astype(dtype)
+    if bin_edges is None:
+        return quantized
+    bin_edges = np.asarray(bin_edges, dtype=np.float64)
+    expected_bins = np.digitize(scores, bin_edges)
+    for _ in range(4):
+        moved = np.digitize(dequantize_scores(quantized), bin_edges) - expected_bins
+        if not moved.any():
+            return quantized
+        # One step down for scores that moved to a higher bin, one step up for scores that moved to a lower bin
+        if dtype == "uint8":
+            quantized[moved > 0] -= 1
+            quantized[moved < 0] += 1
+        else:
+            quantized[moved > 0] = np.nextafter(quantized[moved > 0], np.array(-np.inf, dtype=dtype))
+            quantized[moved < 0] = np.nextafter(quantized[moved < 0], np.array(np.inf, dtype=dtype))
+    raise ValueError(f"The bin edges are too close together to keep the scores in their bins as {dtype}")
+
+
+def dequantize_scores(values: np.ndarray) -> np.ndarray:
+    """Convert stored Tanimoto scores back to floats"""
+    if values.dtype == np.uint8:
+        return values.astype(np.float32) / UINT8_SCALE
+    return values
+
+
+def load_tanimoto_matrix(base_filename: str) -> TanimotoMatrix:
+    """Memory-map a Tanimoto matrix stored with save_tanimoto_matrix"""
+    matrix_file, index_file = tanimoto_store_files(base_filename)
+    values = np.load(matrix_file, mmap_mode="r")
+    return TanimotoMatrix(values, InchikeyIndex.load(index_file))
+
+
+def load_tanimoto_scores(filename: str) -> Union[pd.DataFrame, TanimotoMatrix]:
+    """Load the Tanimoto scores from a pickled dataframe (.pickle) or from a Tanimoto store"""
+    if filename.endswith(".pickle"):
+        with open(filename, "rb") as file:
+            return pickle.load(file)
+    return load_tanimoto_matrix(filename)
+
+
+if __name__ == "__main__":
+    pickle_file, output_base = sys.argv[1], sys.argv[2]
+    output_dtype = sys.argv[3] if len(sys.argv) > 3 else "float32"
+    save_tanimoto_matrix(load_tanimoto_scores(pickle_file), output_base, dtype=output_dtype)
+    print("Stored Tanimoto scores in", os.path.abspath(tanimoto_store_files(output_base)[0]))
@@ -0,0 +1,40 @@
+import json
+import sys
+import pandas as pd
+import pytest
+from benchmark_training import benchmark_training, main, synthetic_training_data
+
+
+def test_benchmark_needs_a_timed_step():
+    spectra, tanimoto_df = synthetic_training_data(20, 10)
+    with pytest.raises(ValueError, match="At least 2 steps"):
+        benchmark_training(spectra, tanimoto_df, steps=1, batch_size=4, embedding_dim=8, base_dims=[16])
+
+
+def test_benchmark_needs_a_batch_of_inchikeys():
+    spectra, tanimoto_df = synthetic_training_data(20, 5)
+    with pytest.raises(ValueError, match="fewer InChIKeys"):
+        benchmark_training(spectra, tanimoto_df, steps=5, batch_size=32, embedding_dim=8, base_dims=[16])
+
+
+def test_benchmark_report_and_profile(tmp_path, monkeypatch):
+    report_file = tmp_path / "training_benchmarks.json"
+    arguments = ["benchmark_training.py", "--steps", "2", "--batch_size", "4", "--embedding_dim", "8",
+                 "--base_dims", "16", "--n_spectra", "40", "--n_inchikeys", "10", "--profile", "cprofile",
+                 "--report", str(report_file)]
+    monkeypatch.setattr(sys, "argv", arguments)
+    main()
+    main()
+
+    with open(report_file, "r") as file:
+        reports = json.load(file)
+    assert len(reports) == 2
+    timings = reports[0]["timings_seconds"]
+    for stage in ("binning", "generator_setup", "model_setup", "batch_generation", "pair_selection",
+                  "augmentation", "first_train_step", "train_steps", "checkpoint_write"):
+        assert timings[stage] >= 0
+    assert timings["pair_selection"] + timings["augmentation"] <= timings["batch_generation"]
+    assert reports[0]["samples_per_second"] > 0
+    assert reports[0]["settings"]["steps"] == 2
+    assert len(pd.read_csv(tmp_path / "training_benchmarks.csv")) == 2
+    assert len(list(tmp_path.glob("training_benchmarks_*.prof"))) >= 1
@@ -0,0 +1,62 @@
+import numpy as np
+from matchms import Spectrum
+from ms2deepscore import SpectrumBinner
+from binned_spectra_store import load_or_create_binned_spectra, load_spectrum_binner, save_spectrum_binner
+
+
+def _spectra(n, seed):
+    rng = np.random.default_rng(seed)
+    return [Spectrum(mz=np.sort(rng.uniform(10.0, 1000.0, 10)), intensities=rng.uniform(0.1, 1.0, 10),
+                     metadata={"inchikey": f"{chr(65 + i % 26) * 14}-UHFFFAOYSA-N"}) for i in range(n)]
+
+
+def _assert_same_binned_peaks(binned_spectra, expected):
+    assert len(binned_spectra) == len(expected)
+    for binned, expected_binned in zip(binned_spectra, expected):
+        assert list(binned.binned_peaks.keys()) == list(expected_binned.binned_peaks.keys())
+        # The weights are stored as float32
+        assert np.allclose(list(binned.binned_peaks.values()), list(expected_binned.binned_peaks.values()))
+
+
+SETTINGS = dict(number_of_bins=100, mz_min=10.0, mz_max=1000.0, peak_scaling=0.5, allowed_missing_percentage=100.0)
+
+
+def test_binned_spectra_are_reused_for_the_same_inputs(tmp_path):
+    train, val = _spectra(20, 0), _spectra(5, 1)
+    binner, binned_train, binned_val = load_or_create_binned_spectra(train, val, str(tmp_path), **SETTINGS)
+    expected = binner.transform(train)
+    modified = (tmp_path / "train" / "weights.npy").stat().st_mtime_ns
+    _, binned_train, _ = load_or_create_binned_spectra(train, val, str(tmp_path), **SETTINGS)
+    assert (tmp_path / "train" / "weights.npy").stat().st_mtime_ns == modified
+    _assert_same_binned_peaks(binned_train, expected)
+
+
+def test_binned_spectra_are_rebuilt_for_other_spectra_or_settings(tmp_path):
+    train, val = _spectra(20, 0), _spectra(5, 1)
+    load_or_create_binned_spectra(train, val, str(tmp_path), **SETTINGS)
+
+    new_train = _spectra(30, 2)
+    binner, binned_train, binned_val = load_or_create_binned_spectra(new_train, val, str(tmp_path), **SETTINGS)
+    assert len(binned_train) == 30
+    _assert_same_binned_peaks(binned_train, binner.transform(new_train))
+
+    settings = {**SETTINGS, "number_of_bins": 50}
+    binner, binned_train, _ = load_or_create_binned_spectra(new_train, val, str(tmp_path), **settings)
+    assert binner.number_of_bins == 50
+    _assert_same_binned_peaks(binned_train, binner.transform(new_train))
+
+
+def test_spectrum_binner_round_trips_with_additional_metadata(tmp_path):
+    train = _spectra(20, 0)
+    for spectrum in train:
+        spectrum.set("precursor_mz", 500.0)
+    spectrum_binner = SpectrumBinner(100, mz_min=10.0, mz_max=1000.0, allowed_missing_percentage=100.0,
+                                     additional_metadata=["precursor_mz"])
+    spectrum_binner.fit_transform(train)
+    save_spectrum_binner(spectrum_binner, str(tmp_path / "spectrum_binner.json"))
+
+    loaded = load_spectrum_binner(str(tmp_path / "spectrum_binner.json"))
+    assert loaded.__dict__ == spectrum_binner.__dict__
+    _assert_same_binned_peaks(loaded.transform(train), spectrum_binner.transform(train))
+    assert load_spectrum_binner(str(tmp_path / "spectrum_binner.json"),
+                                allowed_missing_percentage=50.0).allowed_missing_percentage == 50.0
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from calculate_binned_average_rmse import (pairwise_bins_and_squared_errors, resample_binned_rmses,
+                                           tanimoto_dependent_losses)
+
+REF_SCORE_BINS = np.linspace(0, 1.0, 11)
+
+
+def _symmetric_scores(n_spectra: int, seed: int, missing_fraction: float = 0.0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    scores = rng.random((n_spectra, n_spectra))
+    scores = np.triu(scores, 1) + np.triu(scores, 1).T
+    np.fill_diagonal(scores, 1.0)
+    if missing_fraction > 0:
+        missing = np.triu(rng.random((n_spectra, n_spectra)) < missing_fraction, 1)
+        scores[missing | missing.T] = np.nan
+    return scores
+
+
+def _per_bin_mask_losses(scores, scores_ref, ref_score_bins):
+    """The original implementation: a mask of the full matrix (without the diagonal) per bin"""
+    rmses = []
+    ref_scores_bins_inclusive = ref_score_bins.copy()
+    ref_scores_bins_inclusive[0] = -np.inf
+    ref_scores_bins_inclusive[-1] = np.inf
+    for i in range(len(ref_scores_bins_inclusive) - 1):
+        low = ref_scores_bins_inclusive[i]
+        high = ref_scores_bins_inclusive[i + 1]
+        idx = np.where((scores_ref >= low) & (scores_ref < high) & (~np.eye(scores_ref.shape[0], dtype=bool)))
+        rmses.append(np.sqrt(np.square(scores_ref[idx] - scores[idx]).mean()))
+    return rmses
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 64, 1024])
+def test_tanimoto_dependent_losses_match_the_per_bin_masks(block_size):
+    scores_ref = _symmetric_scores(150, 0, missing_fraction=0.05)
+    # Scores exactly on the bin edges belong to the upper bin
+    on_edges = np.triu(np.random.default_rng(2).random((150, 150)) < 0.2, 1)
+    scores_ref[on_edges | on_edges.T] = np.round(scores_ref[on_edges | on_edges.T], 1)
+    scores = _symmetric_scores(150, 1)
+    expected = _per_bin_mask_losses(scores, scores_ref, REF_SCORE_BINS)
+    assert np.allclose(tanimoto_dependent_losses(scores, scores_ref, REF_SCORE_BINS, block_size), expected)
+
+
+@pytest.mark.parametrize("replace", [False, True])
+def test_resampled_rmses_match_the_rmses_of_each_subset(replace):
+    scores_ref = _symmetric_scores(300, 0, missing_fraction=0.05)
+    scores = _symmetric_scores(300, 1)
+    bin_idx, squared_errors = pairwise_bins_and_squared_errors(scores, scores_ref, REF_SCORE_BINS, block_size=64)
+    rmses = resample_binned_rmses(bin_idx, squared_errors, 10, subset_size=120, n_replicates=5, replace=replace,
+                                  seed=3, block_size=32)
+
+    rng = np.random.default_rng(3)
+    for replicate_rmses in rmses:
+        subset = rng.choice(300, size=120, replace=replace)
+        subset_ref = scores_ref[np.ix_(subset, subset)].copy()
+        # Pairs of a spectrum with itself are ignored, also the duplicates of a bootstrap sample
+        subset_ref[subset[:, np.newaxis] == subset[np.newaxis, :]] = np.nan
+        expected = tanimoto_dependent_losses(scores[np.ix_(subset, subset)], subset_ref, REF_SCORE_BINS)
+        assert np.allclose(replicate_rmses, expected)
+
+
+def test_resampling_more_pairs_than_supported():
+    bin_idx, squared_errors = pairwise_bins_and_squared_errors(_symmetric_scores(50, 1), _symmetric_scores(50, 0),
+                                                               REF_SCORE_BINS)
+    with pytest.raises(ValueError, match="max_pairs"):
+        resample_binned_rmses(bin_idx, squared_errors, 10, subset_size=40, n_replicates=10, max_pairs=7799)
+    assert resample_binned_rmses(bin_idx, squared_errors, 10, subset_size=40, n_replicates=10,
+                                 max_pairs=7800).shape == (10, 10)
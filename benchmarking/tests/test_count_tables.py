@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+from count_tables import instrument_categories
+
+
+# Instrument types as they occur in the GNPS library
+@pytest.mark.parametrize("instrument_type, category", [
+    ("Orbitrap", "Orbitrap"),
+    ("Q-Exactive Plus", "Orbitrap"),
+    ("LTQ-Orbitrap XL", "Orbitrap"),
+    ("ESI-QTOF", "TOF"),
+    ("LC-ESI-QTOF", "TOF"),
+    ("qTof", "TOF"),
+    ("Maxis II HD Q-TOF Bruker", "TOF"),
+    ("MALDI-TOFTOF", "TOF"),
+    ("ESI-ITTOF", "TOF"),
+    ("LC-ESI-QFT", "Fourier transform"),
+    ("LC-ESI-ITFT", "Fourier transform"),
+    ("ESI-FTICR", "Fourier transform"),
+    ("Hybrid FT", "Fourier transform"),
+    ("LC-ESI-IT", "Ion trap"),
+    ("ESI-LTQ", "Ion trap"),
+    ("Ion Trap", "Ion trap"),
+    ("LCQ", "Ion trap"),
+    ("LC-ESI-QIT", "Ion trap"),
+    ("LC-APCI-QQ", "Quadruple"),
+    ("ESI-QQQ", "Quadruple"),
+    ("QTRAP", "Quadruple"),
+    ("Triple Quadrupole", "Quadruple"),
+    ("FAB-EBEB", "EBEB"),
+    ("in source CID", "CID"),
+    ("LC-ESI-Q", "Unknown"),
+    ("CI-B", "Unknown"),
+    ("N/A", "Unknown"),
+    ("", "Unknown"),
+    (None, "Unknown"),
+])
+def test_instrument_categories(instrument_type, category):
+    assert list(instrument_categories(pd.Series([instrument_type]))) == [category]
+
+
+def test_instrument_categories_keep_the_index():
+    instrument_types = pd.Series(["Orbitrap", None, "qTof"], index=[3, 5, 7])
+    categories = instrument_categories(instrument_types)
+    assert list(categories.index) == [3, 5, 7]
+    assert list(categories) == ["Orbitrap", "Unknown", "TOF"]
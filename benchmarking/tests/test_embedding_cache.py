@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+from matchms import Spectrum
+from ms2deepscore import SpectrumBinner
+from ms2deepscore.models import SiameseModel
+import embedding_cache as embedding_cache_module
+from calculate_binned_average_rmse import (calculate_binned_average_rmse,
+                                           calculate_binned_average_rmse_from_embeddings, compute_ms2ds_embeddings)
+from embedding_cache import EmbeddingCache
+
+
+def _spectra(n, seed):
+    rng = np.random.default_rng(seed)
+    return [Spectrum(mz=np.sort(rng.uniform(10.0, 1000.0, 10)), intensities=rng.uniform(0.1, 1.0, 10),
+                     metadata={"inchikey": f"{i % 12:014d}-UHFFFAOYSA-N"}) for i in range(n)]
+
+
+def _model(spectra):
+    spectrum_binner = SpectrumBinner(100, mz_min=10.0, mz_max=1000.0, allowed_missing_percentage=100.0)
+    spectrum_binner.fit_transform(spectra)
+    return SiameseModel(spectrum_binner, base_dims=(16,), embedding_dim=8)
+
+
+def _model_file(tmp_path, content=b"not a model"):
+    """The cache is keyed on the content of the model file, the model is passed in memory"""
+    (tmp_path / "model.hdf5").write_bytes(content)
+    return str(tmp_path / "model.hdf5")
+
+
+def _embedded_spectra(monkeypatch):
+    """Counts the spectra that are embedded"""
+    embedded = []
+
+    def counting_compute_ms2ds_embeddings(spectra, ms2ds_model):
+        embedded.extend(spectra)
+        return compute_ms2ds_embeddings(spectra, ms2ds_model)
+    monkeypatch.setattr(embedding_cache_module, "compute_ms2ds_embeddings", counting_compute_ms2ds_embeddings)
+    return embedded
+
+
+def test_only_missing_spectra_are_embedded(tmp_path, monkeypatch):
+    embedded = _embedded_spectra(monkeypatch)
+    spectra = _spectra(10, 0)
+    model = _model(spectra)
+    expected = compute_ms2ds_embeddings(spectra, model)
+
+    cache = EmbeddingCache(str(tmp_path / "cache"), _model_file(tmp_path), batch_size=3)
+    cache._ms2ds_model = model
+    assert np.allclose(cache.get_embeddings(spectra[:6] + spectra[:2]), expected[[0, 1, 2, 3, 4, 5, 0, 1]], atol=1e-6)
+    assert len(embedded) == 6
+
+    cache = EmbeddingCache(str(tmp_path / "cache"), _model_file(tmp_path))
+    cache._ms2ds_model = model
+    assert np.allclose(cache.get_embeddings(spectra), expected, atol=1e-6)
+    assert len(embedded) == 10
+    # All cached, the model file (which is not a model) is not loaded
+    cache = EmbeddingCache(str(tmp_path / "cache"), _model_file(tmp_path))
+    assert np.allclose(cache.get_embeddings(spectra[::-1]), expected[::-1], atol=1e-6)
+    assert len(embedded) == 10 and len(cache) == 10
+
+
+def test_another_model_file_has_its_own_cache(tmp_path):
+    spectra = _spectra(4, 1)
+    embeddings = np.arange(4 * 8, dtype=np.float32).reshape(4, 8)
+    EmbeddingCache(str(tmp_path / "cache"), _model_file(tmp_path)).add(spectra, embeddings)
+    assert len(EmbeddingCache(str(tmp_path / "cache"), _model_file(tmp_path))) == 4
+
+    retrained = EmbeddingCache(str(tmp_path / "cache"), _model_file(tmp_path, b"another model"))
+    assert len(retrained) == 0
+    cached_embeddings, missing = retrained.lookup(spectra)
+    assert cached_embeddings is None and list(missing) == [0, 1, 2, 3]
+
+
+def test_binned_average_rmse_from_the_embedding_cache(tmp_path):
+    spectra = _spectra(24, 2)
+    embeddings = compute_ms2ds_embeddings(spectra, _model(spectra))
+    scores = np.random.default_rng(3).random((12, 12))
+    scores = (scores + scores.T) / 2
+    np.fill_diagonal(scores, 1.0)
+    inchikeys = [f"{i:014d}" for i in range(12)]
+    tanimoto_df = pd.DataFrame(scores, index=inchikeys, columns=inchikeys)
+
+    model_file = _model_file(tmp_path)
+    cache = EmbeddingCache(str(tmp_path / "cache"), model_file)
+    cache.add(spectra, embeddings)
+    assert np.isclose(calculate_binned_average_rmse(spectra, tanimoto_df, model_file, embedding_cache=cache),
+                      calculate_binned_average_rmse_from_embeddings(spectra, tanimoto_df, embeddings))
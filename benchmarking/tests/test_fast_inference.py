@@ -0,0 +1,73 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from matchms import Spectrum
+from ms2deepscore import SpectrumBinner
+from ms2deepscore.models import SiameseModel
+from calculate_binned_average_rmse import compute_ms2ds_embeddings
+from fast_inference import NumpyEmbedder, compare_inference
+
+
+def _spectra(n, seed):
+    rng = np.random.default_rng(seed)
+    return [Spectrum(mz=np.sort(rng.uniform(10.0, 1000.0, 20)), intensities=rng.uniform(0.1, 1.0, 20),
+                     metadata={"inchikey": f"{i:014d}-UHFFFAOYSA-N"}) for i in range(n)]
+
+
+@pytest.fixture(scope="module")
+def siamese_model():
+    spectrum_binner = SpectrumBinner(200, mz_min=10.0, mz_max=1000.0, allowed_missing_percentage=100.0)
+    spectrum_binner.fit_transform(_spectra(50, 0))
+    model = SiameseModel(spectrum_binner, base_dims=(32, 16), embedding_dim=8, dropout_rate=0.2)
+    # Trained batch normalizations, so folding them into the dense layers is tested
+    rng = np.random.default_rng(1)
+    for layer in model.base.layers:
+        if layer.__class__.__name__ == "BatchNormalization":
+            for weight in (layer.gamma, layer.beta, layer.moving_mean):
+                weight.assign(rng.normal(0, 0.5, weight.shape))
+            layer.moving_variance.assign(rng.uniform(0.5, 2.0, layer.moving_variance.shape))
+    return model
+
+
+@pytest.mark.parametrize("precision, atol", [("float32", 1e-6), ("float16", 1e-4), ("int8", 1e-3)])
+def test_numpy_embeddings_match_keras(siamese_model, precision, atol):
+    spectra = _spectra(40, 2)
+    expected = compute_ms2ds_embeddings(spectra, siamese_model)
+    embeddings = NumpyEmbedder.from_model(siamese_model, precision).calculate_vectors(spectra)
+    assert embeddings.shape == expected.shape
+    assert np.allclose(embeddings, expected, atol=atol)
+
+
+def test_saved_embedder_gives_the_same_embeddings(siamese_model, tmp_path):
+    spectra = _spectra(10, 3)
+    embedder = NumpyEmbedder.from_model(siamese_model, "int8")
+    embedder.save(str(tmp_path / "embedder"))
+    loaded = NumpyEmbedder.load(str(tmp_path / "embedder"))
+    assert np.array_equal(loaded.calculate_vectors(spectra), embedder.calculate_vectors(spectra))
+
+
+def test_load_checks_the_activations(siamese_model, tmp_path):
+    NumpyEmbedder.from_model(siamese_model, "float16").save(str(tmp_path / "embedder"))
+    with open(tmp_path / "embedder" / "settings.json", "r") as file:
+        settings = json.load(file)
+    settings["activations"][-1] = "softmax"
+    with open(tmp_path / "embedder" / "settings.json", "w") as file:
+        json.dump(settings, file)
+    with pytest.raises(AssertionError, match="softmax"):
+        NumpyEmbedder.load(str(tmp_path / "embedder"))
+
+
+def test_compare_inference_returns_the_evaluated_embedder(siamese_model):
+    spectra = _spectra(30, 4)
+    scores = np.random.default_rng(5).random((30, 30))
+    scores = (scores + scores.T) / 2
+    np.fill_diagonal(scores, 1.0)
+    inchikeys = [f"{i:014d}" for i in range(30)]
+    report, embedder = compare_inference(spectra, pd.DataFrame(scores, index=inchikeys, columns=inchikeys),
+                                         siamese_model, "int8")
+    assert embedder.precision == "int8"
+    assert report["accepted"]
+    assert report["max_abs_rmse_delta"] <= report["max_rmse_delta"]
+    assert np.allclose(embedder.calculate_vectors(spectra), compute_ms2ds_embeddings(spectra, siamese_model),
+                       atol=1e-3)
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+from matchms import Spectrum
+from inchikey_index import InchikeyIndex, spectra_inchikeys14
+
+
+def _spectrum(inchikey):
+    return Spectrum(mz=np.array([100.0]), intensities=np.array([1.0]), metadata={"inchikey": inchikey})
+
+
+def test_positions_of_inchikeys():
+    tanimoto_df = pd.DataFrame(np.eye(3), index=["A" * 14, "B" * 14, "C" * 14], columns=["A" * 14, "B" * 14, "C" * 14])
+    inchikey_index = InchikeyIndex.from_tanimoto_df(tanimoto_df)
+    assert list(inchikey_index.positions(["C" * 14, "A" * 14, "C" * 14])) == [2, 0, 2]
+
+
+def test_missing_inchikeys_raise_a_key_error():
+    inchikey_index = InchikeyIndex(["A" * 14, "B" * 14])
+    with pytest.raises(KeyError, match=r"2 of 3 InChIKeys are not in the Tanimoto scores \(1 unique\)"):
+        inchikey_index.positions(["D" * 14, "A" * 14, "D" * 14])
+
+
+def test_duplicated_inchikeys_raise_a_value_error():
+    with pytest.raises(ValueError, match="1 duplicated InChIKeys"):
+        InchikeyIndex(["A" * 14, "B" * 14, "A" * 14])
+
+
+def test_save_and_load(tmp_path):
+    InchikeyIndex(["B" * 14, "A" * 14]).save(str(tmp_path / "index.txt"))
+    assert list(InchikeyIndex.load(str(tmp_path / "index.txt")).inchikeys) == ["B" * 14, "A" * 14]
+
+
+def test_spectra_without_inchikey():
+    spectra = [_spectrum("A" * 14 + "-UHFFFAOYSA-N"), _spectrum("")]
+    with pytest.raises(ValueError, match="1 spectra do not have an InChIKey"):
+        spectra_inchikeys14(spectra)
+    assert spectra_inchikeys14(spectra[:1]) == ["A" * 14]
@@ -0,0 +1,34 @@
+import matplotlib
+from micro_benchmarks import BENCHMARKS, compare_with_baseline, run_benchmarks
+
+
+matplotlib.use("Agg")
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(list(BENCHMARKS), sizes=[200], repeats=1)
+    assert [result["benchmark"] for result in results] == list(BENCHMARKS)
+    for result in results:
+        assert result["n"] == 200 and result["repeats"] == 1
+        assert 0 < result["seconds_min"] <= result["seconds_median"]
+        assert result["peak_memory_mb"] > 0
+
+
+def test_pairwise_benchmarks_are_skipped_above_max_pairwise():
+    results = run_benchmarks(["tanimoto_dependent_losses", "create_stratified_test_set"], sizes=[200], repeats=1,
+                             max_pairwise=100)
+    assert [result["benchmark"] for result in results] == ["create_stratified_test_set"]
+
+
+def test_compare_with_baseline_marks_regressions():
+    def result(benchmark, n, seconds):
+        return {"benchmark": benchmark, "n": n, "seconds_median": seconds, "peak_memory_mb": 10.0}
+
+    baseline = [result("a", 100, 1.0), result("b", 100, 1.0), result("c", 100, 1.0)]
+    results = [result("a", 100, 1.2), result("b", 100, 1.3), result("c", 1000, 5.0)]
+    comparison = compare_with_baseline(results, baseline, tolerance=1.25)
+    # Only the benchmarks and sizes in both are compared
+    assert list(comparison["benchmark"]) == ["a", "b"]
+    assert list(comparison["time_ratio"].round(6)) == [1.2, 1.3]
+    assert list(comparison["memory_ratio"]) == [1.0, 1.0]
+    assert list(comparison["regression"]) == [False, True]
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from tensorflow import keras
+from parallel_batches import SeededBatchSequence
+
+
+class _RandomBatches(keras.utils.Sequence):
+    """Stand-in for the ms2deepscore data generators: random pairs and an order shuffled per epoch"""
+    def __init__(self, n_batches=6, batch_size=4):
+        self.indexes = np.arange(n_batches)
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def __getitem__(self, batch_index):
+        inputs = np.random.random((self.batch_size, 3)) + self.indexes[batch_index]
+        return inputs, np.random.random((self.batch_size, 1))
+
+    def on_epoch_end(self):
+        np.random.shuffle(self.indexes)
+
+
+class _RecordingModel(keras.Model):
+    def __init__(self):
+        super().__init__()
+        self.dense = keras.layers.Dense(1)
+        self.batches = []
+
+    def call(self, inputs):
+        return self.dense(inputs)
+
+    def train_step(self, data):
+        self.batches.append(data[0].numpy())
+        return super().train_step(data)
+
+
+def _train_batches(workers):
+    sequence = SeededBatchSequence(_RandomBatches(), seed=7)
+    model = _RecordingModel()
+    model.compile(loss="mse", run_eagerly=True)
+    model.fit(sequence, epochs=2, verbose=0, shuffle=False, callbacks=[sequence.epoch_callback()],
+              workers=workers, use_multiprocessing=workers > 1)
+    return model.batches
+
+
+def test_batches_do_not_depend_on_the_number_of_workers():
+    batches = _train_batches(1)
+    assert len(batches) == 12
+    # The second epoch is shuffled differently
+    assert not np.array_equal(np.concatenate(batches[:6]), np.concatenate(batches[6:]))
+    parallel_batches = _train_batches(4)
+    assert len(parallel_batches) == 12
+    for batch, parallel_batch in zip(batches, parallel_batches):
+        assert np.array_equal(batch, parallel_batch)
+
+
+def test_repeated_epoch_end_calls_do_not_advance_the_epoch():
+    sequence = SeededBatchSequence(_RandomBatches(), seed=7)
+    first_epoch = [sequence[i][0] for i in range(len(sequence))]
+    sequence.on_epoch_end()
+    sequence.on_epoch_end()
+    sequence.set_epoch(0)
+    assert all(np.array_equal(sequence[i][0], batch) for i, batch in enumerate(first_epoch))
+    sequence.set_epoch(1)
+    sequence.set_epoch(1)
+    second_epoch = [sequence[i][0] for i in range(len(sequence))]
+    other = SeededBatchSequence(_RandomBatches(), seed=7)
+    other.set_epoch(1)
+    assert all(np.array_equal(other[i][0], batch) for i, batch in enumerate(second_epoch))
@@ -0,0 +1,91 @@
+import json
+import os
+from pipeline import DEFAULT_PARAMETERS, PipelineConfig, Stage, run_pipeline
+
+
+def _config(tmp_path, **settings) -> PipelineConfig:
+    return PipelineConfig(library_store="library", tanimoto_scores="tanimoto", classifiers_file="classes.txt",
+                          work_folder=str(tmp_path / "work"), figures_data_folder=str(tmp_path / "figures"),
+                          **settings)
+
+
+def test_stage_parameters_are_not_shared_between_configs(tmp_path):
+    config = _config(tmp_path)
+    assert config.parameters is None
+    assert config.stage_parameters("train") == DEFAULT_PARAMETERS["train"]
+    overridden = _config(tmp_path, parameters={"train": {"seed": 1}})
+    assert overridden.stage_parameters("train") == {**DEFAULT_PARAMETERS["train"], "seed": 1}
+    assert _config(tmp_path).stage_parameters("train") == DEFAULT_PARAMETERS["train"]
+
+
+def test_workers_are_divided_between_concurrent_stages(tmp_path):
+    n_workers = {}
+
+    def stage(name, depends_on=()):
+        return Stage(name, lambda config, parameters: n_workers.update({name: config.n_workers}),
+                     lambda config, file_hashes: {}, lambda config: [], (), depends_on)
+
+    stages = (stage("embed"),
+              stage("evaluate_mass_ranges", ("embed",)),
+              stage("evaluate_superclasses", ("embed",)),
+              stage("evaluate_test_set_sizes", ("embed",)))
+    run_pipeline(_config(tmp_path, n_workers=8), stages)
+    assert n_workers == {"embed": 8, "evaluate_mass_ranges": 2, "evaluate_superclasses": 2,
+                         "evaluate_test_set_sizes": 2}
+    run_pipeline(_config(tmp_path, n_workers=2), stages, force=("evaluate_mass_ranges", "evaluate_superclasses",
+                                                               "evaluate_test_set_sizes"))
+    assert n_workers["evaluate_superclasses"] == 1
+
+
+def test_only_stages_with_a_changed_key_are_rerun(tmp_path):
+    ran = []
+    embedding = {"content": "embeddings"}
+
+    def write(filename, content):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as file:
+            file.write(content)
+
+    def embed(config, parameters):
+        ran.append("embed")
+        write(os.path.join(config.work_folder, "embeddings.txt"), embedding["content"])
+
+    def evaluation(name):
+        def run(config, parameters):
+            ran.append(name)
+            write(os.path.join(config.figures_data_folder, f"{name}.csv"), json.dumps(parameters))
+        return Stage(name, run,
+                     lambda config, file_hashes: {"embeddings": file_hashes(os.path.join(config.work_folder,
+                                                                                          "embeddings.txt"))},
+                     lambda config: [os.path.join(config.figures_data_folder, f"{name}.csv")], (), ("embed",))
+
+    stages = (Stage("embed", embed, lambda config, file_hashes: {},
+                    lambda config: [os.path.join(config.work_folder, "embeddings.txt")], ()),
+              evaluation("evaluate_mass_ranges"), evaluation("evaluate_superclasses"))
+    run_pipeline(_config(tmp_path), stages)
+    assert sorted(ran) == ["embed", "evaluate_mass_ranges", "evaluate_superclasses"]
+
+    ran.clear()
+    run_pipeline(_config(tmp_path), stages)
+    assert ran == []
+
+    mass_bins = [0, 500, 1000, 5000]
+    config = _config(tmp_path, parameters={"evaluate_mass_ranges": {"mass_bins": mass_bins}})
+    run_pipeline(config, stages)
+    assert ran == ["evaluate_mass_ranges"]
+    with open(tmp_path / "figures" / "evaluate_mass_ranges.csv", "r") as file:
+        assert json.load(file)["mass_bins"] == mass_bins
+
+    # Rerunning a stage with the same output does not rerun the stages that depend on it
+    ran.clear()
+    run_pipeline(config, stages, force=("embed",))
+    assert ran == ["embed"]
+    ran.clear()
+    embedding["content"] = "other embeddings"
+    run_pipeline(config, stages, force=("embed",))
+    assert sorted(ran) == ["embed", "evaluate_mass_ranges", "evaluate_superclasses"]
+
+    ran.clear()
+    os.remove(tmp_path / "figures" / "evaluate_superclasses.csv")
+    run_pipeline(config, stages)
+    assert ran == ["evaluate_superclasses"]
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from matchms import Spectrum
+from spectrum_store import INCHIKEY14_COLUMN, SpectrumStore, load_metadata, write_spectrum_store
+
+# Reading and writing Parquet files requires pyarrow
+pytest.importorskip("pyarrow", exc_type=ImportError)
+
+
+def _spectra():
+    rng = np.random.default_rng(0)
+    spectra = []
+    for i in range(5):
+        n_peaks = [3, 0, 5, 1, 4][i]
+        spectra.append(Spectrum(mz=np.sort(rng.uniform(10.0, 1000.0, n_peaks)),
+                                intensities=rng.uniform(0.0, 1.0, n_peaks),
+                                metadata={"inchikey": f"{chr(65 + i % 3) * 14}-UHFFFAOYSA-N",
+                                          "charge": i - 2,
+                                          "parent_mass": 100.0 + i,
+                                          "is_annotated": i % 2 == 0,
+                                          "compound_name": f"compound {i}",
+                                          "library_class": "1" if i == 0 else 2 + i % 2,
+                                          "tags": ["tag", i]}))
+    # A key that only some spectra have
+    spectra[3].set("instrument", "Orbitrap")
+    return spectra
+
+
+def _assert_same_spectrum(spectrum, expected):
+    assert np.array_equal(spectrum.peaks.mz, expected.peaks.mz)
+    assert np.array_equal(spectrum.peaks.intensities, expected.peaks.intensities)
+    assert spectrum.metadata == expected.metadata
+
+
+def test_peaks_and_metadata_round_trip(tmp_path):
+    spectra = _spectra()
+    write_spectrum_store(spectra, str(tmp_path))
+    store = SpectrumStore(str(tmp_path))
+    assert len(store) == 5
+    assert list(store.n_peaks()) == [3, 0, 5, 1, 4]
+    for spectrum, expected in zip(store.get_spectra(), spectra):
+        _assert_same_spectrum(spectrum, expected)
+        assert type(spectrum.get("library_class")) is type(expected.get("library_class"))
+
+
+def test_metadata_dtypes(tmp_path):
+    write_spectrum_store(_spectra(), str(tmp_path))
+    metadata = load_metadata(str(tmp_path))
+    assert metadata["charge"].dtype == "Int64"
+    assert metadata["parent_mass"].dtype == np.float64
+    assert metadata["is_annotated"].dtype == "boolean"
+    assert list(metadata["tags"]) == [["tag", i] for i in range(5)]
+    assert list(metadata[INCHIKEY14_COLUMN]) == [chr(65 + i % 3) * 14 for i in range(5)]
+    assert list(load_metadata(str(tmp_path), ["tags"]).columns) == ["tags"]
+
+
+def test_values_that_do_not_round_trip_are_rejected(tmp_path):
+    spectra = _spectra()
+    spectra[2].set("tags", np.array([1, 2]))
+    with pytest.raises(ValueError, match="tags"):
+        write_spectrum_store(spectra, str(tmp_path))
+    spectra[2].set("tags", ("tag", 2))
+    with pytest.raises(ValueError, match="tags"):
+        write_spectrum_store(spectra, str(tmp_path))
+
+
+def test_subset_and_index_reads(tmp_path):
+    spectra = _spectra()
+    write_spectrum_store(spectra, str(tmp_path))
+    store = SpectrumStore(str(tmp_path), metadata_columns=["inchikey", "parent_mass"])
+    for i, spectrum in zip([4, 1, 2], store.get_spectra([4, 1, 2])):
+        assert np.array_equal(spectrum.peaks.mz, spectra[i].peaks.mz)
+        assert spectrum.metadata == {"inchikey": spectra[i].get("inchikey"),
+                                     "parent_mass": spectra[i].get("parent_mass")}
+    mz, intensities = store.peaks(2)
+    assert np.array_equal(mz, spectra[2].peaks.mz) and np.array_equal(intensities, spectra[2].peaks.intensities)
+    assert store.get_spectrum(1).peaks.mz.size == 0
+    assert list(store.n_peaks(min_intensity=0.5)) == [np.sum(spectrum.peaks.intensities >= 0.5)
+                                                      for spectrum in spectra]
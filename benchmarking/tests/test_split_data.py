@@ -0,0 +1,73 @@
+import pickle
+import h5py
+import numpy as np
+import pytest
+from split_data import (MODEL_SPLIT_ATTRIBUTE, SPLIT_NAMES, load_split_indices, load_test_spectra_for_model,
+                        split_indices, split_indices_by_inchikey, split_manifest_hash, write_split_manifest)
+
+
+def _inchikeys14(n_spectra: int, n_inchikeys: int, seed: int = 0) -> np.ndarray:
+    return np.array([f"{i:014d}" for i in np.random.default_rng(seed).integers(0, n_inchikeys, n_spectra)])
+
+
+def test_splits_are_disjoint_and_reproducible():
+    train, val, test = split_indices(1000, 100, 200, seed=3)
+    assert (len(train), len(val), len(test)) == (700, 100, 200)
+    assert np.array_equal(np.sort(np.concatenate([train, val, test])), np.arange(1000))
+    for split, same_seed_split in zip((train, val, test), split_indices(1000, 100, 200, seed=3)):
+        assert np.array_equal(split, same_seed_split)
+    assert not np.array_equal(test, split_indices(1000, 100, 200, seed=4)[2])
+
+
+def test_splits_by_inchikey_are_disjoint_and_reproducible():
+    inchikeys14 = _inchikeys14(1000, 150)
+    train, val, test = split_indices_by_inchikey(inchikeys14, 100, 200, seed=3)
+    assert np.array_equal(np.sort(np.concatenate([train, val, test])), np.arange(1000))
+    assert len(test) >= 200 and len(val) >= 100
+    split_inchikeys = [set(inchikeys14[split]) for split in (train, val, test)]
+    assert not (split_inchikeys[0] & split_inchikeys[1] or split_inchikeys[0] & split_inchikeys[2]
+                or split_inchikeys[1] & split_inchikeys[2])
+    for split, same_seed_split in zip((train, val, test), split_indices_by_inchikey(inchikeys14, 100, 200, seed=3)):
+        assert np.array_equal(split, same_seed_split)
+
+
+def test_split_manifest_round_trip(tmp_path):
+    splits = dict(zip(SPLIT_NAMES, split_indices(100, 10, 20, seed=1)))
+    write_split_manifest(str(tmp_path), splits, seed=1)
+    for split_name, indices in splits.items():
+        assert np.array_equal(load_split_indices(str(tmp_path), split_name), indices)
+
+
+def _model_file(tmp_path, split_hash=None):
+    """Only the attributes of the model file are read"""
+    with h5py.File(tmp_path / "model.hdf5", mode="w") as file:
+        if split_hash is not None:
+            file.attrs[MODEL_SPLIT_ATTRIBUTE] = split_hash
+    return str(tmp_path / "model.hdf5")
+
+
+def test_split_manifest_hash_changes_with_the_splits(tmp_path):
+    write_split_manifest(str(tmp_path), dict(zip(SPLIT_NAMES, split_indices(100, 10, 20, seed=1))), seed=1)
+    first_hash = split_manifest_hash(str(tmp_path))
+    write_split_manifest(str(tmp_path), dict(zip(SPLIT_NAMES, split_indices(100, 10, 20, seed=1))), seed=1)
+    assert split_manifest_hash(str(tmp_path)) == first_hash
+    write_split_manifest(str(tmp_path), dict(zip(SPLIT_NAMES, split_indices(100, 10, 20, seed=2))), seed=2)
+    assert split_manifest_hash(str(tmp_path)) != first_hash
+
+
+def test_test_spectra_of_a_model_trained_on_other_splits(tmp_path):
+    write_split_manifest(str(tmp_path), dict(zip(SPLIT_NAMES, split_indices(100, 10, 20, seed=1))), seed=1)
+    model_file = _model_file(tmp_path, split_hash="0" * 64)
+    with pytest.raises(ValueError, match="changed after"):
+        load_test_spectra_for_model(str(tmp_path), model_file)
+
+
+def test_test_spectra_of_a_model_trained_before_the_splits(tmp_path):
+    write_split_manifest(str(tmp_path), dict(zip(SPLIT_NAMES, split_indices(100, 10, 20, seed=1))), seed=1)
+    model_file = _model_file(tmp_path)
+    with pytest.raises(ValueError, match="was not trained on the splits"):
+        load_test_spectra_for_model(str(tmp_path), model_file)
+    with open(tmp_path / "all_testing_spectra.pickle", "wb") as file:
+        pickle.dump(["legacy test spectra"], file)
+    assert load_test_spectra_for_model(str(tmp_path), model_file,
+                                       str(tmp_path / "all_testing_spectra.pickle")) == ["legacy test spectra"]
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+import pytest
+from stratification import group_indices, mass_bin_labels, mass_bin_names, sample_per_stratum, superclass_labels
+
+GROUPS = {"small": np.arange(0, 5), "large": np.arange(5, 105), "medium": np.arange(105, 125)}
+
+
+def test_samples_are_reproducible_per_seed():
+    samples = sample_per_stratum(GROUPS, k=5, seed=1)
+    assert list(samples) == ["small", "large", "medium"]
+    for label, indices in samples.items():
+        assert len(np.unique(indices)) == 5
+        assert np.isin(indices, GROUPS[label]).all()
+    again = sample_per_stratum(GROUPS, k=5, seed=1)
+    assert all(np.array_equal(samples[label], again[label]) for label in samples)
+    other_seed = sample_per_stratum(GROUPS, k=5, seed=2)
+    assert not np.array_equal(samples["large"], other_seed["large"])
+
+
+def test_k_larger_than_a_stratum():
+    with pytest.raises(ValueError, match="small"):
+        sample_per_stratum(GROUPS, k=10)
+    samples = sample_per_stratum(GROUPS, k=10, skip_smaller=True)
+    assert list(samples) == ["large", "medium"]
+    assert sample_per_stratum(GROUPS, k=1000, skip_smaller=True) == {}
+
+
+def test_mass_bin_edges():
+    bins = [0, 200, 500, 5000]
+    assert mass_bin_names(bins) == ["mass_0_200", "mass_200_500", "mass_500_5000"]
+    # min < parent mass <= max
+    labels = mass_bin_labels([0.0, 0.001, 200.0, 200.001, 500.0, 5000.0, 5000.001, -1.0, np.nan], bins)
+    assert labels.tolist() == [None, "mass_0_200", "mass_0_200", "mass_200_500", "mass_200_500",
+                               "mass_500_5000", None, None, None]
+
+
+def test_group_indices_leaves_out_unlabeled_spectra():
+    groups = group_indices([10, 11, 12, 13, 14], ["b", None, "a", "b", np.nan])
+    assert list(groups) == ["b", "a"]
+    assert groups["b"].tolist() == [10, 13] and groups["a"].tolist() == [12]
+
+
+def test_superclass_labels_per_spectrum():
+    superclasses_df = pd.DataFrame({"inchikey14": ["A" * 14, "A" * 14, "B" * 14, "C" * 14],
+                                    "cf_superclass": ["Lipids", "Benzenoids", "Alkaloids", None]})
+    labels = superclass_labels(["B" * 14, "A" * 14, "C" * 14, "D" * 14], superclasses_df)
+    assert labels["spectrum_index"].tolist() == [0, 1, 1]
+    assert labels["cf_superclass"].tolist() == ["Alkaloids", "Lipids", "Benzenoids"]
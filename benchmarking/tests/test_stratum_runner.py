@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+from matchms import Spectrum
+from ms2deepscore import SpectrumBinner
+from ms2deepscore.models import SiameseModel
+from calculate_binned_average_rmse import compute_ms2ds_embeddings
+from embedding_cache import EmbeddingCache
+from stratum_runner import _evaluate_stratum, _init_worker, _worker_state, run_strata
+
+
+def _spectra(n, seed):
+    rng = np.random.default_rng(seed)
+    return [Spectrum(mz=np.sort(rng.uniform(10.0, 1000.0, 10)), intensities=rng.uniform(0.1, 1.0, 10),
+                     metadata={"inchikey": f"{i % 24:014d}-UHFFFAOYSA-N"}) for i in range(n)]
+
+
+def _model(spectra):
+    spectrum_binner = SpectrumBinner(100, mz_min=10.0, mz_max=1000.0, allowed_missing_percentage=100.0)
+    spectrum_binner.fit_transform(spectra)
+    return SiameseModel(spectrum_binner, base_dims=(16,), embedding_dim=8)
+
+
+def _model_file(tmp_path):
+    """The caches are keyed on the content of the model file, it is never loaded if everything is cached"""
+    (tmp_path / "model.hdf5").write_bytes(b"not a model")
+    return str(tmp_path / "model.hdf5")
+
+
+def _tanimoto_file(tmp_path):
+    """Scores in every Tanimoto bin, also within a stratum"""
+    i, j = np.indices((24, 24))
+    scores = ((i + j) % 10 + 0.5) / 10
+    np.fill_diagonal(scores, 1.0)
+    inchikeys = [f"{i:014d}" for i in range(24)]
+    pd.DataFrame(scores, index=inchikeys, columns=inchikeys).to_pickle(tmp_path / "scores.pickle")
+    return str(tmp_path / "scores.pickle")
+
+
+def test_embedding_cache_lookup_and_add(tmp_path):
+    spectra = _spectra(6, 0)
+    embedding_cache = EmbeddingCache(str(tmp_path / "cache"), _model_file(tmp_path))
+    embeddings, missing = embedding_cache.lookup(spectra)
+    assert embeddings is None and list(missing) == list(range(6))
+
+    added = np.arange(3 * 8, dtype=np.float32).reshape(3, 8)
+    embedding_cache.add(spectra[:3] + spectra[:1], np.vstack([added, added[:1]]))
+    assert len(embedding_cache) == 3
+    embeddings, missing = embedding_cache.lookup(spectra)
+    assert list(missing) == [3, 4, 5]
+    assert np.array_equal(embeddings[:3], added)
+    assert np.isnan(embeddings[3:]).all()
+
+
+def test_stratum_worker_only_embeds_missing_spectra(tmp_path):
+    spectra = _spectra(12, 1)
+    _init_worker(_tanimoto_file(tmp_path))
+    _worker_state["ms2ds_model"] = _model(spectra)
+    expected = compute_ms2ds_embeddings(spectra, _worker_state["ms2ds_model"])
+    _, expected_rmse, new_embeddings = _evaluate_stratum("stratum", spectra)
+    assert np.allclose(new_embeddings, expected, atol=1e-6)
+
+    cached = expected.copy()
+    cached[[2, 5]] = np.nan
+    _, rmse, new_embeddings = _evaluate_stratum("stratum", spectra, cached, np.array([2, 5]))
+    assert np.allclose(new_embeddings, expected[[2, 5]], atol=1e-6)
+    assert np.isclose(rmse, expected_rmse)
+    _, _, new_embeddings = _evaluate_stratum("stratum", spectra, expected, np.array([], dtype=int))
+    assert new_embeddings is None
+
+
+def test_run_strata_reads_the_embedding_cache(tmp_path):
+    spectra = _spectra(24, 2)
+    strata = {"first": spectra[:12], "second": spectra[8:]}
+    embeddings = compute_ms2ds_embeddings(spectra, _model(spectra))
+    tanimoto_file, model_file = _tanimoto_file(tmp_path), _model_file(tmp_path)
+    expected = run_strata(strata, tanimoto_file, model_file, n_workers=2,
+                          embeddings={"first": embeddings[:12], "second": embeddings[8:]})
+
+    cache_directory = str(tmp_path / "cache")
+    EmbeddingCache(cache_directory, model_file).add(spectra, embeddings)
+    cached = run_strata(strata, tanimoto_file, model_file, n_workers=2, embedding_cache_directory=cache_directory)
+    assert len(EmbeddingCache(cache_directory, model_file)) == 24
+    for stratum in strata:
+        assert np.isclose(cached[stratum], expected[stratum])
+
+
+def test_run_strata_without_strata(tmp_path):
+    assert run_strata({}, _tanimoto_file(tmp_path), _model_file(tmp_path)) == {}
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+from rdkit import Chem, DataStructs
+from tanimoto_builder import build_tanimoto_store
+from tanimoto_store import load_tanimoto_matrix
+
+SMILES = ["CCO", "CCCO", "CCCCO", "c1ccccc1", "c1ccccc1O", "c1ccccc1N", "CC(=O)O", "CC(=O)OC",
+          "CN1C=NC2=C1C(=O)N(C(=O)N2C)C", "OC1=CC=CC=C1C(=O)O", "CC(C)CC1=CC=C(C=C1)C(C)C(=O)O", "C1CCCCC1"]
+
+
+def _structures(smiles):
+    return pd.Series(smiles, index=[f"{i:014d}" for i in range(len(smiles))])
+
+
+def test_scores_are_the_rdkit_tanimoto_scores(tmp_path):
+    build_tanimoto_store(_structures(SMILES), str(tmp_path / "scores"), n_workers=2, rows_per_block=5)
+    fingerprints = [Chem.RDKFingerprint(Chem.MolFromSmiles(smiles), fpSize=2048) for smiles in SMILES]
+    expected = np.array([DataStructs.BulkTanimotoSimilarity(fingerprint, fingerprints) for fingerprint in fingerprints])
+    assert np.allclose(load_tanimoto_matrix(str(tmp_path / "scores")).to_dataframe().to_numpy(), expected, atol=1e-6)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "uint8"])
+def test_incremental_update_matches_a_full_rebuild(tmp_path, dtype):
+    structures = _structures(SMILES)
+    build_tanimoto_store(structures, str(tmp_path / "full"), dtype, n_workers=2, rows_per_block=5)
+    build_tanimoto_store(structures[:7], str(tmp_path / "previous"), dtype, n_workers=2, rows_per_block=5)
+    build_tanimoto_store(structures, str(tmp_path / "updated"), dtype, previous_base=str(tmp_path / "previous"),
+                         n_workers=2, rows_per_block=5)
+
+    full = load_tanimoto_matrix(str(tmp_path / "full"))
+    updated = load_tanimoto_matrix(str(tmp_path / "updated"))
+    assert list(updated.index) == list(full.index)
+    assert np.array_equal(np.asarray(updated.values), np.asarray(full.values))
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+import pytest
+from calculate_binned_average_rmse import binned_squared_errors, tanimoto_dependent_losses
+from tanimoto_store import (SCORE_BIN_EDGES, SUPPORTED_DTYPES, load_tanimoto_matrix, load_tanimoto_scores,
+                            quantize_scores, save_tanimoto_matrix)
+
+
+def _tanimoto_df(n_inchikeys: int, seed: int = 0) -> pd.DataFrame:
+    """Symmetric scores that are ratios of small integers, so many are exactly on a bin edge"""
+    rng = np.random.default_rng(seed)
+    denominators = rng.integers(1, 21, size=(n_inchikeys, n_inchikeys))
+    scores = rng.integers(0, 21, size=(n_inchikeys, n_inchikeys)) % (denominators + 1) / denominators
+    scores = np.triu(scores, 1)
+    scores = scores + scores.T
+    np.fill_diagonal(scores, 1.0)
+    inchikeys = [f"{i:014d}" for i in range(n_inchikeys)]
+    return pd.DataFrame(scores, index=inchikeys, columns=inchikeys)
+
+
+@pytest.mark.parametrize("dtype", SUPPORTED_DTYPES)
+def test_quantized_scores_stay_in_their_bin(dtype):
+    scores = np.concatenate([SCORE_BIN_EDGES, np.arange(0, 201) / 200, np.random.default_rng(0).random(1000)])
+    stored = quantize_scores(scores, dtype)
+    dequantized = stored.astype(np.float32) / 255 if dtype == "uint8" else stored
+    assert np.array_equal(np.digitize(dequantized, SCORE_BIN_EDGES), np.digitize(scores, SCORE_BIN_EDGES))
+    assert np.max(np.abs(dequantized - scores)) < {"float32": 1e-7, "float16": 1e-3, "uint8": 4e-3}[dtype]
+
+
+@pytest.mark.parametrize("dtype", SUPPORTED_DTYPES)
+def test_binned_rmse_of_store_matches_pickle(tmp_path, dtype):
+    tanimoto_df = _tanimoto_df(300)
+    tanimoto_df.to_pickle(tmp_path / "scores.pickle")
+    save_tanimoto_matrix(tanimoto_df, str(tmp_path / "scores"), dtype=dtype)
+
+    pickled = load_tanimoto_scores(str(tmp_path / "scores.pickle")).to_numpy()
+    stored = load_tanimoto_matrix(str(tmp_path / "scores")).gather(np.arange(300))
+    predictions = np.clip(pickled + np.random.default_rng(1).normal(0, 0.1, pickled.shape), 0, 1)
+    predictions = (predictions + predictions.T) / 2
+
+    _, pickle_counts = binned_squared_errors(predictions, pickled, SCORE_BIN_EDGES)
+    _, store_counts = binned_squared_errors(predictions, stored, SCORE_BIN_EDGES)
+    assert np.array_equal(store_counts, pickle_counts)
+    assert np.allclose(tanimoto_dependent_losses(predictions, stored, SCORE_BIN_EDGES),
+                       tanimoto_dependent_losses(predictions, pickled, SCORE_BIN_EDGES), atol=2e-3)
+
+
+def test_float16_without_bin_edges_moves_edge_scores():
+    # Documents why quantize_scores keeps scores in their bin: 0.2 is stored as 0.19995
+    assert quantize_scores(np.array([0.2]), "float16", bin_edges=None)[0] < 0.2
+    assert quantize_scores(np.array([0.2]), "float16")[0] >= 0.2
@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+import pytest
+from calculate_binned_average_rmse import predictions_from_embeddings, tanimoto_dependent_losses
+from tiled_similarity import normalize_embeddings, tiled_tanimoto_dependent_losses, top_k_neighbours
+
+REF_SCORE_BINS = np.linspace(0, 1.0, 11)
+
+
+def _tanimoto_df(n_inchikeys: int, seed: int) -> pd.DataFrame:
+    scores = np.random.default_rng(seed).random((n_inchikeys, n_inchikeys))
+    scores = np.triu(scores, 1) + np.triu(scores, 1).T
+    np.fill_diagonal(scores, 1.0)
+    inchikeys = [f"{i:014d}" for i in range(n_inchikeys)]
+    return pd.DataFrame(scores, index=inchikeys, columns=inchikeys)
+
+
+@pytest.mark.parametrize("tile_size", [16, 37, 2048])
+def test_tiled_rmses_match_the_dense_rmses(tile_size):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(150, 8))
+    # Spectra share InChIKeys, like in a test set
+    inchikey_positions = rng.integers(0, 40, 150)
+    tanimoto_df = _tanimoto_df(40, 1)
+    expected = tanimoto_dependent_losses(predictions_from_embeddings(embeddings),
+                                         tanimoto_df.to_numpy()[np.ix_(inchikey_positions, inchikey_positions)],
+                                         REF_SCORE_BINS)
+    rmses = tiled_tanimoto_dependent_losses(embeddings, inchikey_positions, tanimoto_df, REF_SCORE_BINS,
+                                            tile_size=tile_size, n_threads=2)
+    assert np.allclose(rmses, expected, atol=1e-8)
+
+
+@pytest.mark.parametrize("tile_size", [7, 50, 2048])
+@pytest.mark.parametrize("exclude_self", [True, False])
+def test_top_k_neighbours_match_argsort(tile_size, exclude_self):
+    embeddings = np.random.default_rng(2).normal(size=(60, 8))
+    normalized = normalize_embeddings(embeddings)
+    scores = normalized @ normalized.T
+    if exclude_self:
+        np.fill_diagonal(scores, -np.inf)
+    expected_indices = np.argsort(-scores, axis=1, kind="stable")[:, :5]
+
+    indices, neighbour_scores = top_k_neighbours(embeddings, 5, tile_size=tile_size, n_threads=2,
+                                                 exclude_self=exclude_self)
+    assert np.array_equal(indices, expected_indices)
+    assert np.allclose(neighbour_scores, np.take_along_axis(scores, expected_indices, axis=1))
+    if not exclude_self:
+        assert np.array_equal(indices[:, 0], np.arange(60))
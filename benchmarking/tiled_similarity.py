@@ -0,0 +1,98 @@
+"""Tiled MS2DeepScore similarity computations for test sets too large for a full n x n score matrix.
+
+The cosine similarities are computed as dot products of normalized embeddings in tiles of
+tile_size x tile_size, spread over a pool of threads (numpy releases the GIL in the matrix products).
+Peak memory is a few tiles per thread, independent of the number of spectra.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Union
+import numpy as np
+import pandas as pd
+from calculate_binned_average_rmse import binned_squared_errors, rmses_from_binned_squared_errors
+from tanimoto_store import TanimotoMatrix, gather_scores
+
+
+def normalize_embeddings(embeddings: np.ndarray) -> np.ndarray:
+    """Scale embeddings to unit length, so their dot products are the cosine similarities"""
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
+
+
+def tile_offsets(n_spectra: int, tile_size: int, upper_triangle: bool = True) -> List[Tuple[int, int]]:
+    """(row_offset, col_offset) of all tiles, only those on or above the diagonal if upper_triangle"""
+    return [(row_offset, col_offset)
+            for row_offset in range(0, n_spectra, tile_size)
+            for col_offset in range(row_offset if upper_triangle else 0, n_spectra, tile_size)]
+
+
+def tiled_tanimoto_dependent_losses(embeddings: np.ndarray, inchikey_positions: np.ndarray,
+                                    tanimoto_scores: Union[pd.DataFrame, TanimotoMatrix],
+                                    ref_score_bins=np.linspace(0, 1.0, 11), tile_size: int = 2048,
+                                    n_threads: int = None) -> List[float]:
+    """RMSE per reference score bin, computed tile by tile with streaming per-bin accumulators
+
+    Gives the same result as tanimoto_dependent_losses on the full predicted and reference matrices.
+
+    embeddings:
+        Embeddings of the test spectra (see compute_ms2ds_embeddings or EmbeddingCache).
+    inchikey_positions:
+        Position of the InChIKey of each test spectrum in tanimoto_scores (see InchikeyIndex.positions).
+    """
+    normalized = normalize_embeddings(embeddings)
+    inchikey_positions = np.asarray(inchikey_positions)
+
+    def binned_tile(offsets):
+        row_offset, col_offset = offsets
+        rows = slice(row_offset, row_offset + tile_size)
+        cols = slice(col_offset, col_offset + tile_size)
+        scores_tile = normalized[rows] @ normalized[cols].T
+        scores_ref_tile = gather_scores(tanimoto_scores, inchikey_positions[rows], inchikey_positions[cols])
+        return binned_squared_errors(scores_tile, scores_ref_tile, ref_score_bins, row_offset, col_offset)
+
+    n_bins = len(ref_score_bins) - 1
+    squared_error_sums = np.zeros(n_bins)
+    counts = np.zeros(n_bins, dtype=np.int64)
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for tile_sums, tile_counts in executor.map(binned_tile, tile_offsets(len(normalized), tile_size)):
+            squared_error_sums += tile_sums
+            counts += tile_counts
+    return rmses_from_binned_squared_errors(squared_error_sums, counts)
+
+
+def top_k_neighbours(embeddings: np.ndarray, k: int, tile_size: int = 2048, n_threads: int = None,
+                     exclude_self: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """The k most similar spectra of each spectrum, computed tile by tile
+
+    Returns two arrays of shape (n_spectra, k): the indices of the neighbours and their scores,
+    sorted from most to least similar.
+    """
+    normalized = normalize_embeddings(embeddings)
+    n_spectra = len(normalized)
+    assert 0 < k <= n_spectra - exclude_self, "k should be smaller than the number of spectra"
+    neighbour_indices = np.empty((n_spectra, k), dtype=np.int64)
+    neighbour_scores = np.empty((n_spectra, k), dtype=normalized.dtype)
+
+    def top_k_of_rows(row_offset):
+        block = normalized[row_offset:row_offset + tile_size]
+        block_rows = np.arange(row_offset, row_offset + len(block))
+        best_scores = np.full((len(block), 0), -np.inf, dtype=normalized.dtype)
+        best_indices = np.empty((len(block), 0), dtype=np.int64)
+        for col_offset in range(0, n_spectra, tile_size):
+            scores = block @ normalized[col_offset:col_offset + tile_size].T
+            cols = np.arange(col_offset, col_offset + scores.shape[1])
+            if exclude_self:
+                scores[block_rows[:, np.newaxis] == cols[np.newaxis, :]] = -np.inf
+            candidate_scores = np.hstack([best_scores, scores])
+            candidate_indices = np.hstack([best_indices, np.broadcast_to(cols, scores.shape)])
+            n_best = min(k, candidate_scores.shape[1])
+            best = np.argpartition(-candidate_scores, n_best - 1, axis=1)[:, :n_best]
+            best_scores = np.take_along_axis(candidate_scores, best, axis=1)
+            best_indices = np.take_along_axis(candidate_indices, best, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        neighbour_scores[block_rows] = np.take_along_axis(best_scores, order, axis=1)
+        neighbour_indices[block_rows] = np.take_along_axis(best_indices, order, axis=1)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(top_k_of_rows, range(0, n_spectra, tile_size)))
+    return neighbour_indices, neighbour_scores
@@ -1,83 +1,129 @@
-import os
-import pickle
-import numpy as np
-import tensorflow as tf
-from pathlib import Path
-from typing import Union
-import h5py
-from tensorflow import keras
-from tensorflow.keras.callbacks import (  # pylint: disable=import-error
-    EarlyStopping, ModelCheckpoint)
-from tensorflow.keras.optimizers import Adam  # pylint: disable=import-error
-from ms2deepscore import SpectrumBinner
-from ms2deepscore.data_generators import DataGeneratorAllInchikeys
-from ms2deepscore.models import SiameseModel
-
-
-def load_pickled_file(filename: str):
-    with open(filename, 'rb') as file:
-        loaded_object = pickle.load(file)
-    return loaded_object
-
-
-def train_ms2deepscore_model(spectrums_training, spectrums_val, tanimoto_df, output_folder):
-    # Create binned spectra
-    spectrum_binner = SpectrumBinner(10000, mz_min=10.0, mz_max=1000.0, peak_scaling=0.5,
-                                     allowed_missing_percentage=10.0)
-    binned_spectrums_training = spectrum_binner.fit_transform(spectrums_training)
-    binned_spectrums_val = spectrum_binner.transform(spectrums_val)
-
-    # Select unique Inchikeys
-    training_inchikeys = np.unique([s.get("inchikey")[:14] for s in spectrums_training])
-
-    same_prob_bins = list(zip(np.linspace(0, 0.9, 10), np.linspace(0.1, 1, 10)))
-    dimension = len(spectrum_binner.known_bins)
-    training_generator = DataGeneratorAllInchikeys(
-        binned_spectrums_training, training_inchikeys, tanimoto_df, dim=dimension,
-        same_prob_bins=same_prob_bins, num_turns=2, augment_noise_max=10, augment_noise_intensity=0.01)
-
-    validation_inchikeys = np.unique([s.get("inchikey")[:14] for s in spectrums_val])
-    validation_generator = DataGeneratorAllInchikeys(
-        binned_spectrums_val, validation_inchikeys, tanimoto_df, dim=dimension, same_prob_bins=same_prob_bins,
-        num_turns=10, augment_removal_max=0, augment_removal_intensity=0, augment_intensity=0, augment_noise_max=0, use_fixed_set=True)
-    model = SiameseModel(spectrum_binner, base_dims=(500, 500), embedding_dim=200,
-                         dropout_rate=0.2)
-    print(model.summary())
-
-    # Save best model and include early stopping
-    model.compile(loss='mse', optimizer=Adam(lr=0.01), metrics=["mae", tf.keras.metrics.RootMeanSquaredError()])
-    checkpointer_model_file_name = os.path.join(output_folder, "ms2deepscore_checkpoint_model.hdf5")
-    checkpointer = ModelCheckpoint(filepath=checkpointer_model_file_name, monitor='val_loss', mode="min", verbose=1, save_best_only=True)
-    earlystopper_scoring_net = EarlyStopping(monitor='val_loss', mode="min", patience=10, verbose=1)
-
-    history = model.model.fit(training_generator, validation_data=validation_generator,
-                              epochs=150, verbose=1, callbacks=[earlystopper_scoring_net, checkpointer])
-
-    # Save history
-    filename = os.path.join(output_folder, '_training_history.pickle')
-    with open(filename, 'wb') as f:
-        pickle.dump(history.history, f)
-    model_file_name = os.path.join(output_folder, "final_ms2deepscore_model.hdf5")
-    model.save(model_file_name)
-
-
-def save_model_with_spectrum_binner(filename: Union[str, Path]):
-    """Saves the MS2Deepscore model with spectrum_binner information"""
-    with h5py.File(filename, mode='r') as f:
-        keras_model = keras.models.load_model(f)
-    spectrum_binner = SpectrumBinner(10000, mz_min=10.0, mz_max=1000.0, peak_scaling=0.5,
-                                     allowed_missing_percentage=100.0)
-    training_spectra = load_pickled_file("C:/Users/jonge094/PycharmProjects/PhD_MS2Query/ms2query/data/hot_topics_metabolomics/training_spectra.pickle")
-    spectrum_binner.fit_transform(training_spectra)
-    SiameseModel(spectrum_binner, keras_model=keras_model).save("C:/Users/jonge094/PycharmProjects/PhD_MS2Query/ms2query/data/hot_topics_metabolomics/ms2deepscore_model_with_spectrumbinner.hdf5")
-
-
-if __name__ == "__main__":
-    path_root = os.path.dirname(os.getcwd())
-    path_files_folder = os.path.join(path_root, "../../data/hot_topics_metabolomics/")
-    training_spectra = load_pickled_file(os.path.join(path_files_folder, "training_spectra.pickle"))
-    validation_spectra = load_pickled_file(os.path.join(path_files_folder, "validation_spectra.pickle"))
-
-    tanimoto_score_df = load_pickled_file(os.path.join(path_root, "../../data/libraries_and_models/gnps_15_12_2021/in_between_files/GNPS_15_12_2021_pos_tanimoto_scores.pickle"))
-    train_ms2deepscore_model(training_spectra, validation_spectra, tanimoto_score_df, os.path.join(path_files_folder, "ms2deepscore_model.hdf5"))
-    save_model_with_spectrum_binner(os.path.join(path_files_folder, "ms2deepscore_model.hdf5"))
\ No newline at end of file
+import os
+import pickle
+import numpy as np
+import tensorflow as tf
+from pathlib import Path
+from typing import Union
+import h5py
+from tensorflow import keras
+from tensorflow.keras.callbacks import (  # pylint: disable=import-error
+    EarlyStopping, ModelCheckpoint)
+from tensorflow.keras.optimizers import Adam  # pylint: disable=import-error
+from ms2deepscore import SpectrumBinner
+from ms2deepscore.data_generators import DataGeneratorAllInchikeys
+from ms2deepscore.models import SiameseModel
+from tanimoto_store import load_tanimoto_matrix
+from parallel_batches import BatchThroughputMonitor, SeededBatchSequence
+from binned_spectra_store import SPECTRUM_BINNER_FILE, load_or_create_binned_spectra, load_spectrum_binner
+from split_data import MODEL_SPLIT_ATTRIBUTE, load_split_inchikeys14, load_split_spectra, split_manifest_hash
+
+
+SPECTRUM_BINNER_SETTINGS = dict(number_of_bins=10000, mz_min=10.0, mz_max=1000.0, peak_scaling=0.5,
+                                allowed_missing_percentage=10.0)
+
+
+def train_ms2deepscore_model(spectrums_training, spectrums_val, tanimoto_df, output_folder,
+                             binned_spectra_directory=None, workers=1, max_queue_size=10, seed=42,
+                             training_inchikeys=None, validation_inchikeys=None):
+    """Train an MS2DeepScore model
+
+    binned_spectra_directory:
+        If given, the binned spectra and the fitted SpectrumBinner are stored in (or, when already
+        stored, loaded from) this folder, see binned_spectra_store.py.
+    workers:
+        Number of worker processes creating the training batches. The batches are the same for any
+        number of workers, the throughput per epoch is written to _training_throughput.json.
+    max_queue_size:
+        Number of batches prepared ahead by the workers.
+    training_inchikeys, validation_inchikeys:
+        Optional unique InChIKeys (14 characters) of the spectra, e.g. from the metadata of a spectrum
+        store (see split_data.load_split_inchikeys14). By default they are collected from the spectra.
+    """
+    # Create binned spectra
+    if binned_spectra_directory is None:
+        spectrum_binner = SpectrumBinner(**SPECTRUM_BINNER_SETTINGS)
+        binned_spectrums_training = spectrum_binner.fit_transform(spectrums_training)
+        binned_spectrums_val = spectrum_binner.transform(spectrums_val)
+    else:
+        spectrum_binner, binned_spectrums_training, binned_spectrums_val = load_or_create_binned_spectra(
+            spectrums_training, spectrums_val, binned_spectra_directory, **SPECTRUM_BINNER_SETTINGS)
+
+    # Select unique Inchikeys
+    if training_inchikeys is None:
+        training_inchikeys = np.unique([s.get("inchikey")[:14] for s in spectrums_training])
+
+    same_prob_bins = list(zip(np.linspace(0, 0.9, 10), np.linspace(0.1, 1, 10)))
+    dimension = len(spectrum_binner.known_bins)
+    training_generator = SeededBatchSequence(DataGeneratorAllInchikeys(
+        binned_spectrums_training, training_inchikeys, tanimoto_df, dim=dimension,
+        same_prob_bins=same_prob_bins, num_turns=2, augment_noise_max=10, augment_noise_intensity=0.01),
+        seed=seed)
+
+    if validation_inchikeys is None:
+        validation_inchikeys = np.unique([s.get("inchikey")[:14] for s in spectrums_val])
+    validation_generator = DataGeneratorAllInchikeys(
+        binned_spectrums_val, validation_inchikeys, tanimoto_df, dim=dimension, same_prob_bins=same_prob_bins,
+        num_turns=10, augment_removal_max=0, augment_removal_intensity=0, augment_intensity=0, augment_noise_max=0, use_fixed_set=True)
+    model = SiameseModel(spectrum_binner, base_dims=(500, 500), embedding_dim=200,
+                         dropout_rate=0.2)
+    print(model.summary())
+
+    # Save best model and include early stopping
+    model.compile(loss='mse', optimizer=Adam(lr=0.01), metrics=["mae", tf.keras.metrics.RootMeanSquaredError()])
+    checkpointer_model_file_name = os.path.join(output_folder, "ms2deepscore_checkpoint_model.hdf5")
+    checkpointer = ModelCheckpoint(filepath=checkpointer_model_file_name, monitor='val_loss', mode="min", verbose=1, save_best_only=True)
+    earlystopper_scoring_net = EarlyStopping(monitor='val_loss', mode="min", patience=10, verbose=1)
+    throughput_monitor = BatchThroughputMonitor(os.path.join(output_folder, "_training_throughput.json"))
+
+    history = model.model.fit(training_generator, validation_data=validation_generator,
+                              epochs=150, verbose=1,
+                              callbacks=[training_generator.epoch_callback(), earlystopper_scoring_net, checkpointer,
+                                         throughput_monitor],
+                              workers=workers, use_multiprocessing=workers > 1, max_queue_size=max_queue_size)
+
+    # Save history
+    filename = os.path.join(output_folder, '_training_history.pickle')
+    with open(filename, 'wb') as f:
+        pickle.dump(history.history, f)
+    model_file_name = os.path.join(output_folder, "final_ms2deepscore_model.hdf5")
+    model.save(model_file_name)
+
+
+def save_model_with_spectrum_binner(filename: Union[str, Path], binned_spectra_directory: str,
+                                    output_filename: Union[str, Path], split_store_directory: str = None):
+    """Saves the MS2Deepscore model with spectrum_binner information
+
+    The fitted SpectrumBinner is loaded from binned_spectra_directory (see train_ms2deepscore_model).
+    If the model was trained on the splits of the spectrum store split_store_directory, the hash of its
+    split manifest is stored in the model file, so evaluations can check they use the same test split
+    (see split_data.load_test_spectra_for_model).
+    """
+    with h5py.File(filename, mode='r') as f:
+        keras_model = keras.models.load_model(f)
+    spectrum_binner = load_spectrum_binner(os.path.join(binned_spectra_directory, SPECTRUM_BINNER_FILE),
+                                           allowed_missing_percentage=100.0)
+    SiameseModel(spectrum_binner, keras_model=keras_model).save(output_filename)
+    if split_store_directory is not None:
+        with h5py.File(output_filename, mode='a') as f:
+            f.attrs[MODEL_SPLIT_ATTRIBUTE] = split_manifest_hash(split_store_directory)
+
+
+if __name__ == "__main__":
+    path_root = os.path.dirname(os.getcwd())
+    path_files_folder = os.path.join(path_root, "../../data/hot_topics_metabolomics/")
+    library_store = os.path.join(path_root, "../../data/libraries_and_models/gnps_15_12_2021/in_between_files/ALL_GNPS_15_12_2021_positive_annotated")
+    training_spectra = load_split_spectra(library_store, "train")
+    validation_spectra = load_split_spectra(library_store, "val")
+
+    # The dataframe is a view on the memory-mapped Tanimoto store, see tanimoto_store.py
+    tanimoto_score_df = load_tanimoto_matrix(os.path.join(path_root, "../../data/libraries_and_models/gnps_15_12_2021/in_between_files/GNPS_15_12_2021_pos_tanimoto_scores")).to_dataframe()
+    output_folder = os.path.join(path_files_folder, "ms2deepscore_model.hdf5")
+    binned_spectra_directory = os.path.join(path_files_folder, "binned_spectra")
+    train_ms2deepscore_model(training_spectra, validation_spectra, tanimoto_score_df, output_folder,
+                             binned_spectra_directory, workers=min(8, os.cpu_count()),
+                             training_inchikeys=load_split_inchikeys14(library_store, "train"),
+                             validation_inchikeys=load_split_inchikeys14(library_store, "val"))
+    save_model_with_spectrum_binner(os.path.join(output_folder, "final_ms2deepscore_model.hdf5"),
+                                    binned_spectra_directory,
+                                    os.path.join(path_files_folder, "ms2deepscore_model_with_spectrumbinner.hdf5"),
+                                    split_store_directory=library_store)
\ No newline at end of file
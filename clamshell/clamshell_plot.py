@@ -7,7 +7,9 @@ Usage:          Run './clamshell_plot.py -h' for help.
 import typing as ty 
 import argparse
 import math
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 
@@ -15,6 +17,19 @@ from matplotlib.colors import LinearSegmentedColormap
 Color = ty.Tuple[float, float, float]
 
 
+class Job(ty.NamedTuple):
+    """
+    Clamshell plot to draw in batch mode, one line of a manifest file.
+    """
+    input: str
+    output: str
+    nbins: int
+    counts_threshold: int = 0
+    format: ty.Optional[str] = None
+    log: ty.Optional[str] = None
+    transparent: bool = False
+
+
 GREY = (220 / 256, 220 / 256, 220 / 256)
 BLUE = (0 / 256, 0 / 256, 128 / 256)
 
@@ -31,15 +46,13 @@ def cli () -> argparse.Namespace:
         description="Create a clamshell plot of your counts data."
     )
 
-    # Required parameters.
+    # Required parameters, unless a manifest is given.
     parser.add_argument(
         "-i", "--input", 
-        required=True,
         help="Input file containing a list of items to count and visualize."
     )
     parser.add_argument(
         "-o", "--output",
-        required=True,
         help="Output file to save plot to."
     )
     parser.add_argument(
@@ -66,7 +79,27 @@ def cli () -> argparse.Namespace:
         help="Path to log file. No log is saved if no path is supplied."
     )
 
-    return parser.parse_args()
+    # Batch mode.
+    parser.add_argument(
+        "-m", "--manifest",
+        default=None,
+        help=(
+            "Tab-separated file with a header and one plot per line, with "
+            "columns input, output, nbins and optionally counts_threshold, "
+            "format, log and transparent. Replaces the other arguments."
+        )
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes for the plots of a manifest."
+    )
+
+    args = parser.parse_args()
+    if args.manifest is None and (args.input is None or args.output is None):
+        parser.error("--input and --output are required without --manifest")
+    return args
 
 
 def parse_input(path: str) -> ty.Tuple[ty.List[str], ty.List[int]]:
@@ -90,6 +123,36 @@ def parse_input(path: str) -> ty.Tuple[ty.List[str], ty.List[int]]:
     return labels, counts
 
 
+def parse_manifest(path: str) -> ty.List[Job]:
+    """
+    Parse manifest file for batch mode.
+
+    Parameters
+    ----------
+    path (str): Path to manifest file.
+
+    Returns
+    -------
+    ty.List[Job]: Plots to draw.
+    """
+    with open(path, "r") as handle:
+        header = handle.readline().strip().split("\t")
+        rows = [line.rstrip("\n").split("\t") for line in handle if line.strip()]
+    jobs = []
+    for row in rows:
+        fields = {key: value for key, value in zip(header, row) if value != ""}
+        jobs.append(Job(
+            input=fields["input"],
+            output=fields["output"],
+            nbins=int(fields["nbins"]),
+            counts_threshold=int(fields.get("counts_threshold", 0)),
+            format=fields.get("format"),
+            log=fields.get("log"),
+            transparent=fields.get("transparent", "").lower() in ("1", "true", "yes")
+        ))
+    return jobs
+
+
 def make_color_map(
     source_color: Color,
     target_color: Color,
@@ -117,6 +180,59 @@ def make_color_map(
     )
 
 
+def clamshell_layout(
+    counts: ty.Sequence[int],
+    nbins: int,
+    counts_threshold: int = 0
+) -> ty.Tuple[ty.List[float], np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calculate the clamshell plot sections in a single pass over the counts.
+
+    Parameters
+    ----------
+    counts (ty.Sequence[int]): List of counts.
+    nbins (int): Number of bins.
+    counts_threshold (int): Low counts threshold.
+
+    Returns
+    -------
+    ty.List[float]: Bin thresholds in counts, from high to low.
+    np.ndarray: Bin of every item, from 1 (lowest) to nbins (highest), 0 if
+        the item is in no bin (count of 0 or filtered out).
+    np.ndarray: Radius of every item.
+    np.ndarray: Radius of the circle of every bin (largest radius of its
+        items), 0 for empty bins. Index 0 is unused.
+    """
+    counts = np.asarray(counts)
+    max_count = counts.max()
+
+    # Calculate bin thresholds in counts.
+    thresholds = [
+        float((max_count / nbins) * bin)
+        for bin in range(1, nbins + 1)
+    ][::-1] + [0]
+    # (max_count / nbins) * nbins can round to just below max_count, the
+    # largest item has to stay in the top bin.
+    thresholds[0] = float(max_count)
+
+    # Items with count in (threshold[i + 1], threshold[i]] go into one bin.
+    item_bins = np.digitize(counts, thresholds[::-1], right=True)
+
+    # Filter out classes with low counts, they are displayed separately.
+    if counts_threshold > 0:
+        item_bins[counts < counts_threshold] = 0
+
+    # Convert counts to surface areas with same ratio as to the max count.
+    max_surface = math.pi  # Circle of max count has radius 1.
+    surfaces = counts / max_count * max_surface
+    item_radii = np.sqrt(surfaces / math.pi)
+
+    bin_radii = np.zeros(nbins + 1)
+    np.maximum.at(bin_radii, item_bins, item_radii)
+    bin_radii[0] = 0
+    return thresholds, item_bins, item_radii, bin_radii
+
+
 def clamshell_plot(
     counts: ty.List[int], 
     labels: ty.List[str],
@@ -125,7 +241,8 @@ def clamshell_plot(
     transparent: bool = False,
     color_range: ty.Tuple[Color, Color] = (GREY, BLUE),
     counts_threshold: int = 0,
-    log: str = None
+    log: str = None,
+    format: str = None
 ) -> None:
     """
     Draw a clamshell plot.
@@ -140,6 +257,7 @@ def clamshell_plot(
     color_range (ty.Tuple[Color, Color]): Color range.
     counts_threshold (int): Low counts threshold.
     log (str): Path to log file.
+    format (str): Output file format, inferred from output if not given.
 
     Note: counts cannot be <0.
     """
@@ -149,48 +267,37 @@ def clamshell_plot(
     axs.set_aspect(1)
     cmap = make_color_map(color_range[0], color_range[1])
 
+    thresholds, item_bins, item_radii, bin_radii = clamshell_layout(
+        counts, nbins, counts_threshold
+    )
+    if log: log_handle.write(f"Thresholds: {thresholds}\n")
+
     # Filter out classes with low counts and display them as smallest class 
     # (circle with radius near-0).
     if counts_threshold > 0:
-        all_items = list(zip(labels, counts))
-        filtered_items = filter(lambda x: x[1] < counts_threshold, all_items)
-        other_items = filter(lambda x: x[1] >= counts_threshold, all_items)
-        filtered_items, other_items = list(filtered_items), list(other_items)
+        filtered_items = [
+            (label, count) for label, count in zip(labels, counts)
+            if count < counts_threshold
+        ]
     else:
-        filtered_items, other_items = [], list(zip(labels, counts))
-
-    # Calculate bin thresholds in counts.
-    thresholds = [
-        ((max(counts)) / nbins) * bin
-        for bin in range(1, nbins + 1)
-    ][::-1] + [0]
-    if log: log_handle.write(f"Thresholds: {thresholds}\n")
-
-    for i in range(len(thresholds) - 1):
-        max_bin = thresholds[i]
-        min_bin = thresholds[i + 1]
-
-        # Select items from counts based on previous threshold and new max
-        # threshold.
-        items = filter(
-            lambda x: (x[1] > min_bin) & (x[1] <= max_bin),
-            other_items
-        )
+        filtered_items = []
 
-        # Convert counts to surface areas with same ratio as to the max count.
-        max_surface = math.pi  # Circle of max count has radius 1. 
-        count_ratio = lambda v: v / max(counts)
-        radius_from_surface = lambda a: math.sqrt(a / math.pi)
+    # Items grouped per bin (in input order) for the log.
+    items_order = np.argsort(item_bins, kind="stable")
+    bin_starts = np.searchsorted(item_bins[items_order], np.arange(nbins + 2))
 
-        items = map(lambda x: (x[0], x[1], count_ratio(x[1])), items)
-        items = map(lambda x: (x[0], x[1], x[2] * max_surface), items)
-        items = map(lambda x: (x[0], x[1], radius_from_surface(x[2])), items)
-        items = list(items)
-        if log: log_handle.write(f"Items ({len(items)}): {items}\n")
+    # Draw the sections from the largest to the smallest bin.
+    for bin in range(nbins, 0, -1):
+        if log:
+            items = [
+                (labels[i], counts[i], float(item_radii[i]))
+                for i in items_order[bin_starts[bin]:bin_starts[bin + 1]]
+            ]
+            log_handle.write(f"Items ({len(items)}): {items}\n")
 
         # Draw clamshell plot section.
-        if len(items) > 0:
-            radius = max(list(map(lambda v: v[2], items)))
+        if bin_radii[bin] > 0:
+            radius = bin_radii[bin]
 
             # Draw circle.
             circle = plt.Circle(
@@ -254,16 +361,76 @@ def clamshell_plot(
     plt.axis("off")
     plt.xlim([-1.01, 2.1])
     plt.ylim([-0.01, 2.1])
-    plt.savefig(output, bbox_inches="tight", transparent=transparent, dpi=900)
+    plt.savefig(
+        output, 
+        bbox_inches="tight", 
+        transparent=transparent, 
+        dpi=900, 
+        format=format
+    )
+    plt.close(fig)
 
     if log: log_handle.close()
 
 
+def draw_jobs(input: str, jobs: ty.List[Job]) -> None:
+    """
+    Draw all plots of one input file, which is parsed once.
+
+    Parameters
+    ----------
+    input (str): Path to input file.
+    jobs (ty.List[Job]): Plots to draw from input.
+    """
+    labels, counts = parse_input(input)
+    for job in jobs:
+        clamshell_plot(
+            counts=counts,
+            labels=labels,
+            nbins=job.nbins,
+            output=job.output,
+            transparent=job.transparent,
+            counts_threshold=job.counts_threshold,
+            log=job.log,
+            format=job.format,
+        )
+
+
+def draw_manifest(path: str, workers: int = 1) -> None:
+    """
+    Draw all plots of a manifest file, the inputs are spread over workers.
+
+    Parameters
+    ----------
+    path (str): Path to manifest file.
+    workers (int): Number of worker processes.
+    """
+    jobs_per_input = {}
+    for job in parse_manifest(path):
+        jobs_per_input.setdefault(job.input, []).append(job)
+
+    if workers > 1 and len(jobs_per_input) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(draw_jobs, input, jobs)
+                for input, jobs in jobs_per_input.items()
+            ]
+            for future in futures:
+                future.result()
+    else:
+        for input, jobs in jobs_per_input.items():
+            draw_jobs(input, jobs)
+
+
 def main() -> None:
     """
     Driver code.
     """
     args = cli()
+    if args.manifest is not None:
+        draw_manifest(args.manifest, args.workers)
+        return
+
     labels, counts = parse_input(args.input)
     clamshell_plot(
         counts=counts, 
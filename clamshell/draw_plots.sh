@@ -1,4 +1 @@
-./clamshell_plot.py -i ./data/gnps_instruments.tbd -o ./out/plot_incstruments.png -l ./out/log_instruments.txt -nb 100
-./clamshell_plot.py -i ./data/gnps_instruments.tbd -o ./out/plot_incstruments.svg -l ./out/log_instruments.txt -nb 100
-./clamshell_plot.py -i ./data/gnps_classes.tbd -o ./out/plot_classes.png -nb 10 -ct 6 -l ./out/log_classes.txt 
-./clamshell_plot.py -i ./data/gnps_classes.tbd -o ./out/plot_classes.svg -nb 10 -ct 6 -l ./out/log_classes.txt 
+./clamshell_plot.py --manifest ./plots_manifest.tbd --workers 2
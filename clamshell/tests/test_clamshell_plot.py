@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from clamshell_plot import clamshell_layout
+
+
+def test_clamshell_layout_top_threshold_rounding():
+    # (29 / 100) * 100 rounds to just below 29, the largest item has to stay in the top bin
+    thresholds, item_bins, item_radii, bin_radii = clamshell_layout([29, 5, 1], 100)
+    assert thresholds[0] == 29.0
+    assert item_bins.tolist() == [100, 18, 4]
+    assert bin_radii[100] == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("nbins", [3, 6, 7, 9, 10, 11, 13, 100])
+def test_clamshell_layout_largest_item_in_top_bin(nbins):
+    for max_count in range(1, 2000):
+        _, item_bins, _, bin_radii = clamshell_layout([max_count, 1], nbins)
+        assert item_bins[0] == nbins
+        assert bin_radii[nbins] == pytest.approx(1.0)
+
+
+def test_clamshell_layout_bins():
+    counts = [100, 50, 49, 10, 1, 0]
+    thresholds, item_bins, item_radii, bin_radii = clamshell_layout(counts, 10)
+    assert thresholds == [100.0, 90.0, 80.0, 70.0, 60.0, 50.0, 40.0, 30.0, 20.0, 10.0, 0]
+    # A count equal to a threshold belongs to the bin below it, a count of 0 to no bin
+    assert item_bins.tolist() == [10, 5, 5, 1, 1, 0]
+    assert np.allclose(item_radii, np.sqrt(np.array(counts) / 100))
+    assert bin_radii[0] == 0
+    assert bin_radii[5] == pytest.approx(np.sqrt(0.5))
+    assert bin_radii[1] == pytest.approx(np.sqrt(0.1))
+    assert np.all(bin_radii[[2, 3, 4, 6, 7, 8, 9]] == 0)
+
+
+def test_clamshell_layout_equal_counts():
+    _, item_bins, item_radii, bin_radii = clamshell_layout([7, 7, 7], 5)
+    assert item_bins.tolist() == [5, 5, 5]
+    assert np.allclose(item_radii, 1.0)
+    assert bin_radii.tolist() == [0, 0, 0, 0, 0, 1.0]
+
+
+def test_clamshell_layout_counts_threshold():
+    _, item_bins, _, bin_radii = clamshell_layout([100, 20, 5], 10, counts_threshold=10)
+    assert item_bins.tolist() == [10, 2, 0]
+    assert bin_radii[1] == 0
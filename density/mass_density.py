@@ -0,0 +1,102 @@
+"""Kernel density estimates of parent masses, computed once per dataset and drawn from the cache.
+
+The masses are binned on a fine grid and the Gaussian KDE is computed by FFT convolution of the
+bin counts with the kernel, which matches sns.kdeplot (Scott's rule bandwidth, cut=3) up to the
+bin width. The curves are cached in cache_directory under the hash of the masses and the settings.
+
+Usage in the notebook:
+    curve = mass_density(masses, cache_directory="density_cache")
+    plot_density(curve, label=f"GNPS (n={curve.n})", color=clamshell_colours[0])
+"""
+import hashlib
+import json
+import os
+from typing import NamedTuple, Sequence
+import numpy as np
+from matplotlib import pyplot as plt
+from spectrum_summary import MassHistogram
+
+
+class DensityCurve(NamedTuple):
+    x: np.ndarray
+    density: np.ndarray
+    n: int
+    bandwidth: float
+
+
+def kde_from_histogram(counts: np.ndarray, bin_edges: np.ndarray, bw_adjust: float = 1.0,
+                       cut: float = 3) -> DensityCurve:
+    """Gaussian KDE of binned data by FFT convolution, evaluated on the bin centers
+
+    The bandwidth is Scott's rule (as in sns.kdeplot) times bw_adjust, the curve is evaluated up to cut
+    bandwidths beyond the smallest and largest mass.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    bin_width = bin_edges[1] - bin_edges[0]
+    centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    n = counts.sum()
+    if np.count_nonzero(counts) < 2:
+        raise ValueError(f"The density cannot be estimated from {int(n)} masses, "
+                         "they should fall in at least 2 different bins")
+    mean = np.sum(counts * centers) / n
+    std = np.sqrt(np.sum(counts * (centers - mean) ** 2) / (n - 1))
+    bandwidth = bw_adjust * std * n ** (-1 / 5)
+
+    # The kernel is truncated at 6 bandwidths, where it is negligible
+    half_width = int(np.ceil(max(6, cut) * bandwidth / bin_width))
+    kernel = np.exp(-0.5 * (np.arange(-half_width, half_width + 1) * bin_width / bandwidth) ** 2)
+    size = len(counts) + len(kernel) - 1
+    n_fft = 1 << (size - 1).bit_length()
+    convolved = np.fft.irfft(np.fft.rfft(counts, n_fft) * np.fft.rfft(kernel, n_fft), n_fft)[:size]
+    density = np.clip(convolved, 0, None) / (n * bandwidth * np.sqrt(2 * np.pi))
+    # Element j of the full convolution belongs to bin center j - half_width
+    x = centers[0] + (np.arange(size) - half_width) * bin_width
+    nonzero = np.nonzero(counts)[0]
+    cut_width = int(np.ceil(cut * bandwidth / bin_width))
+    keep = slice(nonzero[0] + half_width - cut_width, nonzero[-1] + half_width + cut_width + 1)
+    return DensityCurve(x[keep], density[keep], int(n), float(bandwidth))
+
+
+def mass_density(masses: Sequence[float], cache_directory: str = None, bin_width: float = 0.1,
+                 bw_adjust: float = 1.0, cut: float = 3) -> DensityCurve:
+    """KDE of masses, loaded from cache_directory if it was computed before for the same masses and settings
+
+    masses:
+        The masses, or a MassHistogram (see spectrum_summary.py) of them, whose bins are used as they are.
+    """
+    if isinstance(masses, MassHistogram):
+        histogram = masses
+    else:
+        masses = np.asarray(masses, dtype=np.float64)
+        masses = masses[~np.isnan(masses)]
+        if len(masses) == 0:
+            raise ValueError("No masses to estimate the density of")
+        histogram = MassHistogram(bin_width, np.floor(masses.min()), masses.max() + bin_width)
+        histogram.add(masses)
+    settings = {"bin_width": histogram.bin_width, "min_mass": histogram.min_mass, "bw_adjust": bw_adjust, "cut": cut}
+
+    cache_file = None
+    if cache_directory is not None:
+        sha256 = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+        sha256.update(histogram.counts.tobytes())
+        cache_file = os.path.join(cache_directory, f"{sha256.hexdigest()}.npz")
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                return DensityCurve(cached["x"], cached["density"], int(cached["n"]), float(cached["bandwidth"]))
+
+    curve = kde_from_histogram(histogram.counts, histogram.bin_edges, bw_adjust, cut)
+    if cache_file is not None:
+        os.makedirs(cache_directory, exist_ok=True)
+        np.savez(cache_file, **curve._asdict())
+    return curve
+
+
+def plot_density(curve: DensityCurve, ax=None, label: str = None, color=None, fill: bool = True):
+    """Draw a precomputed density curve, in the style of sns.kdeplot(..., fill=True)"""
+    if ax is None:
+        ax = plt.gca()
+    line, = ax.plot(curve.x, curve.density, color=color, label=label)
+    if fill:
+        ax.fill_between(curve.x, curve.density, color=line.get_color(), alpha=0.25, linewidth=0)
+    ax.set_ylabel("Density")
+    return ax
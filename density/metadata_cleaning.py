@@ -0,0 +1,168 @@
+"""Metadata cleaning of spectra with a chain of matchms filters, run over a process pool with a disk cache.
+
+The filters are given as (name of the matchms filter, keyword arguments), so a filter chain can be
+hashed and sent to the worker processes. The RDKit conversions between SMILES, InChI and InChIKey
+are memoized per structure, since many spectra share the same structure.
+
+Usage in the notebook:
+    crus_spectra = clean_spectra_file(mgf_path, cache_directory="cleaning_cache")
+"""
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+import matchms
+import matchms.filtering as msfilters
+from matchms import Spectrum
+from matchms.importing import load_from_mgf
+
+
+METADATA_FILTERS = (
+    ("default_filters", {}),
+    ("derive_adduct_from_name", {}),
+    ("add_parent_mass", {"estimate_from_adduct": True}),
+    # Undefined entries are harmonized (instead of having a huge variation of None, "", "N/A" etc.)
+    ("harmonize_undefined_inchikey", {}),
+    ("harmonize_undefined_inchi", {}),
+    ("harmonize_undefined_smiles", {}),
+    # Corrects misplaced metadata (e.g. inchikeys entered as inchi) and harmonizes the entry strings
+    ("repair_inchi_inchikey_smiles", {}),
+    # Where possible (and necessary, i.e. missing): convert between smiles, inchi and inchikey with rdkit
+    ("derive_inchi_from_smiles", {}),
+    ("derive_smiles_from_inchi", {}),
+    ("derive_inchikey_from_inchi", {}),
+)
+
+# The metadata fields the RDKit conversion filters read and write, their results are memoized on these
+STRUCTURE_FILTER_FIELDS = {
+    "derive_inchi_from_smiles": ("smiles", "inchi"),
+    "derive_smiles_from_inchi": ("smiles", "inchi"),
+    "derive_inchikey_from_inchi": ("inchi", "inchikey"),
+}
+
+
+def file_hash(filename: str) -> str:
+    """sha256 of the content of a file"""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for block in iter(lambda: file.read(2 ** 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def filters_hash(filters: Sequence[Tuple[str, dict]]) -> str:
+    """Hash of a filter chain and the matchms version, which together determine the cleaning result"""
+    description = json.dumps({"matchms": matchms.__version__, "filters": [list(f) for f in filters]},
+                             sort_keys=True)
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def derived_input_hash(input_hash: str, *filter_chains: Sequence[Tuple[str, dict]]) -> str:
+    """input_hash of spectra derived from the input with input_hash by filter chains
+
+    For a cached_clean_spectra call on spectra that were already cleaned, e.g.
+    derived_input_hash(file_hash(mgf_path), METADATA_FILTERS, peak_filters).
+    """
+    description = " ".join([input_hash, *(filters_hash(filters) for filters in filter_chains)])
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def _cache_file(cache_directory: str, input_hash: str, filters) -> str:
+    return os.path.join(cache_directory, f"{input_hash}_{filters_hash(filters)}.pickle")
+
+
+@lru_cache(maxsize=None)
+def _structure_conversion(filter_name: str, values: Tuple) -> Tuple:
+    """Result of a structure conversion filter on a spectrum with only the fields it uses"""
+    fields = STRUCTURE_FILTER_FIELDS[filter_name]
+    metadata = {field: value for field, value in zip(fields, values) if value is not None}
+    # Without harmonization, which would drop empty values that the real spectrum has
+    spectrum = Spectrum(mz=np.array([], dtype="float"), intensities=np.array([], dtype="float"), metadata=metadata,
+                        metadata_harmonization=False)
+    spectrum = getattr(msfilters, filter_name)(spectrum)
+    return tuple(spectrum.get(field) for field in fields)
+
+
+def _apply_structure_filter(spectrum: Spectrum, filter_name: str) -> Spectrum:
+    fields = STRUCTURE_FILTER_FIELDS[filter_name]
+    values = tuple(spectrum.get(field) for field in fields)
+    converted = _structure_conversion(filter_name, values)
+    if converted == values:
+        return spectrum
+    spectrum = spectrum.clone()
+    for field, value in zip(fields, converted):
+        spectrum.set(field, value)
+    return spectrum
+
+
+def apply_filters(spectrum: Spectrum, filters: Sequence[Tuple[str, dict]] = METADATA_FILTERS) -> Optional[Spectrum]:
+    """Apply a filter chain to one spectrum, returns None if a filter removed the spectrum"""
+    for filter_name, kwargs in filters:
+        if spectrum is None:
+            return None
+        if filter_name in STRUCTURE_FILTER_FIELDS and not kwargs:
+            spectrum = _apply_structure_filter(spectrum, filter_name)
+        else:
+            spectrum = getattr(msfilters, filter_name)(spectrum, **kwargs)
+    return spectrum
+
+
+def _apply_filters_to_chunk(spectra: List[Spectrum], filters) -> List[Optional[Spectrum]]:
+    return [apply_filters(spectrum, filters) for spectrum in spectra]
+
+
+def clean_spectra(spectra: List[Spectrum], filters: Sequence[Tuple[str, dict]] = METADATA_FILTERS,
+                  n_workers: int = None, chunk_size: int = 1000) -> List[Optional[Spectrum]]:
+    """Apply a filter chain to all spectra in chunks over a pool of n_workers processes
+
+    The result has the same length and order as spectra, spectra removed by a filter are None.
+    """
+    filters = tuple(filters)
+    chunks = [spectra[start:start + chunk_size] for start in range(0, len(spectra), chunk_size)]
+    if n_workers == 1 or len(chunks) <= 1:
+        return [spectrum for chunk in chunks for spectrum in _apply_filters_to_chunk(chunk, filters)]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        cleaned_chunks = executor.map(_apply_filters_to_chunk, chunks, [filters] * len(chunks))
+        return [spectrum for chunk in cleaned_chunks for spectrum in chunk]
+
+
+def cached_clean_spectra(spectra: List[Spectrum], cache_directory: str,
+                         filters: Sequence[Tuple[str, dict]] = METADATA_FILTERS, *, input_hash: str,
+                         **kwargs) -> List[Optional[Spectrum]]:
+    """clean_spectra, with the result stored in cache_directory under the hash of the input and the filters
+
+    input_hash:
+        Hash identifying the input spectra: the file_hash of the file they were loaded from, or the
+        derived_input_hash for spectra that were filtered before.
+    kwargs:
+        Passed to clean_spectra (n_workers, chunk_size).
+    """
+    cache_file = _cache_file(cache_directory, input_hash, filters)
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as file:
+            return pickle.load(file)
+    cleaned_spectra = clean_spectra(spectra, filters, **kwargs)
+    os.makedirs(cache_directory, exist_ok=True)
+    # Written to a temporary file first, so an interrupted write is never loaded
+    with open(cache_file + ".tmp", "wb") as file:
+        pickle.dump(cleaned_spectra, file)
+    os.replace(cache_file + ".tmp", cache_file)
+    return cleaned_spectra
+
+
+def clean_spectra_file(filename: str, cache_directory: str, filters: Sequence[Tuple[str, dict]] = METADATA_FILTERS,
+                       **kwargs) -> List[Optional[Spectrum]]:
+    """Load spectra from an mgf or pickle file and clean them, cached by the hash of the file and the filters"""
+    input_hash = file_hash(filename)
+    if os.path.exists(_cache_file(cache_directory, input_hash, filters)):
+        spectra = []  # not needed, the cleaned spectra are loaded from the cache
+    elif filename.endswith(".mgf"):
+        spectra = list(load_from_mgf(filename))
+    else:
+        with open(filename, "rb") as file:
+            spectra = pickle.load(file)
+    return cached_clean_spectra(spectra, cache_directory, filters, input_hash=input_hash, **kwargs)
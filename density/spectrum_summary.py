@@ -0,0 +1,178 @@
+"""Single pass summaries of (large) collections of spectra, without holding all spectra in memory.
+
+The spectra are streamed from an mgf file, a pickle file or a spectrum store, and the annotation counts
+(see count_annotations in the density notebook), peak counts and a fixed-width parent mass histogram
+are updated per spectrum. Quantiles of the parent masses are estimated from the histogram.
+
+Usage:
+    summary = summarize_spectra(iter_spectra(mgf_path))
+    summary.print_annotation_counts()
+    summary.parent_masses.quantiles([0.05, 0.5, 0.95])
+"""
+import os
+import pickle
+import sys
+from typing import Iterable, Iterator, Sequence
+import numpy as np
+from matchms import Spectrum
+from matchms.importing import load_from_mgf
+
+
+class MassHistogram:
+    """Fixed-width histogram of masses between min_mass and max_mass, updated incrementally
+
+    Masses outside the range are counted in underflow and overflow. The quantiles are interpolated
+    within the bins, so their error is at most bin_width for quantiles inside the range.
+    """
+    def __init__(self, bin_width: float = 0.1, min_mass: float = 0.0, max_mass: float = 5000.0):
+        self.bin_width = bin_width
+        self.min_mass = min_mass
+        self.n_bins = int(np.ceil((max_mass - min_mass) / bin_width))
+        self.max_mass = min_mass + self.n_bins * bin_width
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def bin_edges(self) -> np.ndarray:
+        return self.min_mass + self.bin_width * np.arange(self.n_bins + 1)
+
+    def __len__(self) -> int:
+        return int(self.counts.sum()) + self.underflow + self.overflow
+
+    def add(self, masses: Sequence[float]):
+        masses = np.asarray(masses, dtype=np.float64).ravel()
+        masses = masses[~np.isnan(masses)]
+        if len(masses) == 0:
+            return
+        self.min = min(self.min, masses.min())
+        self.max = max(self.max, masses.max())
+        bin_idx = np.floor((masses - self.min_mass) / self.bin_width).astype(np.int64)
+        self.underflow += int(np.sum(bin_idx < 0))
+        self.overflow += int(np.sum(bin_idx >= self.n_bins))
+        in_range = (bin_idx >= 0) & (bin_idx < self.n_bins)
+        self.counts += np.bincount(bin_idx[in_range], minlength=self.n_bins)
+
+    def merge(self, other: "MassHistogram"):
+        assert (other.bin_width, other.min_mass, other.n_bins) == (self.bin_width, self.min_mass, self.n_bins), \
+            "Only histograms with the same bins can be merged"
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantiles(self, q: Sequence[float]) -> np.ndarray:
+        """Estimated quantiles, quantiles in the underflow or overflow are given as min_mass or max_mass"""
+        ranks = np.asarray(q, dtype=np.float64) * len(self)
+        cumulative = self.underflow + np.cumsum(self.counts)
+        # First bin in which the cumulative count reaches the rank, interpolated linearly within that bin
+        bin_idx = np.clip(np.searchsorted(cumulative, ranks, side="left"), 0, self.n_bins - 1)
+        counts = self.counts[bin_idx]
+        previous = cumulative[bin_idx] - counts
+        fraction = np.clip(np.divide(ranks - previous, counts, out=np.zeros(len(ranks)), where=counts > 0), 0, 1)
+        quantiles = self.bin_edges[bin_idx] + fraction * self.bin_width
+        quantiles[ranks <= self.underflow] = self.min_mass
+        quantiles[ranks > len(self) - self.overflow] = self.max_mass
+        return np.clip(quantiles, self.min, self.max)
+
+
+class SpectraSummary:
+    """Annotation, peak and parent mass counts of spectra, updated one spectrum at a time
+
+    Memory use is constant in the number of spectra, apart from the sets of unique InChIs, SMILES and
+    InChIKeys, which grow with the number of unique structures.
+    """
+    def __init__(self, mass_field: str = "parent_mass", **histogram_settings):
+        self.mass_field = mass_field
+        self.n_spectra = 0
+        self.annotation_counts = {"inchi": 0, "smiles": 0, "inchikey": 0}
+        self.unique_inchis = set()
+        self.unique_smiles = set()
+        self.unique_inchikeys14 = set()
+        self.n_less_than_3_peaks = 0
+        self.n_more_than_500_peaks = 0
+        self.n_without_mass = 0
+        self.parent_masses = MassHistogram(**histogram_settings)
+        self._mass_buffer = []
+
+    def update(self, spectrum: Spectrum):
+        self.n_spectra += 1
+        inchi = spectrum.get("inchi")
+        smiles = spectrum.get("smiles")
+        inchikey = spectrum.get("inchikey")
+        if inchikey is None:
+            inchikey = spectrum.get("inchikey_inchi")
+        self.unique_inchis.add(inchi)
+        self.unique_smiles.add(smiles)
+        self.annotation_counts["inchi"] += bool(inchi)
+        self.annotation_counts["smiles"] += bool(smiles)
+        if inchikey:
+            self.annotation_counts["inchikey"] += 1
+            self.unique_inchikeys14.add(inchikey[:14])
+        n_peaks = len(spectrum.peaks.mz)
+        self.n_less_than_3_peaks += n_peaks < 3
+        self.n_more_than_500_peaks += n_peaks > 500
+        mass = spectrum.get(self.mass_field)
+        if mass:
+            self._mass_buffer.append(mass)
+            # Masses are added to the histogram in batches, which is much faster than one by one
+            if len(self._mass_buffer) >= 10000:
+                self._flush_masses()
+        else:
+            self.n_without_mass += 1
+
+    def _flush_masses(self):
+        self.parent_masses.add(self._mass_buffer)
+        self._mass_buffer = []
+
+    def finish(self) -> "SpectraSummary":
+        self._flush_masses()
+        return self
+
+    def print_annotation_counts(self, file=sys.stdout):
+        """Prints the same counts as count_annotations in the density notebook"""
+        print("nr_of_spectra:", self.n_spectra, file=file)
+        print("Inchis:", self.annotation_counts["inchi"], "--", len(self.unique_inchis), "unique", file=file)
+        print("Smiles:", self.annotation_counts["smiles"], "--", len(self.unique_smiles), "unique", file=file)
+        print("Inchikeys:", self.annotation_counts["inchikey"], "--",
+              len(self.unique_inchikeys14), "unique (first 14 characters)", file=file)
+        print("Spectra with less than 3 peaks:", self.n_less_than_3_peaks, file=file)
+        print("Spectra with more than 500 peaks:", self.n_more_than_500_peaks, file=file)
+
+
+def iter_spectra(filename: str, chunk_size: int = 10000) -> Iterator[Spectrum]:
+    """Yield the spectra of an mgf file, a pickle file or a spectrum store (directory) one by one
+
+    mgf files and spectrum stores are read incrementally. A pickle file of a list of spectra has to be
+    unpickled as a whole, but the spectra are released as soon as they are yielded.
+    """
+    if os.path.isdir(filename):
+        from spectrum_store import SpectrumStore  # in ../benchmarking, add it to sys.path
+        store = SpectrumStore(filename)
+        for start in range(0, len(store), chunk_size):
+            yield from store.get_spectra(np.arange(start, min(start + chunk_size, len(store))))
+    elif filename.endswith(".mgf"):
+        yield from load_from_mgf(filename)
+    else:
+        with open(filename, "rb") as file:
+            spectra = pickle.load(file)
+        spectra.reverse()
+        while spectra:
+            yield spectra.pop()
+
+
+def summarize_spectra(spectra: Iterable[Spectrum], mass_field: str = "parent_mass",
+                      **histogram_settings) -> SpectraSummary:
+    """Summarize spectra in a single pass, spectra that are None (removed by a filter) are skipped
+
+    histogram_settings:
+        bin_width, min_mass and max_mass of the parent mass histogram.
+    """
+    summary = SpectraSummary(mass_field, **histogram_settings)
+    for spectrum in spectra:
+        if spectrum is not None:
+            summary.update(spectrum)
+    return summary.finish()
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from mass_density import kde_from_histogram, mass_density
+from spectrum_summary import MassHistogram
+
+
+def _masses(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.concatenate([rng.normal(300, 60, n // 2), rng.normal(800, 150, n - n // 2)])
+
+
+def test_fft_kde_matches_scipy():
+    stats = pytest.importorskip("scipy.stats")
+    masses = _masses(2000)
+    curve = mass_density(masses)
+    assert curve.n == 2000
+    assert curve.bandwidth == pytest.approx(np.std(masses, ddof=1) * 2000 ** (-1 / 5), rel=1e-4)
+    assert np.allclose(curve.density, stats.gaussian_kde(masses)(curve.x), atol=1e-5)
+    # Evaluated up to 3 bandwidths beyond the smallest and largest mass
+    assert curve.x[0] == pytest.approx(masses.min() - 3 * curve.bandwidth, abs=2 * 0.1)
+    assert curve.x[-1] == pytest.approx(masses.max() + 3 * curve.bandwidth, abs=2 * 0.1)
+
+
+def test_density_is_cached(tmp_path):
+    masses = _masses(500, 1)
+    curve = mass_density(masses, cache_directory=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    cached = mass_density(masses, cache_directory=str(tmp_path))
+    assert np.array_equal(cached.density, curve.density) and cached.n == curve.n
+    mass_density(masses, cache_directory=str(tmp_path), bw_adjust=0.5)
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_density_from_a_histogram():
+    masses = _masses(1000, 2)
+    histogram = MassHistogram(0.1, 0.0, 2000.0)
+    histogram.add(masses)
+    from_histogram = mass_density(histogram)
+    assert from_histogram.n == 1000
+    assert np.allclose(from_histogram.density.max(), mass_density(masses).density.max(), rtol=1e-3)
+
+
+@pytest.mark.parametrize("masses", [[], [np.nan], [500.0], [500.0, 500.01]])
+def test_too_few_masses(masses):
+    with pytest.raises(ValueError):
+        mass_density(masses)
+    with pytest.raises(ValueError, match="cannot be estimated"):
+        kde_from_histogram(np.zeros(10), np.arange(11.0))
@@ -0,0 +1,75 @@
+import os
+import pickle
+import numpy as np
+import matchms.filtering as msfilters
+from matchms import Spectrum
+from metadata_cleaning import (METADATA_FILTERS, apply_filters, cached_clean_spectra, clean_spectra,
+                               clean_spectra_file, derived_input_hash, file_hash)
+
+STRUCTURES = [{"smiles": "CCO"}, {"inchi": "InChI=1S/C6H6/c1-2-4-6-5-3-1/h1-6H"}, {"smiles": "c1ccccc1O"}, {}]
+PEAK_FILTERS = (("require_minimum_number_of_peaks", {"n_required": 3}),)
+
+
+def _spectra(n):
+    return [Spectrum(mz=np.linspace(50.0, 500.0, 2 + i % 4), intensities=np.linspace(0.1, 1.0, 2 + i % 4),
+                     metadata={"precursor_mz": 200.0 + i, "compound_name": f"compound {i}",
+                               **STRUCTURES[i % len(STRUCTURES)]})
+            for i in range(n)]
+
+
+def _apply_matchms_filters(spectrum, filters):
+    for filter_name, kwargs in filters:
+        if spectrum is not None:
+            spectrum = getattr(msfilters, filter_name)(spectrum, **kwargs)
+    return spectrum
+
+
+def _assert_same_spectra(spectra, expected):
+    assert len(spectra) == len(expected)
+    for spectrum, expected_spectrum in zip(spectra, expected):
+        if expected_spectrum is None:
+            assert spectrum is None
+        else:
+            assert spectrum == expected_spectrum
+
+
+def test_memoized_structure_conversions_match_matchms():
+    spectra = _spectra(8)
+    _assert_same_spectra([apply_filters(spectrum) for spectrum in spectra],
+                         [_apply_matchms_filters(spectrum, METADATA_FILTERS) for spectrum in spectra])
+    assert apply_filters(spectra[1]).get("inchikey") == "UHOVQNZJYSORNB-UHFFFAOYSA-N"
+
+
+def test_clean_spectra_keeps_the_order_over_workers():
+    spectra = _spectra(10)
+    expected = [_apply_matchms_filters(spectrum, PEAK_FILTERS) for spectrum in spectra]
+    assert sum(spectrum is None for spectrum in expected) == 3
+    _assert_same_spectra(clean_spectra(spectra, PEAK_FILTERS, n_workers=1), expected)
+    _assert_same_spectra(clean_spectra(spectra, PEAK_FILTERS, n_workers=2, chunk_size=3), expected)
+
+
+def test_cache_is_keyed_on_the_input_and_the_filters(tmp_path):
+    spectra = _spectra(6)
+    cache_directory = str(tmp_path / "cache")
+    cleaned = cached_clean_spectra(spectra, cache_directory, PEAK_FILTERS, input_hash="input")
+    # A cache hit does not clean the spectra that are passed
+    _assert_same_spectra(cached_clean_spectra([], cache_directory, PEAK_FILTERS, input_hash="input"), cleaned)
+    assert cached_clean_spectra([], cache_directory, PEAK_FILTERS, input_hash="other input") == []
+    assert cached_clean_spectra([], cache_directory, METADATA_FILTERS, input_hash="input") == []
+    assert len(os.listdir(cache_directory)) == 3
+    assert derived_input_hash("input", METADATA_FILTERS) != derived_input_hash("input", PEAK_FILTERS)
+
+
+def test_clean_spectra_file_is_cached_on_the_file_content(tmp_path):
+    spectra_file = str(tmp_path / "spectra.pickle")
+    cache_directory = str(tmp_path / "cache")
+    with open(spectra_file, "wb") as file:
+        pickle.dump(_spectra(6), file)
+    cleaned = clean_spectra_file(spectra_file, cache_directory, PEAK_FILTERS)
+    _assert_same_spectra(cleaned, [_apply_matchms_filters(spectrum, PEAK_FILTERS) for spectrum in _spectra(6)])
+    assert os.listdir(cache_directory)[0].startswith(file_hash(spectra_file))
+
+    with open(spectra_file, "wb") as file:
+        pickle.dump(_spectra(8), file)
+    assert len(clean_spectra_file(spectra_file, cache_directory, PEAK_FILTERS)) == 8
+    assert len(os.listdir(cache_directory)) == 2
@@ -0,0 +1,55 @@
+import pickle
+import numpy as np
+import pytest
+from matchms import Spectrum
+from spectrum_summary import MassHistogram, iter_spectra, summarize_spectra
+
+QUANTILES = [0.0, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 1.0]
+
+
+def test_quantiles_match_numpy_within_a_bin():
+    masses = np.random.default_rng(0).lognormal(6, 0.5, 20000)
+    histogram = MassHistogram(0.1, 0.0, 5000.0)
+    for batch in np.array_split(masses, 7):
+        histogram.add(batch)
+    assert len(histogram) == 20000
+    assert np.allclose(histogram.quantiles(QUANTILES), np.quantile(masses, QUANTILES), atol=0.1)
+
+
+def test_merged_histograms_and_masses_outside_the_range():
+    masses = np.random.default_rng(1).uniform(-50, 1100, 5000)
+    first, second = MassHistogram(1.0, 0.0, 1000.0), MassHistogram(1.0, 0.0, 1000.0)
+    first.add(masses[:2000])
+    second.add(np.append(masses[2000:], np.nan))
+    first.merge(second)
+    assert (first.underflow, first.overflow) == (np.sum(masses < 0), np.sum(masses >= 1000))
+    assert len(first) == 5000
+    inside = [0.1, 0.5, 0.85]
+    assert np.allclose(first.quantiles(inside), np.quantile(masses, inside), atol=1.0)
+    # Quantiles in the underflow or overflow are given as the edges of the range
+    assert first.quantiles([0.01, 0.99]).tolist() == [0.0, 1000.0]
+    with pytest.raises(AssertionError):
+        first.merge(MassHistogram(0.5, 0.0, 1000.0))
+
+
+def _spectra():
+    return [Spectrum(mz=np.linspace(50.0, 500.0, n_peaks), intensities=np.ones(n_peaks),
+                     metadata=metadata)
+            for n_peaks, metadata in [(2, {"parent_mass": 200.0, "inchikey": "A" * 14 + "-UHFFFAOYSA-N"}),
+                                      (10, {"parent_mass": 300.0, "inchikey": "A" * 14 + "-UHFFFAOYSB-N",
+                                            "smiles": "CCO"}),
+                                      (600, {"inchi": "InChI=1S/CH4/h1H4"}),
+                                      (5, {"parent_mass": 400.0})]]
+
+
+def test_summary_counts(tmp_path):
+    with open(tmp_path / "spectra.pickle", "wb") as file:
+        pickle.dump(_spectra(), file)
+    summary = summarize_spectra(list(iter_spectra(str(tmp_path / "spectra.pickle"))) + [None],
+                                bin_width=1.0, max_mass=1000.0)
+    assert summary.n_spectra == 4
+    assert summary.annotation_counts == {"inchi": 1, "smiles": 1, "inchikey": 2}
+    assert summary.unique_inchikeys14 == {"A" * 14}
+    assert (summary.n_less_than_3_peaks, summary.n_more_than_500_peaks, summary.n_without_mass) == (1, 1, 1)
+    assert len(summary.parent_masses) == 3
+    assert summary.parent_masses.quantiles([0.5])[0] == pytest.approx(300.0, abs=1.0)